@@ -15,8 +15,15 @@ PROBE_API_URL_GET_PROBES = \
     'https://kong.speedcheckerapi.com:8443/ProbeAPIService/Probes.svc/GetProbesByBoundingBox'
 EARTH_RADIUS = 6371
 
+# probes within this radius [km] are assigned to a location (at most NEAR_PROBES_LIMIT)
+NEAR_PROBES_RADIUS = 1000
+NEAR_PROBES_LIMIT = 200
+
 DEFAULT_BUFFER_TIME = 9
 
 PROBE_CACHING_PATH = '/var/cache/hloc/ripe_probes.cache'
+TRIE_CACHING_DIR = '/var/cache/hloc/tries'
+RIPE_HISTORY_CACHE_PATH = '/var/cache/hloc/ripe_history.sqlite'
+RIPE_RATE_LIMIT_PATH = '/var/cache/hloc/ripe_rate_limit.sqlite'
 
 HLOC_RIPE_TAG = 'hloc-geolocation'
@@ -3,16 +3,31 @@
 A collection of queries connected to the location object
 """
 
+import enum
+import io
 import typing
 import datetime
 import sqlalchemy as sqla
 import sqlalchemy.exc
+import sqlalchemy.orm as sqlorm
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.sql.expression import func
 
 
+from hloc import constants
 from hloc.models import State, Probe, Domain, MeasurementResult, DomainLabel, Base, \
-    DomainType, Location, LocationInfo, AirportInfo
+    DomainType, Location, LocationInfo, AirportInfo, MinRttMeasurement, LocationHint, CodeMatch
+from hloc.models.measurement_result import MEASUREMENT_RESULTS_DEFAULT_PARTITION
+
+UPSERT_BATCH_SIZE = 10**4
+MEASUREMENT_PARTITION_INTERVAL = datetime.timedelta(days=7)
+# the number of partitions created in advance after the current one
+MEASUREMENT_PARTITIONS_AHEAD = 4
+__MEASUREMENT_PARTITION_PREFIX = 'measurement_results_p'
+# a monday so the weekly partitions start on mondays
+__MEASUREMENT_PARTITION_EPOCH = datetime.datetime(1970, 1, 5)
+__MEASUREMENT_PARTITION_LOCK_ID = 0x686c6f63
 
 
 def create_engine(database_name: str, database_user: str='hloc', database_password: str='hloc2017'):
@@ -37,7 +52,227 @@ def create_session_for_process(engine):
 
 def recreate_db(engine):
     Base.metadata.drop_all(bind=engine)
+    create_extensions(engine)
     Base.metadata.create_all(bind=engine)
+    create_measurement_partitions(engine, datetime.datetime.now())
+
+
+def create_extensions(engine):
+    """Creates the postgres extensions needed by the indexes of the models"""
+    with engine.begin() as connection:
+        connection.execute(sqla.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
+
+def create_domain_label_indexes(engine):
+    """
+    Creates the indexes used by the incremental find on databases created before they existed
+    """
+    create_extensions(engine)
+    for index in DomainLabel.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+
+def id_sequence_name(table: sqla.Table) -> str:
+    """Returns the name of the sequence postgres created for the serial id column"""
+    return '{}_id_seq'.format(table.name)
+
+
+def allocate_ids(table: sqla.Table, count: int, db_session) -> [int]:
+    """
+    Reserves ids from the id sequence of the table for rows inserted with COPY
+    :param table: the table of the rows
+    :param count: the number of ids needed
+    :param db_session: a data base session on which the queries are executed
+    :return: a list with count unused ids
+    """
+    if count <= 0:
+        return []
+
+    id_query = sqla.text('SELECT nextval(:sequence_name) FROM generate_series(1, :count)')
+    return [row[0] for row in db_session.execute(
+        id_query, {'sequence_name': id_sequence_name(table), 'count': count})]
+
+
+__COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def __copy_value(value) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, enum.Enum):
+        # postgres enums created from python enums use the member names
+        return value.name
+    return str(value).translate(__COPY_ESCAPES)
+
+
+def copy_rows(table: sqla.Table, columns: [str], rows: typing.Iterable[tuple], db_session) -> int:
+    """
+    Inserts the rows with COPY FROM STDIN in the transaction of the session
+    :param table: the table the rows are inserted in
+    :param columns: the column names in the order of the row values
+    :param rows: tuples with the values of the rows
+    :param db_session: a data base session on which the queries are executed
+    :return: the number of inserted rows
+    """
+    copy_buffer = io.StringIO()
+    row_count = 0
+    for row in rows:
+        copy_buffer.write('\t'.join(__copy_value(value) for value in row))
+        copy_buffer.write('\n')
+        row_count += 1
+
+    if not row_count:
+        return 0
+
+    copy_buffer.seek(0)
+    cursor = db_session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table.name, ', '.join(columns)),
+                           copy_buffer)
+    finally:
+        cursor.close()
+
+    return row_count
+
+
+def measurement_partition_start(timestamp: datetime.datetime) -> datetime.datetime:
+    """Returns the start of the measurement_results partition containing the timestamp"""
+    partition_number = (timestamp - __MEASUREMENT_PARTITION_EPOCH) // \
+        MEASUREMENT_PARTITION_INTERVAL
+    return __MEASUREMENT_PARTITION_EPOCH + partition_number * MEASUREMENT_PARTITION_INTERVAL
+
+
+def measurement_partition_name(partition_start: datetime.datetime) -> str:
+    """Returns the table name of the measurement_results partition starting at partition_start"""
+    return '{}{}'.format(__MEASUREMENT_PARTITION_PREFIX, partition_start.strftime('%Y%m%d'))
+
+
+def measurement_results_partitioned(bind) -> bool:
+    """
+    Returns if the measurement_results table is partitioned
+    Databases created before the partitioning have a plain table
+    """
+    partitioned_query = sqla.text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass('measurement_results'))")
+    return bool(bind.execute(partitioned_query).scalar())
+
+
+def get_measurement_partitions(bind) -> [typing.Tuple[str, datetime.datetime]]:
+    """
+    :param bind: an engine, connection or session on which the queries are executed
+    :return: the names and start timestamps of all time range partitions ordered by start
+    """
+    partitions_query = sqla.text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass('measurement_results') "
+        "AND child.relname LIKE :prefix")
+    partitions = []
+    for name, in bind.execute(partitions_query,
+                              {'prefix': __MEASUREMENT_PARTITION_PREFIX + '%'}):
+        start = datetime.datetime.strptime(name[len(__MEASUREMENT_PARTITION_PREFIX):], '%Y%m%d')
+        partitions.append((name, start))
+
+    partitions.sort(key=lambda partition: partition[1])
+    return partitions
+
+
+def __create_measurement_partition(connection, name: str, start: datetime.datetime):
+    end = start + MEASUREMENT_PARTITION_INTERVAL
+    create_statement = "CREATE TABLE {} PARTITION OF measurement_results " \
+                       "FOR VALUES FROM ('{}') TO ('{}')".format(name, start.isoformat(),
+                                                               end.isoformat())
+    range_params = {'start': start, 'end': end}
+    range_condition = 'timestamp >= :start AND timestamp < :end'
+
+    default_rows_query = sqla.text('SELECT EXISTS (SELECT 1 FROM {} WHERE {})'.format(
+        MEASUREMENT_RESULTS_DEFAULT_PARTITION, range_condition))
+    if not connection.execute(default_rows_query, range_params).scalar():
+        connection.execute(sqla.text(create_statement))
+        return
+
+    # postgres refuses to create a partition for rows saved in the default partition
+    connection.execute(sqla.text('ALTER TABLE measurement_results DETACH PARTITION {}'.format(
+        MEASUREMENT_RESULTS_DEFAULT_PARTITION)))
+    connection.execute(sqla.text(create_statement))
+    connection.execute(sqla.text('INSERT INTO {} SELECT * FROM {} WHERE {}'.format(
+        name, MEASUREMENT_RESULTS_DEFAULT_PARTITION, range_condition)), range_params)
+    connection.execute(sqla.text('DELETE FROM {} WHERE {}'.format(
+        MEASUREMENT_RESULTS_DEFAULT_PARTITION, range_condition)), range_params)
+    connection.execute(sqla.text('ALTER TABLE measurement_results ATTACH PARTITION {} DEFAULT'
+                                 .format(MEASUREMENT_RESULTS_DEFAULT_PARTITION)))
+
+
+def create_measurement_partitions(engine, oldest_timestamp: datetime.datetime,
+                                  newest_timestamp: datetime.datetime=None) -> [str]:
+    """
+    Creates the missing measurement_results partitions for the time range
+    Inserts are routed to the partitions by postgres. Call this before the inserting processes
+    start, it needs an exclusive lock on the table. Rows of the new partitions saved in the
+    default partition are moved.
+    :param engine: the database engine
+    :param oldest_timestamp: the oldest timestamp which should have a partition
+    :param newest_timestamp: the newest timestamp which should have a partition
+                             (default: MEASUREMENT_PARTITIONS_AHEAD partitions after now)
+    :return: the names of the created partitions
+    """
+    if newest_timestamp is None:
+        newest_timestamp = datetime.datetime.now() + \
+            MEASUREMENT_PARTITIONS_AHEAD * MEASUREMENT_PARTITION_INTERVAL
+
+    created_partitions = []
+    with engine.begin() as connection:
+        if not measurement_results_partitioned(connection):
+            return created_partitions
+
+        connection.execute(sqla.text('SELECT pg_advisory_xact_lock(:lock_id)'),
+                           {'lock_id': __MEASUREMENT_PARTITION_LOCK_ID})
+        existing_partitions = {name for name, _ in get_measurement_partitions(connection)}
+
+        partition_start = measurement_partition_start(oldest_timestamp)
+        while partition_start <= newest_timestamp:
+            name = measurement_partition_name(partition_start)
+            if name not in existing_partitions:
+                __create_measurement_partition(connection, name, partition_start)
+                created_partitions.append(name)
+            partition_start += MEASUREMENT_PARTITION_INTERVAL
+
+    return created_partitions
+
+
+def drop_measurement_partitions(engine, oldest_timestamp: datetime.datetime,
+                                detach_only: bool=False) -> [str]:
+    """
+    Removes all measurement results older than oldest_timestamp
+    Partitions older than oldest_timestamp are detached and dropped, only the rows of the
+    partition containing oldest_timestamp and of the default partition are deleted.
+    :param engine: the database engine
+    :param oldest_timestamp: the timestamp of the oldest measurement kept
+    :param detach_only: keep the detached partitions as standalone tables
+    :return: the names of the detached partitions
+    """
+    detached_partitions = []
+    with engine.begin() as connection:
+        connection.execute(sqla.text('SELECT pg_advisory_xact_lock(:lock_id)'),
+                           {'lock_id': __MEASUREMENT_PARTITION_LOCK_ID})
+
+        for name, start in get_measurement_partitions(connection):
+            if start + MEASUREMENT_PARTITION_INTERVAL > oldest_timestamp:
+                break
+
+            connection.execute(sqla.text(
+                'ALTER TABLE measurement_results DETACH PARTITION {}'.format(name)))
+            if not detach_only:
+                connection.execute(sqla.text('DROP TABLE {}'.format(name)))
+            detached_partitions.append(name)
+
+        connection.execute(MeasurementResult.__table__.delete().where(
+            MeasurementResult.__table__.c.timestamp < oldest_timestamp))
+
+    return detached_partitions
 
 
 def state_for_code(state_code, state_name, db_session):
@@ -148,7 +383,8 @@ def get_measurements_for_domain(domain: Domain,
                                 max_measurement_age: typing.Optional[int],
                                 sorted_return: bool,
                                 db_session,
-                                allow_all_zmap_measurements: bool = False) -> [MeasurementResult]:
+                                allow_all_zmap_measurements: bool = False,
+                                use_min_rtt_table: bool = False) -> [MeasurementResult]:
     """
     :param domain: the domain for which measurements should be returned
     :param ip_version: ipv4 or ipv6
@@ -156,14 +392,44 @@ def get_measurements_for_domain(domain: Domain,
     :param sorted_return: if the returned values should be ordered by the rtt set to True
     :param db_session: a data base session on which the queries are executed
     :param allow_all_zmap_measurements: Allow zmap measurement regardless of their timestamp
+    :param use_min_rtt_table: return the minimal measurement of every probe and measurement
+                              type within the allowed age instead of all measurements
     :return: all measurements related to this domain
     """
+    return get_measurements_for_ips([domain.ip_for_version(ip_version)], max_measurement_age,
+                                    sorted_return, db_session,
+                                    allow_all_zmap_measurements=allow_all_zmap_measurements,
+                                    use_min_rtt_table=use_min_rtt_table)
+
+
+def get_measurements_for_ips(ip_addresses: [str],
+                             max_measurement_age: typing.Optional[int],
+                             sorted_return: bool,
+                             db_session,
+                             allow_all_zmap_measurements: bool = False,
+                             use_min_rtt_table: bool = False,
+                             load_probe_locations: bool = False) -> [MeasurementResult]:
+    """
+    Returns the measurements for all ip addresses with one query
+    :param ip_addresses: the destination addresses of the measurements
+    :param load_probe_locations: load the probes and their locations with the same query
+    The other parameters are the same as for get_measurements_for_domain
+    """
+    if use_min_rtt_table:
+        return __get_min_measurements_for_ips(ip_addresses, max_measurement_age, sorted_return,
+                                              db_session, allow_all_zmap_measurements,
+                                              load_probe_locations)
+
+    if len(ip_addresses) == 1:
+        destination_filter = MeasurementResult.destination_address == next(iter(ip_addresses))
+    else:
+        destination_filter = MeasurementResult.destination_address.in_(ip_addresses)
 
     if max_measurement_age:
         if allow_all_zmap_measurements:
             query = db_session.query(MeasurementResult).filter(
                 sqla.and_(
-                    MeasurementResult.destination_address == domain.ip_for_version(ip_version),
+                    destination_filter,
                     sqla.or_(
                         MeasurementResult.timestamp >= datetime.datetime.now() -
                         datetime.timedelta(seconds=max_measurement_age),
@@ -174,15 +440,17 @@ def get_measurements_for_domain(domain: Domain,
         else:
             query = db_session.query(MeasurementResult).filter(
                 sqla.and_(
-                    MeasurementResult.destination_address == domain.ip_for_version(ip_version),
+                    destination_filter,
                     MeasurementResult.timestamp >= datetime.datetime.now() - datetime.timedelta(
                         seconds=max_measurement_age),
                 )
             )
     else:
-        query = db_session.query(MeasurementResult).filter(
-            MeasurementResult.destination_address == domain.ip_for_version(ip_version)
-        )
+        query = db_session.query(MeasurementResult).filter(destination_filter)
+
+    if load_probe_locations:
+        query = query.options(
+            sqlorm.joinedload(MeasurementResult.probe).joinedload(Probe.location))
 
     if sorted_return:
         query = query.order_by(MeasurementResult.timestamp.desc())
@@ -190,6 +458,210 @@ def get_measurements_for_domain(domain: Domain,
     return query
 
 
+def __get_min_measurements_for_ips(ip_addresses: [str],
+                                   max_measurement_age: typing.Optional[int],
+                                   sorted_return: bool,
+                                   db_session,
+                                   allow_all_zmap_measurements: bool,
+                                   load_probe_locations: bool) \
+        -> [typing.Union[MinRttMeasurement, MeasurementResult]]:
+    """
+    Returns the minimal measurement of every probe and measurement type within the allowed age
+    The stored minimum is returned if it was measured within the allowed age, otherwise the
+    minimum is selected from the measurements within the allowed age
+    """
+    min_query = db_session.query(MinRttMeasurement).filter(
+        MinRttMeasurement.destination_address.in_(ip_addresses))
+    if load_probe_locations:
+        min_query = min_query.options(
+            sqlorm.joinedload(MinRttMeasurement.probe).joinedload(Probe.location))
+
+    oldest_timestamp = None
+    if max_measurement_age:
+        oldest_timestamp = datetime.datetime.now() - datetime.timedelta(
+            seconds=max_measurement_age)
+
+    measurements = []
+    # (destination, probe, type) of the minima older than the allowed age
+    outdated_keys = []
+    for min_measurement in min_query:
+        if oldest_timestamp is None or min_measurement.timestamp >= oldest_timestamp or \
+                (allow_all_zmap_measurements and
+                 min_measurement.measurement_result_type == 'zmap_measurement'):
+            measurements.append(min_measurement)
+        else:
+            outdated_keys.append((min_measurement.destination_address, min_measurement.probe_id,
+                                  min_measurement.measurement_result_type))
+
+    key_columns = [MeasurementResult.destination_address, MeasurementResult.probe_id,
+                   MeasurementResult.measurement_result_type]
+    for start in range(0, len(outdated_keys), UPSERT_BATCH_SIZE):
+        window_query = db_session.query(MeasurementResult).filter(
+            sqla.tuple_(*key_columns).in_(outdated_keys[start:start + UPSERT_BATCH_SIZE]),
+            MeasurementResult.timestamp >= oldest_timestamp,
+            MeasurementResult.error_msg.is_(None),
+            MeasurementResult.rtt > 0
+        ).distinct(*key_columns).order_by(*key_columns, MeasurementResult.rtt,
+                                          MeasurementResult.timestamp)
+        if load_probe_locations:
+            window_query = window_query.options(
+                sqlorm.joinedload(MeasurementResult.probe).joinedload(Probe.location))
+        measurements.extend(window_query)
+
+    if sorted_return:
+        measurements.sort(key=lambda measurement: measurement.timestamp, reverse=True)
+
+    return measurements
+
+
+def load_domains_with_hints(domain_ids: [int], db_session) -> [Domain]:
+    """
+    Loads the domains with their labels, the hints of the labels and the hint locations
+    The relations are loaded with one IN query per level instead of one query per object
+    """
+    # load the columns of the subclasses used by the checks (code type and city name) as well
+    hint_entity = sqlorm.with_polymorphic(LocationHint, [CodeMatch])
+    location_entity = sqlorm.with_polymorphic(Location, [LocationInfo], flat=True)
+    return db_session.query(Domain).filter(Domain.id.in_(domain_ids)).options(
+        sqlorm.selectinload(Domain.labels)
+        .selectinload(DomainLabel.hints.of_type(hint_entity))
+        .joinedload(hint_entity.location.of_type(location_entity))).populate_existing().all()
+
+
+def ip_version_for_address(ip_address: str) -> str:
+    """Returns the ip version identifier of the address"""
+    return constants.IPV6_IDENTIFIER if ':' in str(ip_address) else constants.IPV4_IDENTIFIER
+
+
+__min_rtt_table_databases = set()
+
+
+def min_rtt_table_exists(bind) -> bool:
+    """
+    Checks if the min rtt table exists
+    Once the table was found it is not looked up again for the same database.
+    :param bind: an engine or connection of the database
+    """
+    database_url = str(bind.engine.url)
+    if database_url in __min_rtt_table_databases:
+        return True
+
+    if not sqla.inspect(bind).has_table(MinRttMeasurement.__tablename__):
+        return False
+
+    __min_rtt_table_databases.add(database_url)
+    return True
+
+
+def create_min_rtt_table(engine):
+    """
+    Creates the min rtt table on databases created before it existed
+    A newly created table is filled from the saved measurements. Once the table exists all
+    measurement results saved with save_measurement_results are merged into it.
+    """
+    if min_rtt_table_exists(engine):
+        return
+
+    MinRttMeasurement.__table__.create(bind=engine)
+    with engine.begin() as connection:
+        rebuild_min_rtt_measurements(connection)
+
+
+def rebuild_min_rtt_measurements(db_session, oldest_timestamp: datetime.datetime=None):
+    """
+    Merges the minima of all saved measurements into the min rtt table
+    :param db_session: a data base session or connection on which the queries are executed
+    :param oldest_timestamp: only merge measurements newer than this timestamp
+    """
+    rebuild_query = sqla.text(
+        "INSERT INTO min_rtt_measurements (destination_address, probe_id, ip_version, "
+        "measurement_result_type, rtt, timestamp, measurement_result_id) "
+        "SELECT DISTINCT ON (destination_address, probe_id, measurement_result_type) "
+        "destination_address, probe_id, "
+        "CASE WHEN family(destination_address) = 6 THEN :ipv6 ELSE :ipv4 END, "
+        "measurement_result_type, rtt, timestamp, id "
+        "FROM measurement_results "
+        "WHERE error_msg IS NULL AND rtt > 0 "
+        "AND (CAST(:oldest_timestamp AS timestamp) IS NULL OR timestamp >= :oldest_timestamp) "
+        "ORDER BY destination_address, probe_id, measurement_result_type, rtt, timestamp "
+        "ON CONFLICT (destination_address, probe_id, ip_version, measurement_result_type) "
+        "DO UPDATE SET rtt = excluded.rtt, timestamp = excluded.timestamp, "
+        "measurement_result_id = excluded.measurement_result_id "
+        "WHERE min_rtt_measurements.rtt > excluded.rtt")
+    db_session.execute(rebuild_query, {'ipv4': constants.IPV4_IDENTIFIER,
+                                       'ipv6': constants.IPV6_IDENTIFIER,
+                                       'oldest_timestamp': oldest_timestamp})
+
+
+def upsert_min_rtt_measurements(measurement_results: typing.Iterable[MeasurementResult],
+                                db_session) -> int:
+    """
+    Lowers the minima in the min rtt table to the rtts of the measurement results
+    Results with an error or without rtt are ignored. The ids of the results are saved as
+    reference and must be assigned before.
+    :param measurement_results: the measurement results to merge
+    :param db_session: a data base session on which the queries are executed
+    :return: the number of (destination, probe, ip version, type) minima merged
+    """
+    # ON CONFLICT DO UPDATE can not change the same row twice in one statement
+    min_values = {}
+    for measurement_result in measurement_results:
+        if measurement_result.error_msg is not None or not measurement_result.rtt:
+            continue
+
+        destination_address = str(measurement_result.destination_address)
+        ip_version = ip_version_for_address(destination_address)
+        key = (destination_address, measurement_result.probe_id, ip_version,
+               measurement_result.measurement_result_type)
+        current_min = min_values.get(key)
+        if current_min is None or current_min['rtt'] > measurement_result.rtt:
+            min_values[key] = {
+                'destination_address': destination_address,
+                'probe_id': measurement_result.probe_id,
+                'ip_version': ip_version,
+                'measurement_result_type': measurement_result.measurement_result_type,
+                'rtt': measurement_result.rtt,
+                'timestamp': measurement_result.timestamp,
+                'measurement_result_id': measurement_result.id,
+            }
+
+    values = list(min_values.values())
+    min_rtt_table = MinRttMeasurement.__table__
+    for start in range(0, len(values), UPSERT_BATCH_SIZE):
+        insert_query = postgresql.insert(min_rtt_table).values(
+            values[start:start + UPSERT_BATCH_SIZE])
+        db_session.execute(insert_query.on_conflict_do_update(
+            index_elements=[min_rtt_table.c.destination_address, min_rtt_table.c.probe_id,
+                            min_rtt_table.c.ip_version, min_rtt_table.c.measurement_result_type],
+            set_={'rtt': insert_query.excluded.rtt,
+                  'timestamp': insert_query.excluded.timestamp,
+                  'measurement_result_id': insert_query.excluded.measurement_result_id},
+            where=min_rtt_table.c.rtt > insert_query.excluded.rtt))
+
+    return len(values)
+
+
+def save_measurement_results(measurement_results: [MeasurementResult], db_session):
+    """
+    Saves the measurement results in bulk
+    If the min rtt table exists the results are merged into it as well.
+    :param measurement_results: the results to save
+    :param db_session: a data base session on which the queries are executed
+    """
+    update_min_rtt_table = min_rtt_table_exists(db_session.get_bind())
+    if update_min_rtt_table:
+        results_without_id = [measurement_result for measurement_result in measurement_results
+                              if measurement_result.id is None]
+        ids = allocate_ids(MeasurementResult.__table__, len(results_without_id), db_session)
+        for measurement_result, result_id in zip(results_without_id, ids):
+            measurement_result.id = result_id
+
+    db_session.bulk_save_objects(measurement_results)
+
+    if update_min_rtt_table:
+        upsert_min_rtt_measurements(measurement_results, db_session)
+
+
 def get_all_domain_ids_splitted(index: int, block_limit: int, nr_processes: int,
                                 domain_types: typing.List[DomainType], db_session) \
         -> typing.Generator[int, None, None]:
@@ -232,13 +704,75 @@ def get_all_domains_splitted_efficient(index: int, block_limit: int, nr_processe
             break
 
 
-def get_all_domain_labels(index: int, block_limit: int, nr_processes: int, db_session) -> typing.Generator[DomainLabel, None, None]:
+def get_all_domain_labels(index: int, block_limit: int, nr_processes: int, db_session,
+                          label_filter=None) -> typing.Generator[DomainLabel, None, None]:
+    """
+    :param label_filter: an optional additional filter expression on the labels
+    """
     domain_labels_query = db_session.query(DomainLabel).filter(DomainLabel.id % nr_processes == index)
+    if label_filter is not None:
+        domain_labels_query = domain_labels_query.filter(label_filter)
 
     for domain_label in domain_labels_query.yield_per(block_limit):
         yield domain_label
 
 
+def stream_domain_label_batches(batch_size: int, db_session, label_filter=None,
+                                limit: typing.Optional[int]=None) \
+        -> typing.Generator[typing.List[typing.Tuple[int, str, bool]], None, None]:
+    """
+    Streams the labels ordered by id with a server side cursor
+    :param batch_size: the number of labels per batch
+    :param db_session: a data base session on which the queries are executed
+    :param label_filter: an optional filter expression on the labels
+    :param limit: the maximum number of labels returned
+    :return: lists of (id, name, searched before) tuples
+    """
+    labels_query = sqla.select([DomainLabel.id, DomainLabel.name,
+                                DomainLabel.last_searched.isnot(None)])
+    if label_filter is not None:
+        labels_query = labels_query.where(label_filter)
+    labels_query = labels_query.order_by(DomainLabel.id)
+    if limit:
+        labels_query = labels_query.limit(limit)
+
+    result = db_session.connection(execution_options={'stream_results': True}).execute(
+        labels_query)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+    finally:
+        result.close()
+
+
+def domain_labels_to_search_filter(codes: typing.Iterable[str]):
+    """
+    Returns the filter for all labels which were never searched or contain one of the codes
+    The substring conditions are answered by the trigram index on the label names
+    """
+    conditions = [DomainLabel.last_searched.is_(None)]
+    for code in codes:
+        escaped_code = code.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append(DomainLabel.name.like('%' + escaped_code + '%', escape='\\'))
+
+    return sqla.or_(*conditions)
+
+
+def mark_domain_labels_searched(label_ids: typing.Iterable[int], db_session,
+                                searched_time: typing.Optional[datetime.datetime]=None):
+    """Sets last_searched for the labels with the ids"""
+    label_ids = list(label_ids)
+    if not label_ids:
+        return
+
+    update_query = sqla.update(DomainLabel).where(DomainLabel.id.in_(label_ids)).values(
+        last_searched=searched_time or datetime.datetime.now())
+    db_session.execute(update_query)
+
+
 def get_domains_for_ips(ip_filter_list: typing.List[str], db_session, block_limit: int,
                         use_random_order: bool=False, endless_mode: bool=False) \
         -> typing.Generator[Domain, None, None]:
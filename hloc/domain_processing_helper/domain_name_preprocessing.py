@@ -5,13 +5,22 @@ import binascii
 import collections
 import enum
 import ipaddress
+import itertools
 import mmap
 import os
 import re
 import socket
 import string
+import typing
+
+import numpy as np
+
+from hloc.models import DomainType
 
 ACCEPTED_CHARACTER = frozenset('{0}.-_'.format(string.printable[0:62]))
+# the domain type for every classification code returned by DomainClassifier.classify_columns
+DOMAIN_TYPE_CODES = [DomainType.valid, DomainType.bad_tld, DomainType.invalid_characters,
+                     DomainType.ip_encoded, DomainType.blacklisted]
 
 
 @enum.unique
@@ -70,9 +79,13 @@ def main():
 
     regex_strategy = RegexStrategy(value=args.regex_strategy)
 
+    domain_classifier = DomainClassifier(tlds, white_list=white_list, ip_version=args.ip_version,
+                                         regex_strategy=regex_strategy)
+
     os.mkdir(args.destination)
 
-    ip_domain_tuples = []
+    ip_addresses = []
+    domains = []
 
     print('Putting outputfiles into ' + args.destination)
 
@@ -90,41 +103,218 @@ def main():
             open(os.path.join(args.destination, filename + '-custom-filtered'), 'w',
                  encoding='utf-8') as custom_filter_file:
 
-        def save(correct, bad, bad_dns, ip_encoded, custom_filtered):
-            correct_file.write('\n'.join([','.join(tup) for tup in correct]) + '\n')
-            bad_file.write('\n'.join([','.join(tup) for tup in bad]) + '\n')
-            bad_dns_file.write('\n'.join([','.join(tup) for tup in bad_dns]) + '\n')
-            ip_encoded_file.write('\n'.join([','.join(tup) for tup in ip_encoded]) + '\n')
-            custom_filter_file.write('\n'.join([','.join(tup) for tup in custom_filtered]) + '\n')
+        files_for_type = {
+            DomainType.valid: correct_file,
+            DomainType.invalid_characters: bad_file,
+            DomainType.bad_tld: bad_dns_file,
+            DomainType.ip_encoded: ip_encoded_file,
+            DomainType.blacklisted: custom_filter_file,
+        }
+
+        def save():
+            codes = domain_classifier.classify_columns(ip_addresses, domains)
+            for domain_type, indexes in domain_type_indexes(codes).items():
+                files_for_type[domain_type].write(
+                    '\n'.join([ip_addresses[index] + ',' + domains[index] for index in indexes])
+                    + '\n')
+
+            del ip_addresses[:]
+            del domains[:]
 
         line = domain_file_mm.readline().decode(args.encoding)
         while line:
-            line = line.strip()
-            ip_domain_tuples.append(line.split(',', 1))
+            ip_address, domain = line.strip().split(',', 1)
+            ip_addresses.append(ip_address)
+            domains.append(domain)
 
-            if len(ip_domain_tuples) > 10 ** 5:
-                correct, bad, bad_dns, ip_encoded, custom_filtered, _ = preprocess_domains(
-                    ip_domain_tuples, tlds, white_list=white_list, ip_version=args.ip_version,
-                    regex_strategy=regex_strategy)
-                save(correct, bad, bad_dns, ip_encoded, custom_filtered)
-                del ip_domain_tuples[:]
+            if len(ip_addresses) > 10 ** 5:
+                save()
 
             line = domain_file_mm.readline().decode(args.encoding)
 
-        correct, bad, bad_dns, ip_encoded, custom_filtered, _ = preprocess_domains(
-            ip_domain_tuples, tlds, white_list=white_list, ip_version=args.ip_version,
-            regex_strategy=args.regexStrategy)
-        save(correct, bad, bad_dns, ip_encoded, custom_filtered)
+        save()
+
+
+class DomainClassifier(object):
+    """
+    Classifies domains with all checks of preprocess_domains
+    Built once per strategy, a domain is classified by deriving all encodings of its IP address
+    (decimal octets, zero padded octets, hex, base36 and the exploded IPv6 groups) and
+    testing them with plain substring searches instead of the backreference regexes.
+    """
+
+    __VALID_CODE = DOMAIN_TYPE_CODES.index(DomainType.valid)
+    __BAD_TLD_CODE = DOMAIN_TYPE_CODES.index(DomainType.bad_tld)
+    __INVALID_CHARACTERS_CODE = DOMAIN_TYPE_CODES.index(DomainType.invalid_characters)
+    __IP_ENCODED_CODE = DOMAIN_TYPE_CODES.index(DomainType.ip_encoded)
+    __BLACKLISTED_CODE = DOMAIN_TYPE_CODES.index(DomainType.blacklisted)
+
+    __BASE36_DIGITS = string.digits + string.ascii_lowercase
+    __BASE36_DIGIT_PAIRS = [''.join(pair) for pair in itertools.product(__BASE36_DIGITS, repeat=2)]
+    __IPV4_REGEX = re.compile(r'^([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})$')
+    # looks ahead at every position so overlapping octet sequences are found
+    __STRICT_OCTETS_REGEX = re.compile(r'(?=([0-9]+)[\.\-_]([0-9]+)[\.\-_]([0-9]+)[\.\-_]([0-9]+))')
+
+    def __init__(self, tlds: {str}, white_list: typing.Optional[typing.Set[str]]=None,
+                 ip_version: str='ipv4', regex_strategy: RegexStrategy=RegexStrategy.abstract,
+                 ip_encoding_filter: bool=True):
+        """
+        :param tlds: the valid top level domains
+        :param white_list: if set all domains for other IPs are classified as blacklisted
+        :param ip_version: the version of all IP addresses classified (ipv4 or ipv6)
+        :param regex_strategy: how the decimal octets of IPv4 addresses are searched
+        :param ip_encoding_filter: if False no domain is classified as ip encoded
+        """
+        self.tlds = tlds
+        self.white_list = white_list
+        self.is_ipv6 = ip_version == 'ipv6'
+        self.regex_strategy = regex_strategy
+        self.ip_encoding_filter = ip_encoding_filter
+        self.__tld_array = np.array(sorted(tlds), dtype=np.str_)
+
+    def classify(self, ip_address: str, domain: str) -> DomainType:
+        """Returns the type of the domain"""
+        code = self.__filter_code(ip_address, domain)
+        if code != self.__VALID_CODE:
+            return DOMAIN_TYPE_CODES[code]
+        if domain.rsplit('.', 1)[-1] in self.tlds:
+            return DomainType.valid
+
+        return DomainType.bad_tld
+
+    def classify_columns(self, ip_addresses: typing.Sequence[str],
+                         domains: typing.Sequence[str]) -> np.ndarray:
+        """
+        Classifies the domains given as parallel sequences of IP addresses and domain names
+        The top level domains are checked for all domains at once
+        :return: an uint8 array with the index in DOMAIN_TYPE_CODES for every domain
+        """
+        if len(ip_addresses) != len(domains):
+            raise ValueError('ip_addresses and domains must have the same length')
+        if not len(domains):
+            return np.empty(0, dtype=np.uint8)
+
+        codes = np.fromiter((self.__filter_code(ip_address, domain)
+                             for ip_address, domain in zip(ip_addresses, domains)),
+                            dtype=np.uint8, count=len(domains))
+
+        unfiltered = np.flatnonzero(codes == self.__VALID_CODE)
+        if len(unfiltered):
+            domain_array = np.asarray(domains, dtype=np.str_)[unfiltered]
+            top_level_domains = np.char.rpartition(domain_array, '.')[:, 2]
+            has_valid_tld = np.isin(top_level_domains, self.__tld_array)
+            codes[unfiltered[~has_valid_tld]] = self.__BAD_TLD_CODE
+
+        return codes
+
+    def __filter_code(self, ip_address: str, domain: str) -> int:
+        """Returns the code for all checks except the top level domain check"""
+        if not ACCEPTED_CHARACTER.issuperset(domain):
+            return self.__INVALID_CHARACTERS_CODE
+        if self.white_list is not None and ip_address not in self.white_list:
+            return self.__BLACKLISTED_CODE
+        if self.ip_encoding_filter and self.is_ip_encoded(ip_address, domain):
+            return self.__IP_ENCODED_CODE
+
+        return self.__VALID_CODE
+
+    def is_ip_encoded(self, ip_address: str, domain: str) -> bool:
+        """Checks if any encoding of the IP address is contained in the domain"""
+        if self.is_ipv6:
+            ip_bytes = socket.inet_pton(socket.AF_INET6, ip_address)
+            ip_hex = ip_bytes.hex()
+            ip_groups = [ip_hex[index:index + 4] for index in range(0, 32, 4)]
+            return self.__int_to_base36(int(ip_hex, 16)) in domain or \
+                '.'.join(ip_groups) in domain or \
+                '.'.join(ip_groups[::-1]) in domain
+
+        ip_bytes = socket.inet_pton(socket.AF_INET, ip_address)
+        if ip_bytes.hex() in domain.lower() or \
+                self.__int_to_base36(int.from_bytes(ip_bytes, 'big')) in domain:
+            return True
+
+        octets_match = self.__IPV4_REGEX.match(ip_address)
+        if not octets_match:
+            return False
+
+        octets = octets_match.groups()
+        if self.regex_strategy == RegexStrategy.strict:
+            return self.__has_separated_octets(domain, octets)
+
+        min_gap = 1 if self.regex_strategy == RegexStrategy.moderate else 0
+        return self.__has_octets_in_order(domain, octets, min_gap) or \
+            self.__has_octets_in_order(domain, octets[::-1], min_gap)
+
+    @staticmethod
+    def __has_octets_in_order(domain: str, octets: (str, str, str, str), min_gap: int) -> bool:
+        """Checks if the octets occur in this order with at least min_gap characters in between"""
+        position = 0
+        for octet in octets:
+            index = domain.find(octet, position)
+            if index < 0:
+                return False
+            position = index + len(octet) + min_gap
+
+        return True
+
+    @staticmethod
+    def __int_to_base36(num: int) -> str:
+        """Returns the base36 representation with lower case letters"""
+        if num < 36:
+            return DomainClassifier.__BASE36_DIGITS[num]
+
+        digit_pairs = []
+        while num >= 36:
+            num, rest = divmod(num, 1296)
+            digit_pairs.append(DomainClassifier.__BASE36_DIGIT_PAIRS[rest])
+
+        if num:
+            digit_pairs.append(DomainClassifier.__BASE36_DIGITS[num])
+
+        return ''.join(reversed(digit_pairs)).lstrip('0')
+
+    def __has_separated_octets(self, domain: str, octets: (str, str, str, str)) -> bool:
+        """
+        Checks for the octets (or in reverse order) separated by exactly one of '.', '-' and '_'
+        The inner octets can have up to 2 leading zeros
+        """
+        padded_octets = [(octet, '0' + octet, '00' + octet) for octet in octets]
+        for octet_order in [padded_octets, padded_octets[::-1]]:
+            first_octet = octet_order[0][0]
+            for match in self.__STRICT_OCTETS_REGEX.finditer(domain):
+                first, second, third, fourth = match.groups()
+                if first == first_octet and second in octet_order[1] and \
+                        third in octet_order[2] and fourth.startswith(octet_order[3]):
+                    return True
+
+        return False
+
+
+def domain_type_indexes(codes: np.ndarray) -> typing.Dict[DomainType, np.ndarray]:
+    """
+    Groups the result of DomainClassifier.classify_columns
+    :return: the indexes of the domains for every domain type occurring in codes
+    """
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    bounds = np.flatnonzero(np.diff(sorted_codes)) + 1
+    return {DOMAIN_TYPE_CODES[code_indexes[0]]: indexes
+            for code_indexes, indexes in zip(np.split(sorted_codes, bounds),
+                                             np.split(order, bounds))
+            if len(indexes)}
 
 
 def preprocess_domains(ip_domain_tuples: [(str, str)], tlds: {str}, white_list: {str} = None,
                        ip_version: str = 'ipv4',
                        regex_strategy: RegexStrategy = RegexStrategy.abstract,
-                       ip_encoding_filter: bool = True):
+                       ip_encoding_filter: bool = True,
+                       domain_classifier: typing.Optional[DomainClassifier] = None):
     """
     Sanitize filepart from start to end
     pnr is a number to recognize the process
     ipregex should be a regex with 4 integers to filter the Isp client domain names
+    :param domain_classifier: a prebuilt classifier, if set the other classification arguments
+                              are ignored
     """
 
     bad_characters = collections.defaultdict(int)
@@ -134,32 +324,22 @@ def preprocess_domains(ip_domain_tuples: [(str, str)], tlds: {str}, white_list:
     ip_encoded_lines = []
     custom_filter_lines = []
 
-    ipregex_text = __select_ip_regex(regex_strategy)
-    ipregex = re.compile(ipregex_text, flags=re.MULTILINE)
-    is_ipv6 = ip_version == 'ipv6'
+    if domain_classifier is None:
+        domain_classifier = DomainClassifier(tlds, white_list=white_list, ip_version=ip_version,
+                                             regex_strategy=regex_strategy,
+                                             ip_encoding_filter=ip_encoding_filter)
 
-    for ip_address, domain in ip_domain_tuples:
+    lines_for_type = {
+        DomainType.valid: good_lines,
+        DomainType.invalid_characters: bad_lines,
+        DomainType.bad_tld: bad_dns_lines,
+        DomainType.ip_encoded: ip_encoded_lines,
+        DomainType.blacklisted: custom_filter_lines,
+    }
 
-        if set(domain).difference(ACCEPTED_CHARACTER):
-            bad_lines.append((ip_address, domain))
-        else:
-            if white_list is not None and ip_address not in white_list:
-                custom_filter_lines.append((ip_address, domain))
-            elif not is_ipv6 and ip_encoding_filter and __has_ip_encoded(ip_address, domain,
-                                                                         ipregex):
-                ip_encoded_lines.append((ip_address, domain))
-            elif not is_ipv6 and ip_encoding_filter and \
-                    is_ip_hex_encoded(ip_address, domain):
-                ip_encoded_lines.append((ip_address, domain))
-            elif ip_encoding_filter and has_ip_alphanumeric_encoded(ip_address, domain, ip_version):
-                ip_encoded_lines.append((ip_address, domain))
-            elif is_ipv6 and ip_encoding_filter and is_ipv6_address_encoded(ip_address, domain):
-                ip_encoded_lines.append((ip_address, domain))
-            else:
-                if domain.split('.')[-1] in tlds:
-                    good_lines.append((ip_address, domain))
-                else:
-                    bad_dns_lines.append((ip_address, domain))
+    for ip_address, domain in ip_domain_tuples:
+        lines_for_type[domain_classifier.classify(ip_address, domain)].append(
+            (ip_address, domain))
 
     return good_lines, bad_lines, bad_dns_lines, ip_encoded_lines, custom_filter_lines, \
            bad_characters
@@ -193,8 +373,9 @@ def is_ipv4_address_encoded(ip, domain, regex_strategy: RegexStrategy = RegexStr
 
 
 def is_ipv6_address_encoded(ipv6_address, domain):
-    ip_address_exploded = ipaddress.ip_address('ffff::1').exploded.split(':')
-    return '.'.join(ip_address_exploded) in domain or '.'.join(ip_address_exploded[::-1])
+    ip_address_exploded = ipaddress.ip_address(ipv6_address).exploded.split(':')
+    return '.'.join(ip_address_exploded) in domain or \
+        '.'.join(ip_address_exploded[::-1]) in domain
 
 
 def __ip_to_int(ip_addr, ip_version):
@@ -241,9 +422,12 @@ def __select_ip_regex(regex_strategy: RegexStrategy):
 if __name__ == '__main__':
     main()
 
-__all__ = ['has_ip_encoded',
+__all__ = ['is_ipv4_address_encoded',
            'is_ip_hex_encoded',
            'has_ip_alphanumeric_encoded',
            'preprocess_domains',
+           'DomainClassifier',
+           'DOMAIN_TYPE_CODES',
+           'domain_type_indexes',
            'RegexStrategy',
            ]
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Matcher backends to find the location codes of the trie in domain labels
+
+All backends report the codes grouped by their start position in the label (ascending) and
+for every start position ordered by their length (longest first).
+"""
+
+import abc
+import collections
+import enum
+import typing
+
+import marisa_trie
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+@enum.unique
+class MatcherBackend(enum.Enum):
+    marisa = 'marisa'
+    aho_corasick = 'aho-corasick'
+
+    @staticmethod
+    def all_values() -> [str]:
+        return [
+            MatcherBackend.marisa.value,
+            MatcherBackend.aho_corasick.value,
+        ]
+
+
+class LabelMatcher(metaclass=abc.ABCMeta):
+    """The base class for the matcher backends"""
+
+    def __init__(self, trie: marisa_trie.RecordTrie):
+        self.trie = trie
+
+    @abc.abstractmethod
+    def matches_by_start(self, label: str) \
+            -> typing.Iterator[typing.Tuple[int, typing.List[str]]]:
+        """
+        Finds all codes occurring in the label
+        :return: tuples of the start position and all codes starting there (longest first)
+        """
+        pass
+
+    def records(self, code: str) -> typing.List[typing.Tuple[bytes, int]]:
+        """:return: the (location id, code type) records of the code"""
+        return self.trie[code]
+
+
+class MarisaLabelMatcher(LabelMatcher):
+    """Searches the prefixes in the trie for every suffix of the label"""
+
+    def matches_by_start(self, label: str) \
+            -> typing.Iterator[typing.Tuple[int, typing.List[str]]]:
+        for start in range(len(label)):
+            matching_keys = self.trie.prefixes(label[start:])
+            if matching_keys:
+                matching_keys.sort(key=len, reverse=True)
+                yield start, matching_keys
+
+
+class AhoCorasickLabelMatcher(LabelMatcher):
+    """
+    Uses an Aho-Corasick automaton over all codes of the trie which reports all occurrences
+    in one pass over the label
+    Needs the pyahocorasick package
+    """
+
+    def __init__(self, trie: marisa_trie.RecordTrie):
+        if ahocorasick is None:
+            raise ImportError('the aho-corasick matcher backend needs the pyahocorasick package')
+
+        super().__init__(trie)
+        self.automaton = ahocorasick.Automaton()
+        for code in trie.iterkeys():
+            self.automaton.add_word(code, len(code))
+        self.automaton.make_automaton()
+
+    def matches_by_start(self, label: str) \
+            -> typing.Iterator[typing.Tuple[int, typing.List[str]]]:
+        if not label:
+            return
+
+        matches = collections.defaultdict(list)
+        for end, code_length in self.automaton.iter(label):
+            start = end - code_length + 1
+            matches[start].append(label[start:end + 1])
+
+        for start in sorted(matches.keys()):
+            yield start, sorted(matches[start], key=len, reverse=True)
+
+
+def create_label_matcher(backend: MatcherBackend, trie: marisa_trie.RecordTrie) -> LabelMatcher:
+    """Creates the matcher for the backend over the codes of the trie"""
+    if backend == MatcherBackend.marisa:
+        return MarisaLabelMatcher(trie)
+    elif backend == MatcherBackend.aho_corasick:
+        return AhoCorasickLabelMatcher(trie)
+
+    raise ValueError('unknown matcher backend {}'.format(backend))
+
+
+__all__ = ['MatcherBackend',
+           'LabelMatcher',
+           'MarisaLabelMatcher',
+           'AhoCorasickLabelMatcher',
+           'create_label_matcher',
+           ]
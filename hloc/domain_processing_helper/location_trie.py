@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Creation and caching of the location code trie used to search for location hints
+
+The trie is saved to disk together with a hash over its inputs (the location codes in the
+database and the blacklist files). Tools load the saved trie with mmap so all processes share
+the same memory pages and it is only rebuilt if one of the inputs changed.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import typing
+
+import marisa_trie
+import sqlalchemy as sqla
+
+from hloc.models import Location, LocationInfo
+
+TRIE_RECORD_FORMAT = '<32sh'
+# increase if the structure of the trie changes to invalidate all saved tries
+TRIE_ARTIFACT_VERSION = 1
+FIND_STATE_FILENAME = 'find-state.json'
+
+logger = logging.getLogger(__name__)
+
+__LOCATIONS_HASH_QUERY = sqla.text(
+    "SELECT md5(coalesce(string_agg(concat_ws('|', locations.id, locations.city_name, "
+    "locations.clli::text, locations.alternate_names::text, states.iso3166code, "
+    "airport_infos.iata_codes::text, airport_infos.icao_codes::text, "
+    "airport_infos.faa_codes::text, locode_infos.place_codes::text), "
+    "E'\\n' ORDER BY locations.id), '')) "
+    "FROM locations "
+    "LEFT OUTER JOIN states ON locations.state_id = states.id "
+    "LEFT OUTER JOIN airport_infos ON locations.airport_info_id = airport_infos.id "
+    "LEFT OUTER JOIN locode_infos ON locations.locode_info_id = locode_infos.id "
+    "WHERE locations.location_type = 'location_infos'")
+
+
+def read_blacklist(blacklist_filepath: typing.Optional[str]) -> typing.Set[str]:
+    """
+    Reads all entries of a blacklist file, lines starting with # are ignored
+    :param blacklist_filepath: the path to the blacklist file or None
+    :return: a set with all entries
+    """
+    blacklist = set()
+    if blacklist_filepath:
+        with open(blacklist_filepath) as blacklist_file:
+            for line in blacklist_file:
+                line = line.strip()
+                if line and line[0] != '#':
+                    blacklist.add(line)
+
+    return blacklist
+
+
+def create_trie_obj(location_list: [Location], code_blacklist: {str}, word_blacklist: {str}):
+    """
+    Creates a RecordTrie with the marisa library
+    :param location_list: a list with all locations
+    :param code_blacklist: a list with all codes to blacklist
+    :param word_blacklist: a list with all words which should be blacklisted
+    :rtype: marisa_trie.RecordTrie
+    """
+    code_id_type_tuples = []
+    for location in location_list:
+        code_id_type_tuples.extend(location.code_id_type_tuples())
+
+    code_id_type_tuples = [code_tuple for code_tuple in code_id_type_tuples
+                           if code_tuple[0] not in code_blacklist and
+                           code_tuple[0] not in word_blacklist and
+                           len(code_tuple[0]) > 2]
+
+    for code in word_blacklist:
+        code_id_type_tuples.append((code, ('0'*32, -1)))
+
+    encoded_tuples = [(code, (uid.encode(), code_type))
+                      for code, (uid, code_type) in code_id_type_tuples]
+
+    return marisa_trie.RecordTrie(TRIE_RECORD_FORMAT, encoded_tuples)
+
+
+def locations_content_hash(db_session) -> str:
+    """
+    Computes a hash over all location codes stored in the database
+    The hash is computed by the database so no location has to be loaded
+    """
+    return db_session.execute(__LOCATIONS_HASH_QUERY).scalar()
+
+
+def __file_content_hash(filepath: typing.Optional[str]) -> str:
+    if not filepath:
+        return 'None'
+
+    file_hash = hashlib.sha256()
+    with open(filepath, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(2**16), b''):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+def trie_inputs_hash(db_session, code_blacklist_filepath: typing.Optional[str],
+                     word_blacklist_filepath: typing.Optional[str]) -> str:
+    """
+    Computes the hash over all inputs of the trie
+    :return: a hex string which changes if any input of the trie changes
+    """
+    inputs_hash = hashlib.sha256()
+    inputs_hash.update('v{}'.format(TRIE_ARTIFACT_VERSION).encode())
+    inputs_hash.update(locations_content_hash(db_session).encode())
+    inputs_hash.update(__file_content_hash(code_blacklist_filepath).encode())
+    inputs_hash.update(__file_content_hash(word_blacklist_filepath).encode())
+    return inputs_hash.hexdigest()
+
+
+def trie_artifact_path(cache_dir: str, inputs_hash: str) -> str:
+    """Returns the path of the saved trie for the inputs hash"""
+    return os.path.join(cache_dir, 'location-trie-v{}-{}.marisa'.format(TRIE_ARTIFACT_VERSION,
+                                                                        inputs_hash))
+
+
+def load_trie(trie_path: str) -> marisa_trie.RecordTrie:
+    """
+    Memory maps a saved trie
+    All processes mapping the same file share its memory pages
+    """
+    return marisa_trie.RecordTrie(TRIE_RECORD_FORMAT).mmap(trie_path)
+
+
+def save_trie(trie: marisa_trie.RecordTrie, trie_path: str):
+    """Saves the trie atomically so concurrent readers never see a partial file"""
+    trie_dir = os.path.dirname(trie_path)
+    os.makedirs(trie_dir, exist_ok=True)
+
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=trie_dir, suffix='.tmp')
+    os.close(file_descriptor)
+    try:
+        trie.save(tmp_path)
+        os.replace(tmp_path, trie_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def get_trie_artifact(db_session, cache_dir: str,
+                      code_blacklist_filepath: typing.Optional[str],
+                      word_blacklist_filepath: typing.Optional[str],
+                      force_rebuild: bool=False) -> str:
+    """
+    Returns the path to the saved trie for the current inputs and builds it if necessary
+    :param db_session: a data base session on which the queries are executed
+    :param cache_dir: the directory where the tries are saved
+    :param code_blacklist_filepath: the path to the code blacklist file
+    :param word_blacklist_filepath: the path to the word blacklist file
+    :param force_rebuild: rebuild the trie even if a saved one exists
+    :return: the path to the saved trie
+    """
+    inputs_hash = trie_inputs_hash(db_session, code_blacklist_filepath, word_blacklist_filepath)
+    trie_path = trie_artifact_path(cache_dir, inputs_hash)
+
+    if os.path.isfile(trie_path) and not force_rebuild:
+        logger.info('using saved trie %s', trie_path)
+        return trie_path
+
+    logger.info('building trie %s', trie_path)
+    trie = create_trie_obj(db_session.query(LocationInfo),
+                           read_blacklist(code_blacklist_filepath),
+                           read_blacklist(word_blacklist_filepath))
+    save_trie(trie, trie_path)
+
+    return trie_path
+
+
+def changed_codes(old_trie: marisa_trie.RecordTrie, new_trie: marisa_trie.RecordTrie) \
+        -> typing.Set[str]:
+    """
+    Compares the codes of two tries
+    :return: all codes which were added, removed or whose records changed
+    """
+    def code_records(trie):
+        records = {}
+        for code, record in trie.iteritems():
+            records.setdefault(code, set()).add(record)
+        return records
+
+    old_code_records = code_records(old_trie)
+    new_code_records = code_records(new_trie)
+
+    codes = set(old_code_records.keys()).symmetric_difference(new_code_records.keys())
+    for code, records in new_code_records.items():
+        if code in old_code_records and old_code_records[code] != records:
+            codes.add(code)
+
+    return codes
+
+
+def read_find_state(cache_dir: str) -> typing.Optional[typing.Dict[str, str]]:
+    """
+    Returns the state saved by the last completed find run
+    :return: a dict with the trie_path and the finished time or None if there is no state
+    """
+    state_path = os.path.join(cache_dir, FIND_STATE_FILENAME)
+    if not os.path.isfile(state_path):
+        return None
+
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def write_find_state(cache_dir: str, trie_path: str):
+    """Saves the trie used by a completed find run"""
+    os.makedirs(cache_dir, exist_ok=True)
+    state = {'trie_path': trie_path, 'finished': datetime.datetime.now().isoformat()}
+
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(file_descriptor, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, os.path.join(cache_dir, FIND_STATE_FILENAME))
+
+
+__all__ = ['TRIE_RECORD_FORMAT',
+           'read_blacklist',
+           'create_trie_obj',
+           'locations_content_hash',
+           'trie_inputs_hash',
+           'trie_artifact_path',
+           'load_trie',
+           'save_trie',
+           'get_trie_artifact',
+           'changed_codes',
+           'read_find_state',
+           'write_find_state',
+           ]
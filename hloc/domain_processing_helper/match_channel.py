@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+The message protocol between the find search processes and the location match handler
+
+The search processes send batches instead of one message per label. A batch holds the ids of
+the labels whose old hints must be deleted and the found hints as fixed width records
+(location id, code type, label id) with the codes as newline separated string.
+Deletions in a batch always refer to labels searched before the hints in the same batch.
+"""
+
+import array
+import collections
+import multiprocessing as mp
+import struct
+import time
+import typing
+
+HINT_RECORD_STRUCT = struct.Struct('<32shq')
+DEFAULT_BATCH_SIZE = 10 ** 4
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+LocationMatchBatch = collections.namedtuple('LocationMatchBatch',
+                                            ['deleted_label_ids', 'hint_records', 'hint_codes'])
+
+
+class LocationMatchBatcher(object):
+    """Collects the results of a search process and sends them in batches"""
+
+    def __init__(self, location_match_queue: mp.Queue, batch_size: int=DEFAULT_BATCH_SIZE,
+                 flush_interval: float=DEFAULT_FLUSH_INTERVAL):
+        """
+        :param location_match_queue: the queue the batches are sent to
+        :param batch_size: the number of hints and deletions after which a batch is sent
+        :param flush_interval: the maximum time in seconds a result waits before it is sent
+        """
+        self._queue = location_match_queue
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._deleted_label_ids = array.array('q')
+        self._hint_records = bytearray()
+        self._hint_codes = []
+        self._last_flush = time.monotonic()
+
+    def __len__(self):
+        return len(self._deleted_label_ids) + len(self._hint_codes)
+
+    def delete_label_hints(self, label_id: int):
+        """Requests the deletion of all saved hints of the label"""
+        self._deleted_label_ids.append(label_id)
+        self._check_flush()
+
+    def add_hints(self, location_hint_tuples: [(str, str, int, int)]):
+        """Adds (location_id, code, code_type, label_id) tuples"""
+        for location_id, code, code_type, label_id in location_hint_tuples:
+            self._hint_records += HINT_RECORD_STRUCT.pack(location_id.encode(), code_type,
+                                                          label_id)
+            self._hint_codes.append(code)
+        self._check_flush()
+
+    def _check_flush(self):
+        if len(self) >= self._batch_size or \
+                time.monotonic() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Sends all collected results"""
+        self._last_flush = time.monotonic()
+        if not len(self):
+            return
+
+        self._queue.put(LocationMatchBatch(self._deleted_label_ids.tobytes(),
+                                           bytes(self._hint_records),
+                                           '\n'.join(self._hint_codes)))
+        self._deleted_label_ids = array.array('q')
+        self._hint_records = bytearray()
+        self._hint_codes = []
+
+
+def decode_deleted_label_ids(batch: LocationMatchBatch) -> typing.List[int]:
+    """Returns the ids of the labels whose hints must be deleted"""
+    label_ids = array.array('q')
+    label_ids.frombytes(batch.deleted_label_ids)
+    return label_ids.tolist()
+
+
+def decode_hints(batch: LocationMatchBatch) \
+        -> typing.Iterator[typing.Tuple[str, str, int, int]]:
+    """Returns the (location_id, code, code_type, label_id) tuples of the batch"""
+    if not batch.hint_records:
+        return
+
+    for (location_id, code_type, label_id), code in zip(
+            HINT_RECORD_STRUCT.iter_unpack(batch.hint_records), batch.hint_codes.split('\n')):
+        yield location_id.decode(), code, code_type, label_id
+
+
+__all__ = ['LocationMatchBatch',
+           'LocationMatchBatcher',
+           'decode_deleted_label_ids',
+           'decode_hints',
+           ]
@@ -0,0 +1,10 @@
+
+from .haversine import coordinate_arrays, haversine_distances, haversine_distance_matrix
+from .spatial_index import SpatialIndex
+
+
+__all__ = ['coordinate_arrays',
+           'haversine_distances',
+           'haversine_distance_matrix',
+           'SpatialIndex',
+           ]
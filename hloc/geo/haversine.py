@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Vectorized great circle distance computations on numpy arrays
+"""
+
+import typing
+
+import numpy as np
+
+from hloc import constants
+
+
+def coordinate_arrays(locations: typing.Iterable[typing.Any]) \
+        -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Collects the coordinates of all locations into two arrays
+    :param locations: objects with a lat and a lon attribute (e.g. Location)
+    :return: a tuple with the latitudes and the longitudes in decimal degrees
+             missing coordinates are represented as NaN
+    """
+    coordinates = [(location.lat, location.lon) for location in locations]
+    if not coordinates:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+
+    coordinates_arr = np.array(coordinates, dtype=np.float64)
+    return coordinates_arr[:, 0], coordinates_arr[:, 1]
+
+
+def haversine_distances(lat, lon, lats, lons) -> np.ndarray:
+    """
+    Calculate the distances (km) between the point(s) (lat, lon) and all points in (lats, lons)
+    All arguments are in decimal degrees and are broadcasted against each other
+    :return: an array with the distances in km
+    """
+    lat1 = np.radians(lat)
+    lon1 = np.radians(lon)
+    lat2 = np.radians(lats)
+    lon2 = np.radians(lons)
+
+    tmp = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    # rounding errors can lead to values slightly above 1 for antipodal points
+    return 2 * np.arcsin(np.sqrt(np.minimum(tmp, 1))) * constants.EARTH_RADIUS
+
+
+def haversine_distance_matrix(lats1, lons1, lats2, lons2) -> np.ndarray:
+    """
+    Calculate the distances (km) between all points of the first and the second coordinates
+    :return: an array with the shape (len(lats1), len(lats2))
+    """
+    lats1 = np.asarray(lats1, dtype=np.float64)
+    lons1 = np.asarray(lons1, dtype=np.float64)
+    return haversine_distances(lats1[:, np.newaxis], lons1[:, np.newaxis],
+                               np.asarray(lats2, dtype=np.float64)[np.newaxis, :],
+                               np.asarray(lons2, dtype=np.float64)[np.newaxis, :])
+
+
+__all__ = ['coordinate_arrays',
+           'haversine_distances',
+           'haversine_distance_matrix',
+           ]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+A spatial index for radius and nearest neighbour queries on the sphere
+"""
+
+import math
+import typing
+
+import numpy as np
+
+from hloc import constants
+from .haversine import coordinate_arrays, haversine_distances
+
+
+class SpatialIndex(object):
+    """
+    Indexes points on the earth's surface in latitude bands
+    Each band holds its points sorted by longitude. A query therefore only computes distances
+    for the points in the longitude range of the bands which intersect the query circle.
+    """
+
+    __slots__ = ['lats', 'lons', 'items', '_band_height', '_sorted_indexes', '_sorted_lons',
+                 '_band_starts']
+
+    def __init__(self, lats, lons, items: typing.Optional[typing.Sequence[typing.Any]]=None,
+                 band_height: float=1.0):
+        """
+        :param lats: the latitudes of the points in decimal degrees
+        :param lons: the longitudes of the points in decimal degrees
+        :param items: optional objects belonging to the points (same order as the coordinates)
+        :param band_height: the height of a latitude band in degrees
+        """
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = (np.asarray(lons, dtype=np.float64) + 180) % 360 - 180
+        self.items = items
+        self._band_height = band_height
+
+        if self.lats.shape != self.lons.shape:
+            raise ValueError('lats and lons must have the same length')
+        if items is not None and len(items) != len(self.lats):
+            raise ValueError('items must have the same length as the coordinates')
+
+        valid_indexes = np.flatnonzero(~(np.isnan(self.lats) | np.isnan(self.lons)))
+        band_ids = self._band_id(self.lats[valid_indexes])
+        order = np.lexsort((self.lons[valid_indexes], band_ids))
+
+        self._sorted_indexes = valid_indexes[order]
+        self._sorted_lons = self.lons[self._sorted_indexes]
+        self._band_starts = np.searchsorted(band_ids[order], np.arange(self._band_count + 1))
+
+    @classmethod
+    def from_objects(cls, objects: typing.Iterable[typing.Any],
+                     location: typing.Optional[typing.Callable[[typing.Any], typing.Any]]=None,
+                     band_height: float=1.0) -> 'SpatialIndex':
+        """
+        Creates an index over the objects
+        :param objects: the objects to index, they are stored as items of the index
+        :param location: returns the object with lat and lon attributes for an object
+                         if not set the objects themselves need the lat and lon attributes
+        :param band_height: the height of a latitude band in degrees
+        """
+        objects = list(objects)
+        if location is None:
+            lats, lons = coordinate_arrays(objects)
+        else:
+            lats, lons = coordinate_arrays(location(obj) for obj in objects)
+
+        return cls(lats, lons, items=objects, band_height=band_height)
+
+    def __len__(self):
+        return len(self.lats)
+
+    @property
+    def _band_count(self) -> int:
+        return int(math.ceil(180 / self._band_height))
+
+    def _band_id(self, lats):
+        return np.clip(np.floor((lats + 90) / self._band_height).astype(np.int64),
+                       0, self._band_count - 1)
+
+    def _candidates(self, lat: float, lon: float, radius: float) -> np.ndarray:
+        """Returns the indexes of all points which could be within the radius [km]"""
+        angular_radius = radius / constants.EARTH_RADIUS
+        if angular_radius >= math.pi:
+            return self._sorted_indexes
+
+        lat_min = lat - math.degrees(angular_radius)
+        lat_max = lat + math.degrees(angular_radius)
+
+        lon_intervals = [(-180.0, 180.0)]
+        if lat_min > -90 and lat_max < 90:
+            # the circle does not contain a pole so its longitude extent is limited
+            ratio = math.sin(angular_radius) / math.cos(math.radians(lat))
+            if ratio < 1:
+                lon_delta = math.degrees(math.asin(ratio))
+                lon = (lon + 180) % 360 - 180
+                lon_min = lon - lon_delta
+                lon_max = lon + lon_delta
+                if lon_min < -180:
+                    lon_intervals = [(lon_min + 360, 180.0), (-180.0, lon_max)]
+                elif lon_max > 180:
+                    lon_intervals = [(lon_min, 180.0), (-180.0, lon_max - 360)]
+                else:
+                    lon_intervals = [(lon_min, lon_max)]
+
+        first_band, last_band = self._band_id(np.array([max(lat_min, -90), min(lat_max, 90)]))
+
+        candidate_slices = []
+        for band in range(first_band, last_band + 1):
+            band_start = self._band_starts[band]
+            band_end = self._band_starts[band + 1]
+            if band_start == band_end:
+                continue
+
+            band_lons = self._sorted_lons[band_start:band_end]
+            for interval_start, interval_end in lon_intervals:
+                start = band_start + np.searchsorted(band_lons, interval_start, side='left')
+                end = band_start + np.searchsorted(band_lons, interval_end, side='right')
+                if start < end:
+                    candidate_slices.append(self._sorted_indexes[start:end])
+
+        if not candidate_slices:
+            return np.empty(0, dtype=np.int64)
+
+        return np.concatenate(candidate_slices)
+
+    def query_radius(self, lat: float, lon: float, radius: float, sort: bool=True) \
+            -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches all points within the radius [km] around the coordinates
+        :param sort: if set the result is sorted by the distance (ties by the index)
+        :return: a tuple with the indexes of the points and their distances
+        """
+        candidates = self._candidates(lat, lon, radius)
+        distances = haversine_distances(lat, lon, self.lats[candidates], self.lons[candidates])
+
+        in_radius = distances <= radius
+        indexes = candidates[in_radius]
+        distances = distances[in_radius]
+
+        if sort:
+            order = np.lexsort((indexes, distances))
+            indexes = indexes[order]
+            distances = distances[order]
+
+        return indexes, distances
+
+    def query_nearest(self, lat: float, lon: float, k: int,
+                      max_radius: typing.Optional[float]=None,
+                      initial_radius: float=100) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches the k nearest points to the coordinates
+        The search radius starts at initial_radius and is doubled until k points are found
+        :param max_radius: only return points within this radius [km]
+        :return: a tuple with the indexes of the points and their distances sorted by distance
+        """
+        max_search_radius = math.pi * constants.EARTH_RADIUS
+        if max_radius is not None:
+            max_search_radius = min(max_radius, max_search_radius)
+
+        radius = min(initial_radius, max_search_radius)
+        while True:
+            indexes, distances = self.query_radius(lat, lon, radius)
+            if len(indexes) >= k or radius >= max_search_radius:
+                return indexes[:k], distances[:k]
+
+            radius = min(radius * 2, max_search_radius)
+
+    def items_for(self, indexes: typing.Iterable[int]) -> typing.List[typing.Any]:
+        """Returns the items for the indexes returned by a query"""
+        if self.items is None:
+            raise ValueError('the index has no items')
+
+        return [self.items[index] for index in indexes]
+
+
+__all__ = ['SpatialIndex',
+           ]
@@ -5,7 +5,7 @@ from .enums import LocationCodeType, AvailableType, MeasurementError, DomainLoca
     DomainType, MeasurementProtocol
 from .location import Location, LocationInfo, AirportInfo, LocodeInfo, State, LocationHint
 from .measurement_result import MeasurementResult, RipeMeasurementResult, \
-    CaidaArkMeasurementResult, ZmapMeasurementResult
+    CaidaArkMeasurementResult, ZmapMeasurementResult, MinRttMeasurement
 from .probe import Probe, RipeAtlasProbe, CaidaArkProbe, ZmapProbe
 from .json_base import JSONBase
 from .domain import Domain, DomainLabel, CodeMatch
@@ -37,4 +37,5 @@ __all__ = ['MeasurementResult',
            'CaidaArkMeasurementResult',
            'ZmapProbe',
            'ZmapMeasurementResult',
+           'MinRttMeasurement',
            ]
@@ -48,6 +48,14 @@ class DomainLabel(Base):
     name = sqla.Column(sqla.String(100), unique=True, index=True, nullable=False)
     last_searched = sqla.Column(sqla.DateTime)
 
+    # the trigram index is the reverse index from location codes to the labels containing them
+    # (needs the pg_trgm extension) and the partial index holds all never searched labels
+    __table_args__ = (
+        sqla.Index('domain_labels_name_trgm_idx', 'name', postgresql_using='gin',
+                   postgresql_ops={'name': 'gin_trgm_ops'}),
+        sqla.Index('domain_labels_not_searched_idx', 'id',
+                   postgresql_where=last_searched.is_(None)),
+    )
 
     domains = sqlorm.relationship("Domain",
                                   secondary=domain_to_label_table,
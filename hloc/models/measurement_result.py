@@ -15,14 +15,23 @@ from hloc.models.sql_alchemy_base import Base
 from .enums import MeasurementError, MeasurementProtocol
 
 
+MEASUREMENT_RESULTS_DEFAULT_PARTITION = 'measurement_results_default'
+
+
 class MeasurementResult(Base):
-    """the abstract base class for a measurement result"""
+    """
+    the abstract base class for a measurement result
+    The table is range partitioned by the timestamp. Rows outside of all created partitions
+    are saved in the default partition.
+    """
 
     __tablename__ = 'measurement_results'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (timestamp)'}
 
-    id = sqla.Column(sqla.BigInteger, primary_key=True)
+    id = sqla.Column(sqla.BigInteger, primary_key=True, autoincrement=True)
     probe_id = sqla.Column(sqla.Integer, sqla.ForeignKey('probes.id'), nullable=False)
-    timestamp = sqla.Column(sqla.DateTime, nullable=False)
+    # the partition key must be part of the primary key
+    timestamp = sqla.Column(sqla.DateTime, primary_key=True)
     destination_address = sqla.Column(postgresql.INET, nullable=False, index=True)
     source_address = sqla.Column(postgresql.INET)
     error_msg = sqla.Column(postgresql.ENUM(MeasurementError))
@@ -52,6 +61,11 @@ class MeasurementResult(Base):
         return self.rtt
 
 
+sqla.event.listen(MeasurementResult.__table__, 'after_create', sqla.DDL(
+    'CREATE TABLE {} PARTITION OF measurement_results DEFAULT'.format(
+        MEASUREMENT_RESULTS_DEFAULT_PARTITION)))
+
+
 class RipeMeasurementResult(MeasurementResult):
     __mapper_args__ = {
         'polymorphic_identity': 'ripe_measurement'
@@ -152,8 +166,33 @@ class ZmapMeasurementResult(MeasurementResult):
                                                        )
             return measurement_result
 
+
+class MinRttMeasurement(Base):
+    """
+    The minimal rtt measured by a probe to a destination for every type of measurement
+    Maintained by the importers with upserts so reads do not depend on the measurement history
+    """
+
+    __tablename__ = 'min_rtt_measurements'
+
+    destination_address = sqla.Column(postgresql.INET, primary_key=True)
+    probe_id = sqla.Column(sqla.Integer, sqla.ForeignKey('probes.id'), primary_key=True)
+    ip_version = sqla.Column(sqla.String(4), primary_key=True)
+    measurement_result_type = sqla.Column(sqla.String, primary_key=True)
+    rtt = sqla.Column(sqla.Float, nullable=False)
+    timestamp = sqla.Column(sqla.DateTime, nullable=False)
+    measurement_result_id = sqla.Column(sqla.BigInteger)
+
+    probe = sqlorm.relationship('Probe')
+
+    @property
+    def min_rtt(self):
+        return self.rtt
+
+
 __all__ = [
     'MeasurementResult',
+    'MinRttMeasurement',
     'RipeMeasurementResult',
     'CaidaArkMeasurementResult',
     'ZmapMeasurementResult'
@@ -20,10 +20,20 @@ import sqlalchemy.orm as sqlorm
 import hloc.ripe_helper.basics_helper as ripe_helper
 from hloc import util, constants
 from hloc.constants import IPV6_IDENTIFIER, IPV4_IDENTIFIER
-from hloc.exceptions import ProbeError, MeasurementError, ServerError
+from hloc.exceptions import ProbeError
 from hloc.models import Location, RipeMeasurementResult, AvailableType, Base
+from hloc.ripe_helper.probe_status import ProbeStatusService, ProbeFlag, PROBE_STATUS_MAX_AGE
 from .location import probe_location_info_table
 
+# the availability flags deciding the availability type of a RIPE Atlas probe
+AVAILABILITY_MASK = int(ProbeFlag.connected | ProbeFlag.ipv4_works | ProbeFlag.ipv6_works)
+# the masked availability flags of every available type
+AVAILABILITY_FLAGS = {
+    AvailableType.ipv4_available: int(ProbeFlag.connected | ProbeFlag.ipv4_works),
+    AvailableType.ipv6_available: int(ProbeFlag.connected | ProbeFlag.ipv6_works),
+    AvailableType.both_available: AVAILABILITY_MASK,
+}
+
 
 class Probe(Base):
     """
@@ -99,8 +109,12 @@ class RipeAtlasProbe(Probe):
 
     required_keys = ['measurement_name', 'ip_version', 'api_key', 'ripe_slowdown_sema']
 
+    # the snapshot all probes take their status from
+    status_service = ProbeStatusService()
+
     _last_update = None
     _probe_obj = None
+    _availability_flags = 0
 
     class MeasurementKeys(enum.Enum):
         measurement_name = 'measurement_name'
@@ -109,23 +123,33 @@ class RipeAtlasProbe(Probe):
         api_key = 'api_key'
         bill_to_address = 'bill_to_address'
         ripe_slowdown_sema = 'ripe_slowdown_sema'
+        create_slowdown_sema = 'create_slowdown_sema'
         tags = 'tags'
+        status_poller = 'status_poller'
+        measurement_batcher = 'measurement_batcher'
 
         additional_probes = 'additional_probes'
+        requested_probes = 'requested_probes'
 
         @staticmethod
         def get_default_for(property_key: str) -> typing.Any:
-            if property_key == RipeAtlasProbe.MeasurementKeys.num_packets.value:
+            if property_key in [RipeAtlasProbe.MeasurementKeys.num_packets.value,
+                                RipeAtlasProbe.MeasurementKeys.requested_probes.value]:
                 return 1
             elif property_key == RipeAtlasProbe.MeasurementKeys.bill_to_address.value:
                 return None
             elif property_key == RipeAtlasProbe.MeasurementKeys.additional_probes.value:
                 return []
+            elif property_key in [RipeAtlasProbe.MeasurementKeys.status_poller.value,
+                                  RipeAtlasProbe.MeasurementKeys.measurement_batcher.value,
+                                  RipeAtlasProbe.MeasurementKeys.create_slowdown_sema.value]:
+                return None
             raise ValueError('Property ' + property_key + ' has no default value')
 
     def __init__(self, **kwargs):
         self._last_update = None
         self._probe_obj = None
+        self._availability_flags = 0
 
         for name, value in kwargs.items():
             setattr(self, name, value)
@@ -174,37 +198,20 @@ class RipeAtlasProbe(Probe):
                     kwargs[key] = RipeAtlasProbe.MeasurementKeys.get_default_for(key)
 
         ripe_slowdown_sema = kwargs.pop(RipeAtlasProbe.MeasurementKeys.ripe_slowdown_sema.value)
-
-        atlas_request = self._create_request(dest_address, kwargs)
-
-        ripe_slowdown_sema.acquire()
-        (success, response) = atlas_request.create()
-
-        retries = 0
-        while not success:
-            ripe_slowdown_sema.acquire()
-            success, response = atlas_request.create()
-
-            if success:
-                break
-
-            if response.get('status', 500) >= 500:
-                raise ServerError(response)
-
-            if isinstance(response, dict):
-                if response.get('status', 0) >= 400 and \
-                        'start time in future' not in \
-                        response.get('errors', [{}])[0].get('detail', ''):
-                    # If "start time in future" is in the error message then we assume it is a
-                    # RA problem as we do not send a start time.
-                    raise MeasurementError(response)
-            retries += 1
-            time.sleep(10 + (random.randrange(250, 750) / 10) * retries)
-
-            if retries % 5 == 0:
-                logging.error('Create error {}'.format(response))
-
-        measurement_id = response['measurements'][0]
+        # an own limit for the creation requests if given
+        create_slowdown_sema = kwargs.pop(
+            RipeAtlasProbe.MeasurementKeys.create_slowdown_sema.value) or ripe_slowdown_sema
+        status_poller = kwargs.pop(RipeAtlasProbe.MeasurementKeys.status_poller.value)
+        measurement_batcher = kwargs.pop(
+            RipeAtlasProbe.MeasurementKeys.measurement_batcher.value)
+
+        ping = self._create_ping(dest_address, kwargs)
+        batch_key = self._create_batch_key(kwargs)
+        if measurement_batcher is not None:
+            measurement_id = measurement_batcher.create_measurement(batch_key, ping)
+        else:
+            measurement_id = ripe_helper.create_measurements(batch_key, [ping],
+                                                             create_slowdown_sema)[0]
 
         if measurement_id is None:
             return None
@@ -212,11 +219,12 @@ class RipeAtlasProbe(Probe):
         additional_probes = kwargs.get(RipeAtlasProbe.MeasurementKeys.additional_probes.value, [])
         measurement_result = self._get_measurement_response(measurement_id,
                                                             ripe_slowdown_sema=ripe_slowdown_sema,
-                                                            additional_probes=additional_probes)
+                                                            additional_probes=additional_probes,
+                                                            status_poller=status_poller)
         return measurement_result
 
-    def _create_request(self, dest_address, kwargs):
-        """Creates a Ripe atlas request out of the arguments"""
+    def _create_ping(self, dest_address, kwargs) -> ripe_atlas.Ping:
+        """Creates the Ripe atlas ping definition out of the arguments"""
         if kwargs[RipeAtlasProbe.MeasurementKeys.ip_version.value] == constants.IPV4_IDENTIFIER:
             af = 4
         else:
@@ -226,54 +234,51 @@ class RipeAtlasProbe(Probe):
         measurement_description = kwargs[RipeAtlasProbe.MeasurementKeys.measurement_name.value]
         tags = kwargs.get(RipeAtlasProbe.MeasurementKeys.tags.value, [])
 
-        ping = ripe_atlas.Ping(af=af, packets=packets, target=dest_address,
+        return ripe_atlas.Ping(af=af, packets=packets, target=dest_address,
                                description=measurement_description, tags=tags)
 
-        if RipeAtlasProbe.MeasurementKeys.additional_probes.value in kwargs:
-            probe_ids = [str(self.probe_id)]
-            for probe in kwargs[RipeAtlasProbe.MeasurementKeys.additional_probes.value]:
-                probe_ids.append(str(probe.probe_id))
-
-            source = ripe_atlas.AtlasSource(value=','.join(probe_ids), requested=1, type='probes')
-        else:
-            source = ripe_atlas.AtlasSource(value=self.probe_id, requested=1, type='probes')
-
-        # unix_timestamp = int(datetime.datetime.now().timestamp())
-
-        atlas_request_args = {
-            'key': kwargs[RipeAtlasProbe.MeasurementKeys.api_key.value],
-            'measurements': [ping],
-            'sources': [source],
-            'is_oneoff': True,
-            'verify': kwargs.get('verify', True)
-        }
-
-        if RipeAtlasProbe.MeasurementKeys.bill_to_address.value in kwargs:
-            atlas_request_args['bill_to'] = kwargs[
-                RipeAtlasProbe.MeasurementKeys.bill_to_address.value]
+    def _create_batch_key(self, kwargs) -> ripe_helper.MeasurementBatchKey:
+        """
+        Creates the key for the candidate probes, the number of them requested, the api key and
+        the bill to address of the arguments
+        """
+        probe_ids = [str(self.probe_id)]
+        for probe in kwargs[RipeAtlasProbe.MeasurementKeys.additional_probes.value]:
+            probe_ids.append(str(probe.probe_id))
 
-        return ripe_atlas.AtlasCreateRequest(**atlas_request_args)
+        return ripe_helper.MeasurementBatchKey(
+            ','.join(probe_ids), kwargs[RipeAtlasProbe.MeasurementKeys.requested_probes.value],
+            kwargs[RipeAtlasProbe.MeasurementKeys.api_key.value],
+            kwargs[RipeAtlasProbe.MeasurementKeys.bill_to_address.value])
 
     def _get_measurement_response(self, measurement_id: int, ripe_slowdown_sema: mp.Semaphore,
-                                  additional_probes: ['RipeAtlasProbe']) \
+                                  additional_probes: ['RipeAtlasProbe'], status_poller=None) \
             -> typing.Optional[RipeMeasurementResult]:
+        """
+        Waits for the measurement to stop and returns the result of the fastest probe
+        :param status_poller: a MeasurementStatusPoller waking this thread when the measurement
+                              stopped, without one the measurement is polled by this thread
+        """
         def sleep_time(amount: float = 10):
             """Sleep for ten seconds"""
             time.sleep(amount)
 
-        sleep_time(amount=360)
-        while True:
-            ripe_slowdown_sema.acquire()
-            res = ripe_helper.get_ripe_measurement(measurement_id, ripe_slowdown_sema)
-            if res is not None:
-                if res.status_id == 4:
-                    break
-                elif res.status_id in [6, 7]:
-                    raise ProbeError()
-                elif res.status_id in [0, 1, 2]:
+        if status_poller is not None:
+            status_poller.wait_for_measurement(measurement_id)
+        else:
+            sleep_time(amount=360)
+            while True:
+                ripe_slowdown_sema.acquire()
+                res = ripe_helper.get_ripe_measurement(measurement_id, ripe_slowdown_sema)
+                if res is not None:
+                    if res.status_id == 4:
+                        break
+                    elif res.status_id in [6, 7]:
+                        raise ProbeError()
+                    elif res.status_id in [0, 1, 2]:
+                        sleep_time()
+                else:
                     sleep_time()
-            else:
-                sleep_time()
 
         ripe_slowdown_sema.acquire()
         success, m_results = ripe_atlas.AtlasResultsRequest(
@@ -285,17 +290,24 @@ class RipeAtlasProbe(Probe):
             success, m_results = ripe_atlas.AtlasResultsRequest(
                 **{'msm_id': measurement_id}).create()
 
+        return RipeAtlasProbe.min_measurement_result(m_results, [self] + additional_probes)
+
+    @staticmethod
+    def min_measurement_result(m_results: [typing.Dict[str, typing.Any]],
+                               probes: ['RipeAtlasProbe']) \
+            -> typing.Optional[RipeMeasurementResult]:
+        """
+        Creates the measurement result for the fastest of the results of a measurement
+        :param m_results: the results as returned by the RIPE Atlas results endpoint
+        :param probes: the probes used for the measurement
+        """
         if not m_results or not isinstance(m_results, list):
             return None
 
         min_result = min(m_results, key=operator.itemgetter('min'))
         measurement_result = RipeMeasurementResult.create_from_dict(min_result)
-        if self.probe_id == str(min_result['prb_id']):
-            measurement_result.probe_id = self.id
-        else:
-            probe = [probe for probe in additional_probes
-                     if probe.probe_id == str(min_result['prb_id'])][0]
-            measurement_result.probe_id = probe.id
+        probe = [probe for probe in probes if probe.probe_id == str(min_result['prb_id'])][0]
+        measurement_result.probe_id = probe.id
 
         return measurement_result
 
@@ -304,35 +316,34 @@ class RipeAtlasProbe(Probe):
         """return timestamp when the probe was last updated"""
         return self._last_update
 
-    def available(self, max_age=datetime.timedelta(hours=2)) -> typing.Optional[AvailableType]:
+    def availability_flags(self, max_age=PROBE_STATUS_MAX_AGE) -> int:
         """
-        Should return if the probe is available for measurements
+        Returns the ProbeFlag flags of the probe
         :param max_age: :datetime.timedelta: the maximum age of the info
         """
         if not self._last_update or datetime.datetime.now() - max_age >= self._last_update:
-            if not self._update():
+            if not self._update(max_age=max_age):
                 if self._probe_obj:
                     raise ProbeError('Probes location changed')
                 raise ProbeError('Probe object could not be fetched')
 
+        return self._availability_flags
+
+    def available(self, max_age=PROBE_STATUS_MAX_AGE) -> typing.Optional[AvailableType]:
+        """
+        Should return if the probe is available for measurements
+        :param max_age: :datetime.timedelta: the maximum age of the info
+        """
+        available_flags = self.availability_flags(max_age=max_age) & AVAILABILITY_MASK
+
         if not self._probe_obj:
             return AvailableType.unknown
 
-        available = AvailableType.not_available
-        if self._probe_obj.status == 'Connected' and \
-                'system-ipv4-works' in [tag['slug'] for tag in self._probe_obj.tags] and \
-                'system-ipv4-capable' in [tag['slug'] for tag in self._probe_obj.tags]:
-            available = AvailableType.ipv4_available
-
-        if self._probe_obj.status == 'Connected' and \
-                'system-ipv6-works' in [tag['slug'] for tag in self._probe_obj.tags] and \
-                'system-ipv6-capable' in [tag['slug'] for tag in self._probe_obj.tags]:
-            if available == AvailableType.ipv4_available:
-                available = AvailableType.both_available
-            else:
-                available = AvailableType.ipv6_available
+        for available_type, flags in AVAILABILITY_FLAGS.items():
+            if available_flags == flags:
+                return available_type
 
-        return available
+        return AvailableType.not_available
 
     def is_available(self, ip_version: typing.Optional[str], max_age=datetime.timedelta(hours=12)) \
             -> bool:
@@ -353,15 +364,19 @@ class RipeAtlasProbe(Probe):
         if not self._probe_obj:
             if not self._update():
                 raise ProbeError('probe could not be fetched')
-        return 'system-ipv6-capable' in [tag['slug'] for tag in self._probe_obj.tags]
+        return bool(self._availability_flags & ProbeFlag.ipv6_capable)
 
     def update(self) -> bool:
         return self._update()
 
-    def _update(self) -> bool:
-        """Updates the probes status"""
-        self._probe_obj = ripe_atlas.Probe(id=self.probe_id)
-        self._last_update = datetime.datetime.now()
+    def _update(self, max_age: datetime.timedelta=PROBE_STATUS_MAX_AGE) -> bool:
+        """Updates the probes status from the snapshot of the status service"""
+        self._probe_obj, self._last_update, self._availability_flags = \
+            RipeAtlasProbe.status_service.probe_status(self.probe_id, max_age=max_age)
+
+        if not self._probe_obj:
+            logging.debug('ripe atlas id %s not found', self.probe_id)
+            return False
 
         if not self._probe_obj.geometry:
             logging.debug('no geometry found for ripe atlas id %s', self.probe_id)
@@ -386,7 +401,7 @@ class RipeAtlasProbe(Probe):
         if not self._probe_obj:
             if not self._update():
                 raise ProbeError('probe could not be fetched')
-        return 'system-ipv4-rfc1918' in [tag['slug'] for tag in self._probe_obj.tags]
+        return bool(self._availability_flags & ProbeFlag.rfc1918)
 
 
 class CaidaArkProbe(Probe):
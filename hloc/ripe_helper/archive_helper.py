@@ -0,0 +1,229 @@
+"""
+Reading and filtering of the RIPE Atlas daily archive dumps
+
+The filters do in process what the jq filters used by parse_ripe_archive did: they drop old
+results and results without a destination, keep only the minimal ping RTT of at most 30 ms and
+for every traceroute hop the fastest reply of less than 30 ms.
+"""
+
+import bz2
+import logging
+import queue
+import threading
+import typing
+import ujson as json
+
+READ_BLOCK_SIZE = 2**20
+MAX_PING_RTT = 30
+MAX_TRACEROUTE_RTT = 30
+
+
+def __jq_order_key(value):
+    """Sorts values like jq does (null < booleans < numbers < strings)"""
+    if value is None:
+        return 0, 0
+    if isinstance(value, bool):
+        return 1, value
+    if isinstance(value, (int, float)):
+        return 2, value
+    return 3, str(value)
+
+
+def filter_ping_result(result: typing.Dict[str, typing.Any], oldest_timestamp: int) \
+        -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Reduces a ping result to the fields used for the import
+    :return: the result with its minimal rtt as result or None if the result is dropped
+    """
+    timestamp = result.get('timestamp')
+    if timestamp is None or timestamp < oldest_timestamp or 'dst_addr' not in result:
+        return None
+
+    min_rtt = None
+    for ping in result.get('result') or []:
+        if not isinstance(ping, dict) or 'rtt' not in ping:
+            continue
+
+        rtt = ping['rtt']
+        if rtt is None:
+            # jq sorts null before all numbers so the minimum is null and the result dropped
+            return None
+        if not isinstance(rtt, (int, float)):
+            continue
+        if rtt <= MAX_PING_RTT and (min_rtt is None or rtt < min_rtt):
+            min_rtt = rtt
+
+    if min_rtt is None or min_rtt < 0:
+        return None
+
+    return {
+        'timestamp': timestamp,
+        'avg': result.get('avg'),
+        'dst_addr': result['dst_addr'],
+        'from': result.get('from'),
+        'min': result.get('min'),
+        'msm_id': result.get('msm_id'),
+        'type': result.get('type'),
+        'result': min_rtt,
+        'proto': result.get('proto'),
+        'src_addr': result.get('src_addr'),
+        'ttl': result.get('ttl'),
+        'prb_id': result.get('prb_id'),
+    }
+
+
+def filter_traceroute_result(result: typing.Dict[str, typing.Any], oldest_timestamp: int) \
+        -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Reduces a traceroute result to the fields used for the import
+    Every hop is reduced to the fastest reply of the replying address sorted first
+    :return: the result with the reduced hops as result or None if the result is dropped
+    """
+    timestamp = result.get('timestamp')
+    if timestamp is None or timestamp < oldest_timestamp or 'dst_addr' not in result:
+        return None
+
+    hops = []
+    for hop in result.get('result') or []:
+        if not isinstance(hop, dict) or 'result' not in hop:
+            continue
+
+        fastest_replies = {}
+        for reply in hop['result'] or []:
+            if not isinstance(reply, dict) or 'rtt' not in reply or 'from' not in reply:
+                continue
+
+            rtt = reply['rtt']
+            if rtt is not None and \
+                    (not isinstance(rtt, (int, float)) or rtt >= MAX_TRACEROUTE_RTT):
+                continue
+
+            reply_from = reply['from']
+            fastest_reply = fastest_replies.get(reply_from)
+            if fastest_reply is None or \
+                    __jq_order_key(rtt) < __jq_order_key(fastest_reply['rtt']):
+                fastest_replies[reply_from] = {'rtt': rtt, 'ttl': reply.get('ttl'),
+                                               'from': reply_from}
+
+        if fastest_replies:
+            first_from = min(fastest_replies.keys(), key=__jq_order_key)
+            hop_result = fastest_replies[first_from]
+            hop_result['hop'] = hop.get('hop')
+            hops.append(hop_result)
+
+    if not hops:
+        return None
+
+    return {
+        'timestamp': timestamp,
+        'dst_addr': result['dst_addr'],
+        'from': result.get('from'),
+        'msm_id': result.get('msm_id'),
+        'type': result.get('type'),
+        'result': hops,
+        'proto': result.get('proto'),
+        'src_addr': result.get('src_addr'),
+        'prb_id': result.get('prb_id'),
+    }
+
+
+def read_archive_lines(filepath: str, bz2_compressed: bool) -> typing.Generator[bytes, None, None]:
+    """
+    Returns the lines of an archive file
+    bz2 files are decompressed in a separate thread (the decompression releases the GIL) so the
+    decompression of the next block overlaps with the parsing of the current one
+    """
+    if not bz2_compressed:
+        with open(filepath, 'rb') as archive_file:
+            yield from archive_file
+        return
+
+    block_queue = queue.Queue(maxsize=8)
+    stop_event = threading.Event()
+
+    def decompress():
+        try:
+            with bz2.open(filepath, 'rb') as archive_file:
+                while not stop_event.is_set():
+                    block = archive_file.read(READ_BLOCK_SIZE)
+                    block_queue.put(block)
+                    if not block:
+                        break
+        except Exception as error:
+            block_queue.put(error)
+
+    decompress_thread = threading.Thread(target=decompress, name='bz2-decompress', daemon=True)
+    decompress_thread.start()
+
+    try:
+        rest = b''
+        while True:
+            block = block_queue.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                break
+
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            yield from lines
+
+        if rest:
+            yield rest
+    finally:
+        stop_event.set()
+        while decompress_thread.is_alive():
+            try:
+                block_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def read_archive_results(filepath: str, bz2_compressed: bool, oldest_timestamp: int,
+                         batch_size: int=1000) \
+        -> typing.Generator[typing.List[typing.Dict[str, typing.Any]], None, None]:
+    """
+    Parses and filters all results of an archive file
+    The measurement type is taken from the file name like the archive files are named. Lines
+    which are no valid json (e.g. the last line of a truncated file) are counted and skipped.
+    :return: lists of at most batch_size filtered results
+    """
+    if 'traceroute' in filepath:
+        result_filter = filter_traceroute_result
+    else:
+        result_filter = filter_ping_result
+
+    batch = []
+    invalid_lines = 0
+    for line in read_archive_lines(filepath, bz2_compressed):
+        if not line.strip():
+            continue
+
+        try:
+            result_dct = json.loads(line)
+        except ValueError:
+            invalid_lines += 1
+            continue
+
+        result = result_filter(result_dct, oldest_timestamp)
+        if result is None:
+            continue
+
+        batch.append(result)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if invalid_lines:
+        logging.warning('skipped %s lines of %s which are no valid json', invalid_lines,
+                        filepath)
+
+    if batch:
+        yield batch
+
+
+__all__ = ['filter_ping_result',
+           'filter_traceroute_result',
+           'read_archive_lines',
+           'read_archive_results',
+           ]
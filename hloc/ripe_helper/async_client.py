@@ -0,0 +1,404 @@
+"""
+An asyncio client for the RIPE Atlas REST API
+
+All requests of a process share one keep-alive connection pool and take their tokens from the
+RIPE Atlas rate limiters. Waiting for a measurement to finish awaits a central status poller so
+thousands of measurements can be in flight without holding a thread each.
+Needs the aiohttp package
+"""
+
+import asyncio
+import logging
+import random
+import time
+import typing
+
+from hloc import constants
+from hloc.exceptions import MeasurementError, ServerError
+from hloc.models import RipeAtlasProbe, RipeMeasurementResult, MeasurementResult
+from hloc.ripe_helper.history_cache import RipeHistoryCache
+from hloc.ripe_helper.history_helper import measurement_results_for_nodes, \
+    select_measurement_results
+from hloc.ripe_helper.measurement_batcher import AsyncMeasurementBatcher, \
+    MEASUREMENT_BATCH_WINDOW
+from hloc.ripe_helper.measurement_poller import AsyncMeasurementStatusPoller, \
+    MEASUREMENT_FIRST_POLL_DELAY, MEASUREMENT_POLL_INTERVAL
+from hloc.ripe_helper.rate_limiter import RipeEndpoint, RipeRateLimiters
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+RIPE_ATLAS_API_URL = 'https://atlas.ripe.net/api/v2/'
+MAX_MEASUREMENT_IDS = 500
+MAX_RESULT_PROBE_IDS = 1000
+
+
+class AsyncRipeAtlasClient(object):
+    """
+    Creates and evaluates RIPE Atlas ping measurements with coroutines
+    Must be created and used inside of a running event loop:
+
+        async with AsyncRipeAtlasClient(api_key, rate_limiters) as client:
+            measurement_result = await client.measure_rtt(...)
+    """
+
+    def __init__(self, api_key: str, rate_limiters: RipeRateLimiters,
+                 measurement_limit: int=100, max_connections: int=100,
+                 bill_to_address: str=None, api_url: str=RIPE_ATLAS_API_URL,
+                 first_poll_delay: float=MEASUREMENT_FIRST_POLL_DELAY,
+                 poll_interval: float=MEASUREMENT_POLL_INTERVAL,
+                 result_cache: RipeHistoryCache=None,
+                 batch_window: float=MEASUREMENT_BATCH_WINDOW):
+        """
+        :param api_key: the RIPE Atlas api key used to create measurements
+        :param rate_limiters: the rate limiters every request takes a token from
+        :param measurement_limit: the maximum number of measurements running in parallel
+        :param max_connections: the size of the connection pool
+        :param bill_to_address: the RIPE Atlas bill to address
+        :param api_url: the url of the RIPE Atlas REST API
+        :param first_poll_delay: the time in seconds before a new measurement is polled
+        :param poll_interval: the time in seconds between two status polls
+        :param result_cache: a cache for the fetched measurement history
+        :param batch_window: the time in seconds a new measurement waits for other measurements
+                             with the same candidate probes to be created with one request,
+                             0 disables the batching
+        """
+        if aiohttp is None:
+            raise ImportError('the async RIPE Atlas client needs the aiohttp package')
+
+        self.api_key = api_key
+        self.bill_to_address = bill_to_address
+        self.api_url = api_url
+        self._rate_limiters = rate_limiters
+        self._measurement_slots = asyncio.Semaphore(measurement_limit)
+        self._max_connections = max_connections
+        self._result_cache = result_cache
+        if batch_window > 0:
+            self._measurement_batcher = AsyncMeasurementBatcher(self.create_measurements,
+                                                                batch_window=batch_window)
+        else:
+            self._measurement_batcher = None
+        self._session = None
+        self._status_poller = AsyncMeasurementStatusPoller(self.get_measurement_statuses,
+                                                           first_poll_delay=first_poll_delay,
+                                                           poll_interval=poll_interval)
+
+    async def __aenter__(self) -> 'AsyncRipeAtlasClient':
+        connector = aiohttp.TCPConnector(limit=self._max_connections, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=120),
+            headers={'Authorization': 'Key {}'.format(self.api_key)})
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """Stops the status polling and closes all pooled connections"""
+        self._status_poller.cancel()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    async def _run_in_executor(function: typing.Callable, *args) -> typing.Any:
+        """Calls a blocking function like the result cache queries in the default executor"""
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    async def _request(self, endpoint: RipeEndpoint, method: str, path: str,
+                       params: typing.Dict[str, typing.Any]=None,
+                       json_body: typing.Dict[str, typing.Any]=None) \
+            -> typing.Tuple[int, typing.Any]:
+        """
+        Sends one request limited by the rate limiter of the endpoint
+        :return: the http status and the decoded json response
+        """
+        await self._rate_limiters[endpoint].acquire_async()
+        async with self._session.request(method, self.api_url + path, params=params,
+                                         json=json_body) as response:
+            try:
+                body = await response.json(content_type=None)
+            except ValueError:
+                body = None
+
+            return response.status, body
+
+    async def _get(self, endpoint: RipeEndpoint, path: str,
+                   params: typing.Dict[str, typing.Any]=None,
+                   max_retries: int=-1) -> typing.Tuple[int, typing.Any]:
+        """
+        Sends a GET request and retries it on server and connection errors
+        :param max_retries: the number of retries, -1 retries forever
+        """
+        retries = 0
+        while True:
+            status, body = None, None
+            try:
+                status, body = await self._request(endpoint, 'GET', path, params=params)
+                if status < 500:
+                    return status, body
+
+                logging.debug('RIPE Atlas GET %s returned %s: %s', path, status, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                logging.debug('RIPE Atlas GET %s failed', path, exc_info=True)
+
+            if retries >= max_retries >= 0:
+                return status, body
+
+            retries += 1
+            await asyncio.sleep(5 + (random.randrange(0, 500) / 100) * retries)
+
+            if retries % 5 == 0:
+                logging.error('RIPE Atlas GET %s error!', path)
+                await asyncio.sleep(30)
+
+    async def get_measurement_ids(self, ip_addr: str, allowed_measurement_age: int) -> [int]:
+        """Returns the ids of the newest ping measurements targeting ip_addr"""
+        if self._result_cache is not None:
+            measurement_ids = await self._run_in_executor(self._result_cache.get_measurement_ids,
+                                                          ip_addr, allowed_measurement_age)
+            if measurement_ids is not None:
+                return measurement_ids
+
+        params = {
+            'status__in': '2,4,5',
+            'target': ip_addr,
+            'type': 'ping',
+            'stop_time__gte': int(time.time()) - allowed_measurement_age,
+            'sort': '-id',
+            'page_size': MAX_MEASUREMENT_IDS,
+            'fields': 'id',
+        }
+        status, body = await self._get(RipeEndpoint.measurements, 'measurements/',
+                                       params=params)
+        if status != 200 or not body:
+            logging.error('RIPE Atlas measurements request error! %s %s', ip_addr, body)
+            return []
+
+        measurement_ids = [measurement['id'] for measurement in body.get('results', [])]
+        if self._result_cache is not None:
+            await self._run_in_executor(self._result_cache.save_measurement_ids, ip_addr,
+                                        allowed_measurement_age, measurement_ids)
+
+        return measurement_ids
+
+    async def get_results(self, measurement_id: int, start: int=None,
+                          probe_ids: [str]=None) -> typing.Optional[typing.List[typing.Any]]:
+        """
+        Returns the results of a measurement
+        :param start: only return results measured after this unix timestamp
+        :param probe_ids: only return results of these RIPE Atlas probes
+        :return: the results or None if the measurement has no results
+        """
+        params = {}
+        if start is not None:
+            params['start'] = start
+        if probe_ids:
+            params['probe_ids'] = ','.join(probe_ids[:MAX_RESULT_PROBE_IDS])
+
+        status, body = await self._get(RipeEndpoint.results,
+                                       'measurements/{}/results/'.format(measurement_id),
+                                       params=params, max_retries=5)
+        if status == 200 and isinstance(body, list):
+            return body
+
+        logging.debug('RIPE Atlas results request error! %s', body)
+        return None
+
+    async def check_measurements_for_nodes(self, measurement_ids: [int],
+                                           nodes: [RipeAtlasProbe],
+                                           allowed_measurement_age: int) \
+            -> typing.Optional[typing.List[MeasurementResult]]:
+        """
+        Like hloc.ripe_helper.history_helper.check_measurements_for_nodes
+        The results of all measurements not found in the result cache are requested
+        concurrently
+        """
+        if not measurement_ids:
+            return None
+
+        node_dct = {node.probe_id: node.id for node in nodes}
+        probe_ids = list(node_dct.keys())[:MAX_RESULT_PROBE_IDS]
+        start = int(time.time()) - allowed_measurement_age
+
+        def cached_results() -> {int: typing.List[typing.Any]}:
+            cached_lists = {}
+            for measurement_id in measurement_ids:
+                result_list = self._result_cache.get_results(measurement_id, probe_ids, start)
+                if result_list is not None:
+                    cached_lists[measurement_id] = result_list
+            return cached_lists
+
+        result_lists = {}
+        if self._result_cache is not None:
+            result_lists = await self._run_in_executor(cached_results)
+
+        requested_ids = [measurement_id for measurement_id in measurement_ids
+                         if measurement_id not in result_lists]
+        requested_lists = await asyncio.gather(*[
+            self.get_results(measurement_id, start=start, probe_ids=probe_ids)
+            for measurement_id in requested_ids])
+
+        new_lists = {measurement_id: result_list
+                     for measurement_id, result_list in zip(requested_ids, requested_lists)
+                     if result_list is not None}
+        result_lists.update(new_lists)
+
+        def save_results():
+            for measurement_id, result_list in new_lists.items():
+                self._result_cache.save_results(measurement_id, probe_ids, start, result_list)
+
+        if self._result_cache is not None and new_lists:
+            await self._run_in_executor(save_results)
+
+        measurement_results = [(measurement_id,
+                                measurement_results_for_nodes(result_lists[measurement_id],
+                                                              node_dct))
+                               for measurement_id in measurement_ids
+                               if measurement_id in result_lists]
+        return select_measurement_results(measurement_results, allowed_measurement_age)
+
+    async def create_measurements(self, probes_key: typing.Tuple[str, int],
+                                  definitions: [typing.Dict[str, typing.Any]]) -> [int]:
+        """
+        Creates one-off measurements for all definitions with one request
+        Every measurement is performed by the requested number of the candidate probes
+        :param probes_key: the comma separated RIPE Atlas ids of the candidate probes and the
+                           number of them requested
+        :raises ServerError: if RIPE Atlas has server issues
+        :raises MeasurementError: if RIPE Atlas refuses the measurements
+        :return: the ids of the created measurements in the order of the definitions
+        """
+        probe_ids, requested_probes = probes_key
+        request_body = {
+            'definitions': definitions,
+            'probes': [{
+                'type': 'probes',
+                'value': probe_ids,
+                'requested': requested_probes,
+            }],
+            'is_oneoff': True,
+        }
+        if self.bill_to_address:
+            request_body['bill_to'] = self.bill_to_address
+
+        retries = 0
+        while True:
+            try:
+                status, response = await self._request(RipeEndpoint.create, 'POST',
+                                                       'measurements/', json_body=request_body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                raise ServerError(error)
+
+            if status in (200, 201):
+                return response['measurements']
+
+            if status >= 500:
+                raise ServerError(response)
+
+            error = response.get('error', {}) if isinstance(response, dict) else {}
+            error_detail = error.get('errors', [{}])[0].get('detail', '')
+            if status >= 400 and 'start time in future' not in error_detail:
+                # If "start time in future" is in the error message then we assume it is a
+                # RA problem as we do not send a start time.
+                raise MeasurementError(response)
+
+            retries += 1
+            await asyncio.sleep(10 + (random.randrange(250, 750) / 10) * retries)
+
+            if retries % 5 == 0:
+                logging.error('Create error {}'.format(response))
+
+    async def create_ping_measurement(self, ip_addr: str, ip_version: str,
+                                      probes: [RipeAtlasProbe], description: str,
+                                      number_of_packets: int=1, tags: [str]=None,
+                                      requested_probes: int=1) -> typing.Optional[int]:
+        """
+        Creates a one-off ping measurement from requested_probes of the candidate probes
+        With a measurement batcher it is created together with the other measurements
+        requested for the same candidates
+        :raises ServerError: if RIPE Atlas has server issues
+        :raises MeasurementError: if RIPE Atlas refuses the measurement
+        :return: the id of the created measurement
+        """
+        definition = {
+            'type': 'ping',
+            'af': 4 if ip_version == constants.IPV4_IDENTIFIER else 6,
+            'packets': number_of_packets,
+            'target': ip_addr,
+            'description': description,
+            'tags': tags or [],
+        }
+        probes_key = (','.join(str(probe.probe_id) for probe in probes), requested_probes)
+
+        if self._measurement_batcher is not None:
+            return await self._measurement_batcher.create_measurement(probes_key, definition)
+
+        return (await self.create_measurements(probes_key, [definition]))[0]
+
+    async def get_measurement_statuses(self, measurement_ids: [int]) -> {int: int}:
+        """
+        Requests the status of all measurements with one listing request per 500 ids
+        :return: a dict mapping the measurement ids to their status ids
+        """
+        statuses = {}
+        for start in range(0, len(measurement_ids), MAX_MEASUREMENT_IDS):
+            id_chunk = measurement_ids[start:start + MAX_MEASUREMENT_IDS]
+            params = {
+                'id__in': ','.join(str(measurement_id) for measurement_id in id_chunk),
+                'fields': 'status',
+                'page_size': len(id_chunk),
+            }
+            status, body = await self._get(RipeEndpoint.measurements, 'measurements/',
+                                           params=params, max_retries=0)
+            if status != 200 or not body:
+                logging.error('RIPE Atlas measurement status listing error! %s', body)
+                continue
+
+            for measurement in body.get('results', []):
+                statuses[measurement['id']] = measurement['status']['id']
+
+        return statuses
+
+    async def wait_for_measurement(self, measurement_id: int):
+        """
+        Waits until the measurement is stopped
+        The status of all awaited measurements is polled together
+        :raises ProbeError: if the measurement failed because of its probes
+        """
+        await self._status_poller.wait_for_measurement(measurement_id)
+
+    async def measure_rtt(self, ip_addr: str, ip_version: str, probes: [RipeAtlasProbe],
+                          description: str, number_of_packets: int=1, tags: [str]=None,
+                          requested_probes: int=1) -> typing.Optional[RipeMeasurementResult]:
+        """
+        Measures the rtt to ip_addr from requested_probes of the candidate probes like
+        RipeAtlasProbe.measure_rtt
+        Waits for a free measurement slot before the measurement is created
+        :return: the result of the fastest probe or None
+        """
+        async with self._measurement_slots:
+            measurement_id = await self.create_ping_measurement(ip_addr, ip_version, probes,
+                                                                description,
+                                                                number_of_packets=number_of_packets,
+                                                                tags=tags,
+                                                                requested_probes=requested_probes)
+            if measurement_id is None:
+                return None
+
+            await self.wait_for_measurement(measurement_id)
+
+        m_results = None
+        while m_results is None:
+            m_results = await self.get_results(measurement_id)
+            if m_results is None:
+                logging.error('ResultRequest error for measurement {}'.format(measurement_id))
+                await asyncio.sleep(10 + (random.randrange(0, 500) / 100))
+
+        return RipeAtlasProbe.min_measurement_result(m_results, probes)
+
+
+__all__ = ['AsyncRipeAtlasClient',
+           ]
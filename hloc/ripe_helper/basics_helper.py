@@ -2,6 +2,7 @@
 Functions that will help with the ripe requests
 """
 
+import collections
 import logging
 import time
 import multiprocessing as mp
@@ -10,6 +11,16 @@ import random
 import ripe.atlas.cousteau as ripe_atlas
 import ripe.atlas.cousteau.exceptions as ripe_atlas_exceptions
 
+from hloc.exceptions import MeasurementError, ServerError
+from hloc.ripe_helper.history_cache import RipeHistoryCache
+
+MEASUREMENT_LISTING_PAGE_SIZE = 500
+
+# measurements with the same key can be created with one request
+MeasurementBatchKey = collections.namedtuple('MeasurementBatchKey',
+                                             ['probe_ids', 'requested_probes', 'api_key',
+                                              'bill_to_address'])
+
 
 def get_ripe_measurement(measurement_id: int, ripe_slow_down_sema: mp.Semaphore,
                          max_retries: int = -1):
@@ -34,10 +45,16 @@ def get_ripe_measurement(measurement_id: int, ripe_slow_down_sema: mp.Semaphore,
 
 def get_measurement_ids(ip_addr: str,
                         ripe_slow_down_sema: mp.Semaphore,
-                        allowed_measurement_age: int) -> [int]:
+                        allowed_measurement_age: int,
+                        result_cache: RipeHistoryCache=None) -> [int]:
     """
     Get ripe measurements for ip_addr
+    :param result_cache: a cache for the fetched measurement ids
     """
+    if result_cache is not None:
+        measurement_ids = result_cache.get_measurement_ids(ip_addr, allowed_measurement_age)
+        if measurement_ids is not None:
+            return measurement_ids
 
     def next_batch(measurement):
         loc_retries = 0
@@ -87,4 +104,78 @@ def get_measurement_ids(ip_addr: str,
         for _ in range(0, skip):
             next_batch(measurements)
 
-    return [measurement['id'] for measurement in measurements]
+    measurement_ids = [measurement['id'] for measurement in measurements]
+    if result_cache is not None:
+        result_cache.save_measurement_ids(ip_addr, allowed_measurement_age, measurement_ids)
+
+    return measurement_ids
+
+
+def get_measurement_statuses(measurement_ids: [int], ripe_slow_down_sema: mp.Semaphore) \
+        -> {int: int}:
+    """
+    Requests the status of all measurements with one listing request per 500 ids
+    :return: a dict mapping the measurement ids to their status ids
+    """
+    statuses = {}
+    for start in range(0, len(measurement_ids), MEASUREMENT_LISTING_PAGE_SIZE):
+        id_chunk = measurement_ids[start:start + MEASUREMENT_LISTING_PAGE_SIZE]
+        ripe_slow_down_sema.acquire()
+        try:
+            for measurement in ripe_atlas.MeasurementRequest(id__in=id_chunk, fields='status',
+                                                             page_size=len(id_chunk)):
+                statuses[measurement['id']] = measurement['status']['id']
+        except ripe_atlas_exceptions.APIResponseError:
+            logging.exception('Ripe measurement status listing error!')
+
+    return statuses
+
+
+def create_measurements(batch_key: MeasurementBatchKey, definitions: [ripe_atlas.Ping],
+                        ripe_slow_down_sema: mp.Semaphore) -> [int]:
+    """
+    Creates one-off measurements for all definitions with one request
+    Every measurement is performed by requested_probes of the probes of the batch key
+    :raises ServerError: if RIPE Atlas has server issues
+    :raises MeasurementError: if RIPE Atlas refuses the measurements
+    :return: the ids of the created measurements in the order of the definitions
+    """
+    atlas_request_args = {
+        'key': batch_key.api_key,
+        'measurements': definitions,
+        'sources': [ripe_atlas.AtlasSource(value=batch_key.probe_ids,
+                                           requested=batch_key.requested_probes,
+                                           type='probes')],
+        'is_oneoff': True,
+        'bill_to': batch_key.bill_to_address
+    }
+    atlas_request = ripe_atlas.AtlasCreateRequest(**atlas_request_args)
+
+    ripe_slow_down_sema.acquire()
+    (success, response) = atlas_request.create()
+
+    retries = 0
+    while not success:
+        ripe_slow_down_sema.acquire()
+        success, response = atlas_request.create()
+
+        if success:
+            break
+
+        if response.get('status', 500) >= 500:
+            raise ServerError(response)
+
+        if isinstance(response, dict):
+            if response.get('status', 0) >= 400 and \
+                    'start time in future' not in \
+                    response.get('errors', [{}])[0].get('detail', ''):
+                # If "start time in future" is in the error message then we assume it is a
+                # RA problem as we do not send a start time.
+                raise MeasurementError(response)
+        retries += 1
+        time.sleep(10 + (random.randrange(250, 750) / 10) * retries)
+
+        if retries % 5 == 0:
+            logging.error('Create error {}'.format(response))
+
+    return response['measurements']
@@ -0,0 +1,129 @@
+"""
+A TTL bounded cache for the RIPE Atlas measurement history
+
+The measurement ids found for a target and the results of a measurement for a set of probes
+are saved in a SQLite database. All validate processes open the same database file so a
+history fetched by one of them is reused by all others until it expires.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+import ujson as json
+
+CACHE_TABLE_STATEMENTS = [
+    'CREATE TABLE IF NOT EXISTS measurement_ids ('
+    'target TEXT PRIMARY KEY, oldest_stop_time INTEGER NOT NULL, '
+    'fetched INTEGER NOT NULL, measurement_ids TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS measurement_results ('
+    'measurement_id INTEGER NOT NULL, probes_hash TEXT NOT NULL, start INTEGER NOT NULL, '
+    'fetched INTEGER NOT NULL, results TEXT NOT NULL, '
+    'PRIMARY KEY (measurement_id, probes_hash))',
+    'CREATE INDEX IF NOT EXISTS measurement_ids_fetched ON measurement_ids (fetched)',
+    'CREATE INDEX IF NOT EXISTS measurement_results_fetched ON measurement_results (fetched)',
+]
+
+
+def probes_hash(probe_ids: [str]) -> str:
+    """Returns a key for the set of probe ids"""
+    return hashlib.sha1(','.join(sorted(str(probe_id) for probe_id in probe_ids))
+                        .encode()).hexdigest()
+
+
+class RipeHistoryCache(object):
+    """
+    Caches measurement ids and measurement results in a SQLite database
+    Every thread and process uses its own connection to the database file
+    """
+
+    def __init__(self, cache_path: str, ttl: int):
+        """
+        :param cache_path: the path of the SQLite database file
+        :param ttl: the time in seconds a fetched history is used
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.cache_path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    def create(self):
+        """Creates the cache tables and drops all expired entries"""
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        connection = self._connection()
+        for statement in CACHE_TABLE_STATEMENTS:
+            connection.execute(statement)
+
+        self.purge_expired()
+
+    def purge_expired(self):
+        """Deletes all expired entries"""
+        oldest_fetched = int(time.time()) - self.ttl
+        connection = self._connection()
+        connection.execute('DELETE FROM measurement_ids WHERE fetched < ?', (oldest_fetched,))
+        connection.execute('DELETE FROM measurement_results WHERE fetched < ?', (oldest_fetched,))
+
+    def get_measurement_ids(self, target: str, allowed_measurement_age: int) \
+            -> typing.Optional[typing.List[int]]:
+        """
+        :return: the cached measurement ids for the target if they cover the age window or None
+        """
+        now = int(time.time())
+        row = self._connection().execute(
+            'SELECT measurement_ids FROM measurement_ids '
+            'WHERE target = ? AND fetched >= ? AND oldest_stop_time <= ?',
+            (target, now - self.ttl, now - allowed_measurement_age)).fetchone()
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def save_measurement_ids(self, target: str, allowed_measurement_age: int,
+                             measurement_ids: [int]):
+        """Saves the measurement ids fetched for the target and age window"""
+        now = int(time.time())
+        self._connection().execute(
+            'INSERT OR REPLACE INTO measurement_ids VALUES (?, ?, ?, ?)',
+            (target, now - allowed_measurement_age, now, json.dumps(measurement_ids)))
+
+    def get_results(self, measurement_id: int, probe_ids: [str], start: int) \
+            -> typing.Optional[typing.List[typing.Dict[str, typing.Any]]]:
+        """
+        :return: the cached results of the measurement for the probes if they cover all
+                 results since start or None
+        """
+        row = self._connection().execute(
+            'SELECT results FROM measurement_results '
+            'WHERE measurement_id = ? AND probes_hash = ? AND fetched >= ? AND start <= ?',
+            (measurement_id, probes_hash(probe_ids), int(time.time()) - self.ttl,
+             start)).fetchone()
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def save_results(self, measurement_id: int, probe_ids: [str], start: int,
+                     results: [typing.Dict[str, typing.Any]]):
+        """Saves the results of the measurement fetched for the probes since start"""
+        self._connection().execute(
+            'INSERT OR REPLACE INTO measurement_results VALUES (?, ?, ?, ?, ?)',
+            (measurement_id, probes_hash(probe_ids), start, int(time.time()),
+             json.dumps(results)))
+
+
+__all__ = ['RipeHistoryCache',
+           'probes_hash',
+           ]
@@ -15,14 +15,19 @@ import ripe.atlas.cousteau as ripe_atlas
 from hloc.models import RipeMeasurementResult, RipeAtlasProbe, MeasurementResult
 from hloc.db_utils import probes_for_ids
 from hloc.constants import PROBE_CACHING_PATH
+from hloc.ripe_helper.history_cache import RipeHistoryCache
 
 
 def __get_measurements_for_nodes(measurement_ids: [int],
                                  ripe_slow_down_sema: mp.Semaphore,
                                  near_nodes: [RipeAtlasProbe],
-                                 allowed_measurement_age: int) \
+                                 allowed_measurement_age: int,
+                                 result_cache: RipeHistoryCache=None) \
         -> typing.Generator[typing.Tuple[int, typing.List[RipeMeasurementResult]], None, None]:
-    """Loads all results for all measurements if they are less than a year ago"""
+    """
+    Loads all results for all measurements if they are less than a year ago
+    Results found in the result_cache are not requested again
+    """
 
     node_dct = {}
     for node in near_nodes:
@@ -37,6 +42,13 @@ def __get_measurements_for_nodes(measurement_ids: [int],
             'probe_ids': [node.probe_id for node in near_nodes][:1000]
         }
 
+        if result_cache is not None:
+            result_list = result_cache.get_results(measurement_id, params['probe_ids'],
+                                                   allowed_start_time)
+            if result_list is not None:
+                yield measurement_id, measurement_results_for_nodes(result_list, node_dct)
+                continue
+
         ripe_slow_down_sema.acquire()
         success, result_list = ripe_atlas.AtlasResultsRequest(**params).create()
         retries = 0
@@ -58,23 +70,39 @@ def __get_measurements_for_nodes(measurement_ids: [int],
             logging.error('AtlasResultsRequest error! {}'.format(result_list))
             continue
 
-        measurements = []
-        for res in result_list:
-            ripe_measurement = RipeMeasurementResult.create_from_dict(res)
-            ripe_measurement.probe_id = node_dct[str(res['prb_id'])]
+        if result_cache is not None:
+            result_cache.save_results(measurement_id, params['probe_ids'], allowed_start_time,
+                                      result_list)
 
-            measurements.append(ripe_measurement)
+        yield measurement_id, measurement_results_for_nodes(result_list, node_dct)
 
-        yield measurement_id, measurements
+
+def measurement_results_for_nodes(result_list: [typing.Dict[str, typing.Any]],
+                                  node_dct: typing.Dict[str, int]) -> [RipeMeasurementResult]:
+    """
+    Creates the measurement results out of the results returned by RIPE Atlas
+    :param result_list: the results as returned by the RIPE Atlas results endpoint
+    :param node_dct: maps the RIPE Atlas probe ids to the database ids of the probes
+    """
+    measurements = []
+    for res in result_list:
+        ripe_measurement = RipeMeasurementResult.create_from_dict(res)
+        ripe_measurement.probe_id = node_dct[str(res['prb_id'])]
+
+        measurements.append(ripe_measurement)
+
+    return measurements
 
 
 def check_measurements_for_nodes(measurement_ids: [int],
                                  nodes: [RipeAtlasProbe],
                                  ripe_slow_down_sema: mp.Semaphore,
-                                 allowed_measurement_age: int) \
+                                 allowed_measurement_age: int,
+                                 result_cache: RipeHistoryCache=None) \
         -> typing.Optional[typing.List[MeasurementResult]]:
     """
     Check the measurements list for measurements from near_nodes
+    :param result_cache: a cache for the fetched measurement results
     :rtype: (float, dict)
     """
     if not measurement_ids:
@@ -83,8 +111,19 @@ def check_measurements_for_nodes(measurement_ids: [int],
     measurement_results = __get_measurements_for_nodes(measurement_ids,
                                                        ripe_slow_down_sema,
                                                        nodes,
-                                                       allowed_measurement_age)
+                                                       allowed_measurement_age,
+                                                       result_cache=result_cache)
     logging.debug('got measurement results')
+    return select_measurement_results(measurement_results, allowed_measurement_age)
+
+
+def select_measurement_results(measurement_results: typing.Iterable[
+                                   typing.Tuple[int, typing.List[RipeMeasurementResult]]],
+                               allowed_measurement_age: int) -> [MeasurementResult]:
+    """
+    Drops all results older than allowed_measurement_age
+    :return: the remaining results with the fastest one at the first position
+    """
     temp_result = None
     date_n = None
 
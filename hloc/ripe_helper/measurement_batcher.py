@@ -0,0 +1,201 @@
+"""
+Batching of RIPE Atlas measurement creations
+
+RIPE Atlas creates all definitions of one create request with the same probe selection. The
+batchers collect the measurements requested by the checks of a process for a short window,
+group them by their batch key (the candidate probes, how many of them are requested and the
+billing) and create every group with one request. Every caller gets the id of its own
+measurement back.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+import typing
+
+from hloc.exceptions import MeasurementError
+
+MEASUREMENT_BATCH_WINDOW = 2.0
+MAX_MEASUREMENT_BATCH_SIZE = 100
+
+
+class MeasurementBatcher(object):
+    """
+    Batches the measurement creations of the threads of a process
+    The submitting thread only runs while there are pending measurements
+    """
+
+    def __init__(self, create_measurements: typing.Callable[[typing.Hashable, typing.List],
+                                                            typing.List[int]],
+                 batch_window: float=MEASUREMENT_BATCH_WINDOW,
+                 max_batch_size: int=MAX_MEASUREMENT_BATCH_SIZE):
+        """
+        :param create_measurements: creates the definitions for a batch key with one request and
+                                    returns their measurement ids
+        :param batch_window: the time in seconds a measurement waits for others to join its batch
+        :param max_batch_size: the maximum number of definitions per request
+        """
+        self._create_measurements = create_measurements
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+        self._condition = threading.Condition()
+        # batch key -> (submit time, [(definition, future)])
+        self._batches = {}
+        self._submit_thread = None
+
+    def create_measurement(self, batch_key: typing.Hashable, definition) -> int:
+        """
+        Blocks until the measurement was created together with its batch
+        :raises ServerError, MeasurementError: like the create_measurements function
+        :return: the id of the created measurement
+        """
+        future = concurrent.futures.Future()
+        with self._condition:
+            if batch_key not in self._batches:
+                self._batches[batch_key] = (time.monotonic() + self._batch_window, [])
+            self._batches[batch_key][1].append((definition, future))
+
+            if len(self._batches[batch_key][1]) >= self._max_batch_size:
+                self._condition.notify()
+
+            if self._submit_thread is None:
+                self._submit_thread = threading.Thread(target=self._submit,
+                                                       name='measurement-batcher', daemon=True)
+                self._submit_thread.start()
+
+        return future.result()
+
+    def _next_batches(self) -> [typing.Tuple[typing.Hashable, typing.List]]:
+        """Waits for the batches to submit, an empty list if there is nothing to wait for"""
+        with self._condition:
+            while self._batches:
+                now = time.monotonic()
+                due_keys = [batch_key for batch_key, (submit_time, batch) in self._batches.items()
+                            if submit_time <= now or len(batch) >= self._max_batch_size]
+                if due_keys:
+                    return [(batch_key, self._batches.pop(batch_key)[1])
+                            for batch_key in due_keys]
+
+                self._condition.wait(min(submit_time for submit_time, _ in
+                                         self._batches.values()) - now)
+
+            self._submit_thread = None
+            return []
+
+    def _submit(self):
+        while True:
+            batches = self._next_batches()
+            if not batches:
+                return
+
+            for batch_key, batch in batches:
+                for start in range(0, len(batch), self._max_batch_size):
+                    self._submit_batch(batch_key, batch[start:start + self._max_batch_size])
+
+    def _submit_batch(self, batch_key: typing.Hashable, batch: [typing.Tuple]):
+        try:
+            measurement_ids = self._create_measurements(batch_key,
+                                                        [definition for definition, _ in batch])
+        except MeasurementError as error:
+            if len(batch) == 1:
+                batch[0][1].set_exception(error)
+                return
+
+            # one refused definition fails the whole request so the others are created alone
+            logging.debug('batch of %s measurements refused, creating them alone', len(batch))
+            for definition_future in batch:
+                self._submit_batch(batch_key, [definition_future])
+            return
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+            return
+
+        for index, (_, future) in enumerate(batch):
+            if index < len(measurement_ids):
+                future.set_result(measurement_ids[index])
+            else:
+                future.set_exception(MeasurementError('no measurement id returned'))
+
+
+class AsyncMeasurementBatcher(object):
+    """Batches the measurement creations of the coroutines of an event loop"""
+
+    def __init__(self, create_measurements: typing.Callable[[typing.Hashable, typing.List],
+                                                            typing.Awaitable[typing.List[int]]],
+                 batch_window: float=MEASUREMENT_BATCH_WINDOW,
+                 max_batch_size: int=MAX_MEASUREMENT_BATCH_SIZE):
+        """
+        :param create_measurements: a coroutine function creating the definitions for a batch
+                                    key with one request and returning their measurement ids
+        :param batch_window: the time in seconds a measurement waits for others to join its batch
+        :param max_batch_size: the maximum number of definitions per request
+        """
+        self._create_measurements = create_measurements
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+        # batch key -> (submit timer, [(definition, future)])
+        self._batches = {}
+
+    async def create_measurement(self, batch_key: typing.Hashable, definition) -> int:
+        """
+        Waits until the measurement was created together with its batch
+        :raises ServerError, MeasurementError: like the create_measurements coroutine
+        :return: the id of the created measurement
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if batch_key not in self._batches:
+            self._batches[batch_key] = (
+                loop.call_later(self._batch_window, self._submit_due, batch_key), [])
+        self._batches[batch_key][1].append((definition, future))
+
+        if len(self._batches[batch_key][1]) >= self._max_batch_size:
+            self._submit_due(batch_key)
+
+        return await future
+
+    def _submit_due(self, batch_key: typing.Hashable):
+        submit_timer, batch = self._batches.pop(batch_key, (None, None))
+        if submit_timer is not None:
+            # a full batch is submitted early, the next batch of the key gets its own window
+            submit_timer.cancel()
+        if batch:
+            asyncio.ensure_future(self._submit_batch(batch_key, batch))
+
+    async def _submit_batch(self, batch_key: typing.Hashable, batch: [typing.Tuple]):
+        try:
+            measurement_ids = await self._create_measurements(
+                batch_key, [definition for definition, _ in batch])
+        except MeasurementError as error:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(error)
+                return
+
+            # one refused definition fails the whole request so the others are created alone
+            logging.debug('batch of %s measurements refused, creating them alone', len(batch))
+            await asyncio.gather(*[self._submit_batch(batch_key, [definition_future])
+                                   for definition_future in batch])
+            return
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+
+            if index < len(measurement_ids):
+                future.set_result(measurement_ids[index])
+            else:
+                future.set_exception(MeasurementError('no measurement id returned'))
+
+
+__all__ = ['MeasurementBatcher',
+           'AsyncMeasurementBatcher',
+           ]
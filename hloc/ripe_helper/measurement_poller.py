@@ -0,0 +1,177 @@
+"""
+Central pollers for the status of running RIPE Atlas measurements
+
+Instead of every waiting check sleeping and polling its own measurement, the checks register
+their measurement at a poller. The poller requests the status of all registered measurements
+with one listing request per poll interval and wakes every check whose measurement stopped.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import typing
+
+from hloc.exceptions import ProbeError
+
+MEASUREMENT_FIRST_POLL_DELAY = 60
+MEASUREMENT_POLL_INTERVAL = 10
+STOPPED_STATUS_ID = 4
+FAILED_STATUS_IDS = [6, 7]
+
+
+class MeasurementStatusPoller(object):
+    """
+    Polls the status of the measurements waited for by the threads of a process
+    The polling thread only runs while there are measurements to wait for
+    """
+
+    def __init__(self, get_statuses: typing.Callable[[typing.List[int]], typing.Dict[int, int]],
+                 first_poll_delay: float=MEASUREMENT_FIRST_POLL_DELAY,
+                 poll_interval: float=MEASUREMENT_POLL_INTERVAL):
+        """
+        :param get_statuses: requests the status ids for a list of measurement ids
+        :param first_poll_delay: the time in seconds before a new measurement is polled
+        :param poll_interval: the time in seconds between two polls
+        """
+        self._get_statuses = get_statuses
+        self._first_poll_delay = first_poll_delay
+        self._poll_interval = poll_interval
+        self._lock = threading.Lock()
+        # measurement id -> [finished event, status id, first poll time]
+        self._waiting = {}
+        self._poll_thread = None
+
+    def wait_for_measurement(self, measurement_id: int):
+        """
+        Blocks until the measurement is stopped
+        :raises ProbeError: if the measurement failed because of its probes
+        """
+        with self._lock:
+            waiting_entry = self._waiting.get(measurement_id)
+            if waiting_entry is None:
+                waiting_entry = [threading.Event(), None,
+                                 time.monotonic() + self._first_poll_delay]
+                self._waiting[measurement_id] = waiting_entry
+
+            if self._poll_thread is None:
+                self._poll_thread = threading.Thread(target=self._poll, name='status-poller',
+                                                     daemon=True)
+                self._poll_thread.start()
+
+        waiting_entry[0].wait()
+        if waiting_entry[1] in FAILED_STATUS_IDS:
+            raise ProbeError()
+
+    def _poll(self):
+        while True:
+            time.sleep(self._poll_interval)
+
+            with self._lock:
+                if not self._waiting:
+                    self._poll_thread = None
+                    return
+
+                now = time.monotonic()
+                measurement_ids = [measurement_id
+                                   for measurement_id, (_, _, first_poll) in self._waiting.items()
+                                   if first_poll <= now]
+
+            if not measurement_ids:
+                continue
+
+            try:
+                statuses = self._get_statuses(measurement_ids)
+            except Exception:
+                logging.exception('measurement status poll failed')
+                continue
+
+            with self._lock:
+                for measurement_id, status_id in statuses.items():
+                    if status_id != STOPPED_STATUS_ID and status_id not in FAILED_STATUS_IDS:
+                        continue
+
+                    waiting_entry = self._waiting.pop(measurement_id, None)
+                    if waiting_entry is not None:
+                        waiting_entry[1] = status_id
+                        waiting_entry[0].set()
+
+
+class AsyncMeasurementStatusPoller(object):
+    """
+    Polls the status of the measurements awaited by the coroutines of an event loop
+    The polling task only runs while there are measurements to wait for
+    """
+
+    def __init__(self, get_statuses: typing.Callable[[typing.List[int]],
+                                                     typing.Awaitable[typing.Dict[int, int]]],
+                 first_poll_delay: float=MEASUREMENT_FIRST_POLL_DELAY,
+                 poll_interval: float=MEASUREMENT_POLL_INTERVAL):
+        """
+        :param get_statuses: a coroutine function requesting the status ids for a list of
+                             measurement ids
+        :param first_poll_delay: the time in seconds before a new measurement is polled
+        :param poll_interval: the time in seconds between two polls
+        """
+        self._get_statuses = get_statuses
+        self._first_poll_delay = first_poll_delay
+        self._poll_interval = poll_interval
+        # measurement id -> (future for the status id, first poll time)
+        self._waiting = {}
+        self._poll_task = None
+
+    async def wait_for_measurement(self, measurement_id: int):
+        """
+        Waits until the measurement is stopped
+        :raises ProbeError: if the measurement failed because of its probes
+        """
+        waiting_entry = self._waiting.get(measurement_id)
+        if waiting_entry is None:
+            waiting_entry = (asyncio.get_event_loop().create_future(),
+                             time.monotonic() + self._first_poll_delay)
+            self._waiting[measurement_id] = waiting_entry
+
+        if self._poll_task is None:
+            self._poll_task = asyncio.ensure_future(self._poll())
+
+        status_id = await asyncio.shield(waiting_entry[0])
+        if status_id in FAILED_STATUS_IDS:
+            raise ProbeError()
+
+    def cancel(self):
+        """Stops the polling task"""
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+
+    async def _poll(self):
+        while self._waiting:
+            await asyncio.sleep(self._poll_interval)
+
+            now = time.monotonic()
+            measurement_ids = [measurement_id
+                               for measurement_id, (_, first_poll) in self._waiting.items()
+                               if first_poll <= now]
+            if not measurement_ids:
+                continue
+
+            try:
+                statuses = await self._get_statuses(measurement_ids)
+            except Exception:
+                logging.exception('measurement status poll failed')
+                continue
+
+            for measurement_id, status_id in statuses.items():
+                if status_id != STOPPED_STATUS_ID and status_id not in FAILED_STATUS_IDS:
+                    continue
+
+                waiting_entry = self._waiting.pop(measurement_id, None)
+                if waiting_entry is not None and not waiting_entry[0].done():
+                    waiting_entry[0].set_result(status_id)
+
+        self._poll_task = None
+
+
+__all__ = ['MeasurementStatusPoller',
+           'AsyncMeasurementStatusPoller',
+           ]
@@ -0,0 +1,152 @@
+"""
+A snapshot of the status of RIPE Atlas probes
+
+Instead of requesting every probe on its own the status, tags and geometry of all probes in
+use are requested with probe listings filtered by id, 500 probes per request. The tags of a
+probe are parsed once per refresh into availability flags, so the probes answer their
+availability from the snapshot with bitwise operations until it is older than the allowed age.
+"""
+
+import datetime
+import enum
+import logging
+import random
+import threading
+import time
+import typing
+
+import ripe.atlas.cousteau as ripe_atlas
+import ripe.atlas.cousteau.exceptions as ripe_atlas_exceptions
+
+PROBE_LISTING_PAGE_SIZE = 500
+PROBE_STATUS_MAX_AGE = datetime.timedelta(hours=2)
+
+
+@enum.unique
+class ProbeFlag(enum.IntFlag):
+    connected = 1
+    # works and is capable
+    ipv4_works = 2
+    ipv6_works = 4
+    ipv6_capable = 8
+    rfc1918 = 16
+
+
+def probe_flags(probe_obj: typing.Optional[ripe_atlas.Probe]) -> int:
+    """Computes the availability flags from the status and tags of a probe"""
+    if probe_obj is None:
+        return 0
+
+    tag_slugs = {tag['slug'] for tag in probe_obj.tags or []}
+    flags = 0
+    if probe_obj.status == 'Connected':
+        flags |= ProbeFlag.connected
+    if 'system-ipv4-works' in tag_slugs and 'system-ipv4-capable' in tag_slugs:
+        flags |= ProbeFlag.ipv4_works
+    if 'system-ipv6-works' in tag_slugs and 'system-ipv6-capable' in tag_slugs:
+        flags |= ProbeFlag.ipv6_works
+    if 'system-ipv6-capable' in tag_slugs:
+        flags |= ProbeFlag.ipv6_capable
+    if 'system-ipv4-rfc1918' in tag_slugs:
+        flags |= ProbeFlag.rfc1918
+
+    return int(flags)
+
+
+class ProbeStatusService(object):
+    """
+    Keeps the RIPE Atlas probe objects of all probes asked for
+    A probe older than the allowed age refreshes all outdated probes at once
+    """
+
+    def __init__(self, ripe_slow_down_sema=None, page_size: int=PROBE_LISTING_PAGE_SIZE):
+        """
+        :param ripe_slow_down_sema: the rate limiter every listing request takes a token from
+        :param page_size: the number of probes requested per listing request
+        """
+        self._ripe_slow_down_sema = ripe_slow_down_sema
+        self._page_size = page_size
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # probe id -> (ripe_atlas.Probe or None if it was not found, fetch time, flags)
+        self._snapshot = {}
+
+    def refresh(self, probe_ids: [str], max_retries: int=5):
+        """
+        Requests the status of the probes with one listing request per page
+        :param max_retries: the retries per page, -1 retries forever
+        :raises APIResponseError: if a page could not be requested
+        """
+        probe_ids = [str(probe_id) for probe_id in probe_ids]
+        for start in range(0, len(probe_ids), self._page_size):
+            id_chunk = probe_ids[start:start + self._page_size]
+            probe_objs = self.__request_probes(id_chunk, max_retries)
+
+            fetched = datetime.datetime.now()
+            with self._lock:
+                for probe_id in id_chunk:
+                    probe_obj = probe_objs.get(probe_id)
+                    self._snapshot[probe_id] = (probe_obj, fetched, probe_flags(probe_obj))
+
+    def __request_probes(self, probe_ids: [str], max_retries: int) -> {str: ripe_atlas.Probe}:
+        retries = 0
+        while True:
+            if self._ripe_slow_down_sema is not None:
+                self._ripe_slow_down_sema.acquire()
+
+            try:
+                return {str(probe_obj.id): probe_obj
+                        for probe_obj in ripe_atlas.ProbeRequest(return_objects=True,
+                                                                 id__in=probe_ids,
+                                                                 page_size=len(probe_ids))}
+            except ripe_atlas_exceptions.APIResponseError:
+                if retries >= max_retries >= 0:
+                    raise
+
+                retries += 1
+                if retries % 5 == 0:
+                    logging.exception('Ripe probe listing error!')
+
+                time.sleep(5 + (random.randrange(0, 500) / 100) * retries)
+
+    def refresh_outdated(self, probe_ids: [str],
+                         max_age: datetime.timedelta=PROBE_STATUS_MAX_AGE):
+        """
+        Refreshes the probes not in the snapshot or older than max_age
+        Together with them all other outdated probes of the snapshot are refreshed
+        """
+        probe_ids = set(str(probe_id) for probe_id in probe_ids)
+        with self._refresh_lock:
+            with self._lock:
+                oldest_fetched = datetime.datetime.now() - max_age
+                missing_ids = [probe_id for probe_id in probe_ids
+                               if probe_id not in self._snapshot or
+                               self._snapshot[probe_id][1] <= oldest_fetched]
+                if not missing_ids:
+                    return
+
+                outdated_ids = [outdated_id
+                                for outdated_id, (_, fetched, _) in self._snapshot.items()
+                                if fetched <= oldest_fetched and outdated_id not in probe_ids]
+
+            logging.debug('refreshing the status of %s probes',
+                          len(missing_ids) + len(outdated_ids))
+            self.refresh(missing_ids + outdated_ids)
+
+    def probe_status(self, probe_id: str, max_age: datetime.timedelta=PROBE_STATUS_MAX_AGE) \
+            -> typing.Tuple[typing.Optional[ripe_atlas.Probe], datetime.datetime, int]:
+        """
+        Returns the snapshot of the probe and refreshes it if it is older than max_age
+        :return: the probe object or None if RIPE Atlas does not know the probe, the time it
+                 was fetched and its ProbeFlag flags
+        """
+        self.refresh_outdated([probe_id], max_age=max_age)
+        with self._lock:
+            return self._snapshot[str(probe_id)]
+
+
+__all__ = ['ProbeStatusService',
+           'ProbeFlag',
+           'probe_flags',
+           'PROBE_STATUS_MAX_AGE',
+           ]
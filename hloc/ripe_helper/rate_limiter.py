@@ -0,0 +1,322 @@
+"""
+Token bucket rate limiting for the RIPE Atlas API
+
+A bucket holds at most burst tokens and is refilled continuously at rate tokens per second,
+measured with a clock instead of a thread releasing tokens. Every request takes a token from
+the global bucket of the api key and from the bucket of its endpoint if that one is limited.
+The bucket states are kept by a backend:
+
+- local: in the memory of one process for all its threads
+- shared-memory: in shared memory for all processes forked after the backend was created
+- sqlite: in a SQLite file for all processes (and hosts) opening the same file
+"""
+
+import abc
+import argparse
+import asyncio
+import collections
+import enum
+import math
+import multiprocessing as mp
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+GLOBAL_BUCKET_NAME = 'ripe'
+
+BucketLimit = collections.namedtuple('BucketLimit', ['name', 'rate', 'burst'])
+
+
+@enum.unique
+class RipeEndpoint(enum.Enum):
+    """The RIPE Atlas API endpoints with their own buckets"""
+    create = 'create'
+    results = 'results'
+    probes = 'probes'
+    measurements = 'measurements'
+
+    @property
+    def bucket_name(self) -> str:
+        return '{}-{}'.format(GLOBAL_BUCKET_NAME, self.value)
+
+
+@enum.unique
+class RateLimitBackendType(enum.Enum):
+    local = 'local'
+    shared_memory = 'shared-memory'
+    sqlite = 'sqlite'
+
+
+class RateLimitBackend(metaclass=abc.ABCMeta):
+    """Keeps the state of token buckets"""
+
+    # take can wait for other processes (file locks) and must not run in an event loop
+    blocking = False
+
+    @abc.abstractmethod
+    def take(self, limits: [BucketLimit], tokens: float=1) -> float:
+        """
+        Takes the tokens from all buckets at once if every bucket holds enough of them
+        :return: 0 if the tokens were taken, otherwise the time in seconds until they are
+                 available
+        """
+        pass
+
+    @staticmethod
+    def _take_tokens(states: typing.Dict[str, typing.Tuple[float, float]],
+                     limits: [BucketLimit], tokens: float, now: float) -> float:
+        """
+        Refills the buckets and takes the tokens if all of them hold enough
+        :param states: maps the bucket names to their tokens and update time, missing buckets
+                       are full. Only updated if the tokens were taken.
+        :return: 0 if the tokens were taken, otherwise the time in seconds until they are
+                 available
+        """
+        wait_time = 0
+        refilled_tokens = {}
+        for limit in limits:
+            bucket_tokens, updated = states.get(limit.name, (limit.burst, now))
+            bucket_tokens = min(limit.burst, bucket_tokens + max(0, now - updated) * limit.rate)
+            refilled_tokens[limit.name] = bucket_tokens
+            if bucket_tokens < tokens:
+                wait_time = max(wait_time, (tokens - bucket_tokens) / limit.rate)
+
+        if wait_time > 0:
+            return wait_time
+
+        for limit in limits:
+            states[limit.name] = (refilled_tokens[limit.name] - tokens, now)
+
+        return 0
+
+
+class LocalBackend(RateLimitBackend):
+    """Keeps the buckets in the memory of this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def take(self, limits: [BucketLimit], tokens: float=1) -> float:
+        with self._lock:
+            return self._take_tokens(self._states, limits, tokens, time.monotonic())
+
+
+class SharedMemoryBackend(RateLimitBackend):
+    """
+    Keeps the buckets in shared memory
+    Must be created before the processes sharing it are forked. The monotonic clock is the same
+    for all processes of a host.
+    """
+
+    def __init__(self, bucket_names: [str]):
+        """:param bucket_names: the names of all buckets used with this backend"""
+        self._indexes = {name: index for index, name in enumerate(bucket_names)}
+        # the tokens and update time of every bucket, NaN for buckets never used
+        self._states = mp.Array('d', [float('nan')] * (2 * len(bucket_names)))
+
+    def take(self, limits: [BucketLimit], tokens: float=1) -> float:
+        with self._states.get_lock():
+            states = {}
+            for limit in limits:
+                index = 2 * self._indexes[limit.name]
+                if not math.isnan(self._states[index]):
+                    states[limit.name] = (self._states[index], self._states[index + 1])
+
+            wait_time = self._take_tokens(states, limits, tokens, time.monotonic())
+            if wait_time == 0:
+                for limit in limits:
+                    index = 2 * self._indexes[limit.name]
+                    self._states[index], self._states[index + 1] = states[limit.name]
+
+            return wait_time
+
+
+class SQLiteBackend(RateLimitBackend):
+    """
+    Keeps the buckets in a SQLite database file
+    All processes opening the same file share the buckets. To share them between hosts the file
+    must be on a file system with working file locks and the clocks of the hosts must be
+    synchronized because the buckets are refilled by wall clock time.
+    """
+
+    blocking = True
+
+    def __init__(self, db_path: str):
+        """:param db_path: the path of the SQLite database file"""
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            connection.execute('CREATE TABLE IF NOT EXISTS token_buckets ('
+                               'name TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                               'updated REAL NOT NULL)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    def take(self, limits: [BucketLimit], tokens: float=1) -> float:
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            states = {}
+            for limit in limits:
+                row = connection.execute('SELECT tokens, updated FROM token_buckets '
+                                         'WHERE name = ?', (limit.name,)).fetchone()
+                if row is not None:
+                    states[limit.name] = row
+
+            wait_time = self._take_tokens(states, limits, tokens, time.time())
+            if wait_time == 0:
+                connection.executemany('INSERT OR REPLACE INTO token_buckets VALUES (?, ?, ?)',
+                                       [(limit.name,) + tuple(states[limit.name])
+                                        for limit in limits])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        return wait_time
+
+
+class RateLimiter(object):
+    """Takes a token from each of its buckets per request"""
+
+    def __init__(self, backend: RateLimitBackend, limits: [BucketLimit]):
+        for limit in limits:
+            if limit.rate <= 0:
+                raise ValueError('the rate of bucket {} must be larger than 0'.format(limit.name))
+
+        self._backend = backend
+        self._limits = [BucketLimit(limit.name, limit.rate, max(limit.burst, 1))
+                        for limit in limits]
+
+    def acquire(self, block: bool=True, timeout: float=None) -> bool:
+        """
+        Takes a token like Semaphore.acquire so it can replace the RIPE slow down semaphore
+        :return: True if the token was taken
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait_time = self._backend.take(self._limits)
+            if wait_time == 0:
+                return True
+            if not block:
+                return False
+
+            if deadline is not None:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    return False
+                wait_time = min(wait_time, remaining_time)
+
+            time.sleep(wait_time)
+
+    async def acquire_async(self):
+        """
+        Waits until a token is available and takes it
+        The tokens of a blocking backend are taken in the default executor of the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            if self._backend.blocking:
+                wait_time = await loop.run_in_executor(None, self._backend.take, self._limits)
+            else:
+                wait_time = self._backend.take(self._limits)
+            if wait_time == 0:
+                return
+
+            await asyncio.sleep(wait_time)
+
+
+class RipeRateLimiters(object):
+    """
+    The rate limiters for the RIPE Atlas endpoints
+    All endpoints share the global bucket, the endpoints with a limit also have their own one.
+    """
+
+    def __init__(self, backend: RateLimitBackend, rate: float, burst: float,
+                 endpoint_limits: typing.Dict[RipeEndpoint, typing.Tuple[float, float]]=None):
+        """
+        :param rate: the requests per second allowed for all endpoints together
+        :param burst: the maximum number of requests sent at once
+        :param endpoint_limits: maps endpoints to their own rate and burst
+        """
+        global_limit = BucketLimit(GLOBAL_BUCKET_NAME, rate, burst)
+        endpoint_limits = endpoint_limits or {}
+        self._limiters = {}
+        for endpoint in RipeEndpoint:
+            limits = [global_limit]
+            if endpoint in endpoint_limits:
+                endpoint_rate, endpoint_burst = endpoint_limits[endpoint]
+                limits.append(BucketLimit(endpoint.bucket_name, endpoint_rate, endpoint_burst))
+            self._limiters[endpoint] = RateLimiter(backend, limits)
+
+    def __getitem__(self, endpoint: RipeEndpoint) -> RateLimiter:
+        return self._limiters[endpoint]
+
+    @staticmethod
+    def bucket_names() -> [str]:
+        return [GLOBAL_BUCKET_NAME] + [endpoint.bucket_name for endpoint in RipeEndpoint]
+
+    @staticmethod
+    def create(backend_type: RateLimitBackendType, rate: float, burst: float,
+               endpoint_limits: typing.Dict[RipeEndpoint, typing.Tuple[float, float]]=None,
+               db_path: str=None) -> 'RipeRateLimiters':
+        """
+        Creates the rate limiters with a new backend
+        :param db_path: the database file of the sqlite backend
+        """
+        if backend_type == RateLimitBackendType.sqlite:
+            if not db_path:
+                raise ValueError('the sqlite rate limit backend needs a database file')
+            backend = SQLiteBackend(db_path)
+        elif backend_type == RateLimitBackendType.shared_memory:
+            backend = SharedMemoryBackend(RipeRateLimiters.bucket_names())
+        else:
+            backend = LocalBackend()
+
+        return RipeRateLimiters(backend, rate, burst, endpoint_limits=endpoint_limits)
+
+
+def parse_endpoint_limit(value: str) -> typing.Tuple[RipeEndpoint, float, float]:
+    """
+    Parses an endpoint limit argument of the form endpoint:rate[:burst]
+    The burst defaults to the rate
+    """
+    parts = value.split(':')
+    try:
+        if len(parts) not in (2, 3):
+            raise ValueError()
+        endpoint = RipeEndpoint(parts[0])
+        rate = float(parts[1])
+        burst = float(parts[2]) if len(parts) == 3 else rate
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected endpoint:rate[:burst] with endpoint one of {}, got {}'.format(
+                ', '.join(endpoint.value for endpoint in RipeEndpoint), value))
+
+    if rate <= 0:
+        raise argparse.ArgumentTypeError('the rate of {} must be larger than 0'.format(value))
+
+    return endpoint, rate, burst
+
+
+__all__ = ['RipeEndpoint',
+           'RateLimitBackendType',
+           'RateLimitBackend',
+           'LocalBackend',
+           'SharedMemoryBackend',
+           'SQLiteBackend',
+           'BucketLimit',
+           'RateLimiter',
+           'RipeRateLimiters',
+           'parse_endpoint_limit',
+           ]
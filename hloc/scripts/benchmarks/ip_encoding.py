@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Compares the DomainClassifier with the single check functions on an rDNS file
+The file has one "ip,domain" entry per line like the input of ipdns_parser.
+"""
+
+import argparse
+import collections
+import time
+
+from hloc import util
+from hloc.domain_processing_helper.domain_name_preprocessing import ACCEPTED_CHARACTER, \
+    RegexStrategy, DomainClassifier, is_ipv4_address_encoded, is_ip_hex_encoded, \
+    has_ip_alphanumeric_encoded, is_ipv6_address_encoded
+from hloc.models import DomainType
+
+logger = None
+
+
+def __create_parser_arguments(parser: argparse.ArgumentParser):
+    """Creates the arguments for the parser"""
+    parser.add_argument('filepath', type=str, help='The path to the rDNS file')
+    parser.add_argument('-t', '--tlds-file', type=str, required=True,
+                        help='Set the path to the tlds file')
+    parser.add_argument('-s', '--regex-strategy', type=str, choices=RegexStrategy.all_values(),
+                        default=RegexStrategy.abstract.value, help='Specify a regex Strategy')
+    parser.add_argument('-n', '--line-limit', type=int, default=10**6,
+                        help='The maximum number of lines used')
+    parser.add_argument('-l', '--log-file', type=str, default='ip-encoding-benchmark.log',
+                        help='Specify a logging file where the log should be saved')
+    parser.add_argument('-ll', '--log-level', type=str, default='INFO',
+                        choices=['NOTSET', 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='Set the preferred log level')
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser()
+    __create_parser_arguments(parser)
+    args = parser.parse_args()
+
+    global logger
+    logger = util.setup_logger(args.log_file, 'ip-encoding-benchmark', loglevel=args.log_level)
+
+    tlds = set()
+    with open(args.tlds_file) as tld_file:
+        for line in tld_file:
+            line = line.strip()
+            if line and line[0] != '#':
+                tlds.add(line.lower())
+
+    ip_domain_tuples = collections.defaultdict(list)
+    with open(args.filepath, encoding='ISO-8859-1') as rdns_file:
+        for line_number, line in enumerate(rdns_file):
+            if line_number >= args.line_limit:
+                break
+
+            ip_address, domain = line.strip().split(',', 1)
+            ip_version = 'ipv6' if ':' in ip_address else 'ipv4'
+            ip_domain_tuples[ip_version].append((ip_address, domain))
+
+    regex_strategy = RegexStrategy(args.regex_strategy)
+
+    for ip_version, version_tuples in ip_domain_tuples.items():
+        start_time = time.perf_counter()
+        legacy_types = [legacy_classify(ip_address, domain, tlds, ip_version, regex_strategy)
+                        for ip_address, domain in version_tuples]
+        legacy_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        domain_classifier = DomainClassifier(tlds, ip_version=ip_version,
+                                             regex_strategy=regex_strategy)
+        classifier_types = [domain_classifier.classify(ip_address, domain)
+                            for ip_address, domain in version_tuples]
+        classifier_time = time.perf_counter() - start_time
+
+        differences = sum(1 for legacy_type, classifier_type in zip(legacy_types,
+                                                                    classifier_types)
+                          if legacy_type != classifier_type)
+
+        logger.info('%s: %s domains, check functions %.3f s (%.0f domains/s), classifier %.3f s '
+                    '(%.0f domains/s), %s different classifications, types %s', ip_version,
+                    len(version_tuples), legacy_time, len(version_tuples) / legacy_time,
+                    classifier_time, len(version_tuples) / classifier_time, differences,
+                    dict(collections.Counter(classifier_types)))
+
+
+def legacy_classify(ip_address: str, domain: str, tlds: {str}, ip_version: str,
+                    regex_strategy: RegexStrategy) -> DomainType:
+    """Classifies the domain with the single check functions in the order they were used"""
+    is_ipv6 = ip_version == 'ipv6'
+
+    if set(domain).difference(ACCEPTED_CHARACTER):
+        return DomainType.invalid_characters
+    elif not is_ipv6 and is_ipv4_address_encoded(ip_address, domain, regex_strategy):
+        return DomainType.ip_encoded
+    elif not is_ipv6 and is_ip_hex_encoded(ip_address, domain):
+        return DomainType.ip_encoded
+    elif has_ip_alphanumeric_encoded(ip_address, domain, ip_version):
+        return DomainType.ip_encoded
+    elif is_ipv6 and is_ipv6_address_encoded(ip_address, domain):
+        return DomainType.ip_encoded
+    elif domain.split('.')[-1] in tlds:
+        return DomainType.valid
+
+    return DomainType.bad_tld
+
+
+if __name__ == '__main__':
+    main()
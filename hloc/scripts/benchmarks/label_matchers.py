@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Compares the matcher backends of find on a label corpus
+The labels are either taken from the domain_labels table or from a file with one label per line.
+Each backend has to return exactly the same location hints as the marisa backend.
+"""
+
+import argparse
+import collections
+import time
+
+from hloc import util
+from hloc.db_utils import create_engine, create_session_for_process
+from hloc.domain_processing_helper.label_matcher import MatcherBackend, create_label_matcher
+from hloc.domain_processing_helper.location_trie import load_trie
+from hloc.models import DomainLabel
+from hloc.scripts.find import find_label_location_hints
+
+logger = None
+
+
+def __create_parser_arguments(parser: argparse.ArgumentParser):
+    """Creates the arguments for the parser"""
+    parser.add_argument('trie_path', type=str, help='The path to the trie saved by find')
+    parser.add_argument('-i', '--label-file', type=str,
+                        help='A file with one label per line. '
+                             'If not set the labels are read from the database')
+    parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
+    parser.add_argument('-n', '--label-limit', type=int, default=10**6,
+                        help='The maximum number of labels used')
+    parser.add_argument('-r', '--repetitions', type=int, default=3,
+                        help='The number of runs per backend, the fastest run is reported')
+    parser.add_argument('-b', '--backends', type=str, nargs='+',
+                        default=MatcherBackend.all_values(), choices=MatcherBackend.all_values())
+    parser.add_argument('-l', '--log-file', type=str, default='label-matchers-benchmark.log',
+                        help='Specify a logging file where the log should be saved')
+    parser.add_argument('-ll', '--log-level', type=str, default='INFO',
+                        choices=['NOTSET', 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='Set the preferred log level')
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser()
+    __create_parser_arguments(parser)
+    args = parser.parse_args()
+
+    global logger
+    logger = util.setup_logger(args.log_file, 'label-matchers-benchmark',
+                               loglevel=args.log_level)
+
+    if args.label_file:
+        labels = read_label_file(args.label_file, args.label_limit)
+    else:
+        labels = read_database_labels(args.database_name, args.label_limit)
+
+    logger.info('loaded %s labels with %s characters', len(labels),
+                sum(len(name) for _, name in labels))
+
+    trie = load_trie(args.trie_path)
+    reference_hints = None
+
+    for backend_value in args.backends:
+        backend = MatcherBackend(backend_value)
+
+        start_time = time.perf_counter()
+        matcher = create_label_matcher(backend, trie)
+        build_time = time.perf_counter() - start_time
+
+        best_time = None
+        for _ in range(args.repetitions):
+            search_time, hints, match_count = run_matcher(matcher, labels)
+            if best_time is None or search_time < best_time:
+                best_time = search_time
+
+        if reference_hints is None:
+            reference_hints = hints
+        elif hints != reference_hints:
+            logger.error('%s returned different location hints than %s', backend.value,
+                         args.backends[0])
+
+        logger.info('%s: build %.3f s, search %.3f s (%.0f labels/s), %s matches %s',
+                    backend.value, build_time, best_time, len(labels) / best_time,
+                    sum(match_count.values()), dict(match_count))
+
+
+def read_label_file(label_filepath: str, label_limit: int) -> [(int, str)]:
+    """Reads at most label_limit labels from the file, the line number is used as id"""
+    labels = []
+    with open(label_filepath) as label_file:
+        for line_number, line in enumerate(label_file):
+            if len(labels) >= label_limit:
+                break
+
+            line = line.strip().lower()
+            if line:
+                labels.append((line_number, line))
+
+    return labels
+
+
+def read_database_labels(database_name: str, label_limit: int) -> [(int, str)]:
+    """Reads at most label_limit labels from the domain_labels table"""
+    engine = create_engine(database_name)
+    Session = create_session_for_process(engine)
+    db_session = Session()
+    try:
+        return db_session.query(DomainLabel.id, DomainLabel.name) \
+            .order_by(DomainLabel.id).limit(label_limit).all()
+    finally:
+        db_session.close()
+        Session.remove()
+
+
+def run_matcher(matcher, labels: [(int, str)]):
+    """
+    Searches the location hints in all labels
+    :return: a tuple with the needed time, all location hints and the count per code type
+    """
+    hints = []
+    match_count = collections.defaultdict(int)
+
+    start_time = time.perf_counter()
+    for label_id, name in labels:
+        label_hints, type_count = find_label_location_hints(label_id, name.split('-'), matcher,
+                                                            {})
+        hints.extend(label_hints)
+        for code_type, count in type_count.items():
+            match_count[code_type] += count
+
+    return time.perf_counter() - start_time, hints, match_count
+
+
+if __name__ == '__main__':
+    main()
@@ -17,9 +17,11 @@ import time
 from string import ascii_lowercase, ascii_letters, digits
 from time import sleep
 
+import numpy as np
 import requests
 from html.parser import HTMLParser
 
+from hloc.geo import SpatialIndex
 from hloc.models import LocationInfo, State
 from hloc.util import setup_logger
 from hloc.db_utils import recreate_db, create_session_for_process, create_engine
@@ -493,26 +495,54 @@ def location_merge(location1: LocationInfo, location2: LocationInfo, db_session)
         location1.population = location2.population
 
 
-def merge_locations_to_location(location: LocationInfo, locations: [LocationInfo], radius: int,
-                                db_session, start: int=0):
-    """Merge all locations from the locations list to the location if they are near enough"""
-    near_locations = []
+class LocationMergeStats(object):
+    """Collects the statistics of one merge step"""
 
-    for j in range(start, len(locations)):
-        if location.is_in_radius(locations[j], radius):
-            near_locations.append(locations[j])
+    def __init__(self, name: str):
+        self.name = name
+        self.locations = 0
+        self.merged = 0
+        self.state_conflicts = 0
+        self.remaining = 0
+        self._start_time = time.time()
+
+    def __str__(self):
+        return '{} merge: {} locations, {} merged, {} state conflicts, {} remaining, ' \
+               '{:.1f} seconds'.format(self.name, self.locations, self.merged,
+                                       self.state_conflicts, self.remaining,
+                                       time.time() - self._start_time)
+
+
+def merge_locations_to_location(location: LocationInfo, locations: [LocationInfo],
+                                location_index: SpatialIndex, merged: np.ndarray, radius: int,
+                                db_session, stats: LocationMergeStats, start: int=0):
+    """
+    Merge all locations from the locations list to the location if they are near enough
+    :param location_index: the SpatialIndex over the locations list
+    :param merged: a boolean array marking the locations which were already merged
+    :param start: only locations with an index of at least start are merged
+    """
+    near_indexes, _ = location_index.query_radius(location.lat, location.lon, radius,
+                                                  sort=False)
+    near_indexes = np.sort(near_indexes[near_indexes >= start])
+
+    for j in near_indexes:
+        if merged[j]:
+            continue
 
-    for mloc in near_locations:
         try:
-            location_merge(location, mloc, db_session)
-            locations.remove(mloc)
-            del mloc
+            location_merge(location, locations[j], db_session)
         except ValueError:
+            stats.state_conflicts += 1
             continue
 
+        merged[j] = True
+        stats.merged += 1
+
 
 def add_locations(locations: [LocationInfo], to_add_locations: [LocationInfo], radius: int,
-                  db_session, create_new_locations: bool=True):
+                  db_session, create_new_locations: bool=True, name: str='add') \
+        -> LocationMergeStats:
     """
     The first argument is a list which will not be condensed but the items
     of the second list will be matched on it. the remaining items in add_locations
@@ -523,12 +553,27 @@ def add_locations(locations: [LocationInfo], to_add_locations: [LocationInfo], r
     :param db_session: the database connection object
     :param create_new_locations: Set false if the add_locations are not allowed to
         create new location objects Default is true
+    :param name: the name of the merge step used for the statistics
+    :return: the statistics of the merge
     """
-    for i, location in enumerate(locations):
-        merge_locations_to_location(location, to_add_locations, radius, db_session)
+    stats = LocationMergeStats(name)
+    stats.locations = len(to_add_locations)
+
+    location_index = SpatialIndex.from_objects(to_add_locations)
+    merged = np.zeros(len(to_add_locations), dtype=bool)
+
+    for location in locations:
+        if location.lat is None or location.lon is None:
+            continue
+
+        merge_locations_to_location(location, to_add_locations, location_index, merged, radius,
+                                    db_session, stats)
+
+    to_add_locations[:] = [location for location, is_merged in zip(to_add_locations, merged)
+                           if not is_merged]
 
     if create_new_locations:
-        merge_locations_by_gps(to_add_locations, radius, db_session)
+        merge_locations_by_gps(to_add_locations, radius, db_session, stats=stats)
         locations.extend(to_add_locations)
     else:
         for location in to_add_locations:
@@ -536,22 +581,41 @@ def add_locations(locations: [LocationInfo], to_add_locations: [LocationInfo], r
                 location.state.location_infos.remove(location)
                 location.state = None
 
+    stats.remaining = len(to_add_locations)
+    return stats
 
-def merge_locations_by_gps(locations: [LocationInfo], radius: int, db_session):
+
+def merge_locations_by_gps(locations: [LocationInfo], radius: int, db_session,
+                           stats: LocationMergeStats=None) -> LocationMergeStats:
     """
     this method starts at the beginning and matches all locations which are in a
     range of `radius` kilometers
+    The merged locations are removed from the list
+    :return: the statistics of the merge
     """
-    i = 0
-    while i < len(locations):
-        location = locations[i]
-        i += 1
+    if stats is None:
+        stats = LocationMergeStats('gps')
+        stats.locations = len(locations)
+
+    location_index = SpatialIndex.from_objects(locations)
+    merged = np.zeros(len(locations), dtype=bool)
+
+    for i, location in enumerate(locations):
+        if merged[i]:
+            continue
+
         lat_is_none = location.lat is None
         lon_is_none = location.lon is None
         if lat_is_none or lon_is_none:
             continue
 
-        merge_locations_to_location(location, locations, radius, db_session, start=i)
+        merge_locations_to_location(location, locations, location_index, merged, radius,
+                                    db_session, stats, start=i + 1)
+
+    locations[:] = [location for location, is_merged in zip(locations, merged) if not is_merged]
+
+    stats.remaining = len(locations)
+    return stats
 
 
 def state_for_code(state_code, state_name):
@@ -610,7 +674,8 @@ def merge_location_codes(merge_radius, db_session):
         location_codes = sorted(GEONAMES_LOCATION_CODES,
                                 key=lambda location: location.population,
                                 reverse=True)
-        merge_locations_by_gps(location_codes, merge_radius, db_session)
+        merge_stats = merge_locations_by_gps(location_codes, merge_radius, db_session)
+        logger.info(merge_stats)
 
         locodes = sorted(LOCODE_LOCATION_CODES, key=lambda location: location.city_name)
         airport_codes = sorted(AIRPORT_LOCATION_CODES, key=lambda location: location.city_name)
@@ -618,12 +683,17 @@ def merge_location_codes(merge_radius, db_session):
         # add_locations(location_codes, geo_codes)
 
         logger.info('geonames merged:{}'.format(len(location_codes)))
-        add_locations(location_codes, locodes, merge_radius, db_session, create_new_locations=False)
+        merge_stats = add_locations(location_codes, locodes, merge_radius, db_session,
+                                    create_new_locations=False, name='locode')
+        logger.info(merge_stats)
         logger.info('locode merged:{}'.format(len(location_codes)))
-        add_locations(location_codes, airport_codes, merge_radius, db_session)
+        merge_stats = add_locations(location_codes, airport_codes, merge_radius, db_session,
+                                    name='airport')
+        logger.info(merge_stats)
         logger.info('air merged: {}'.format(len(location_codes)))
-        add_locations(location_codes, clli_codes, merge_radius, db_session,
-                      create_new_locations=False)
+        merge_stats = add_locations(location_codes, clli_codes, merge_radius, db_session,
+                                    create_new_locations=False, name='clli')
+        logger.info(merge_stats)
         logger.info('clli merged:{}'.format(len(location_codes)))
 
     else:
@@ -696,11 +766,16 @@ def parse_codes(args):
                     metropolitan_locations = parse_metropolitan_codes(args.metropolitan_file,
                                                                       db_session)
                     if args.merge_radius:
-                        add_locations(AIRPORT_LOCATION_CODES, metropolitan_locations, 
-                                      args.merge_radius, db_session, create_new_locations=False)
+                        merge_stats = add_locations(AIRPORT_LOCATION_CODES,
+                                                    metropolitan_locations, args.merge_radius,
+                                                    db_session, create_new_locations=False,
+                                                    name='metropolitan')
                     else:
-                        add_locations(AIRPORT_LOCATION_CODES, metropolitan_locations, 100,
-                                      db_session, create_new_locations=False)
+                        merge_stats = add_locations(AIRPORT_LOCATION_CODES,
+                                                    metropolitan_locations, 100, db_session,
+                                                    create_new_locations=False,
+                                                    name='metropolitan')
+                    logger.info(merge_stats)
 
             if args.locode:
                 parse_locode_codes(args.locode, db_session)
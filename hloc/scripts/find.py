@@ -5,24 +5,35 @@
  * Can use 3 types of blacklist to exclude unlikely matches
 """
 
-import marisa_trie
-
+import array
 import collections
 import configargparse
 import datetime
 import json
 import multiprocessing as mp
+import os
 import queue
 import threading
 import typing
 
-from hloc import util
-from hloc.db_utils import get_all_domain_labels, create_session_for_process, \
-    create_engine
-from hloc.models import CodeMatch, Location, LocationCodeType, DomainLabel, LocationInfo
+from hloc import util, constants
+from hloc.db_utils import stream_domain_label_batches, create_session_for_process, \
+    create_engine, create_domain_label_indexes, domain_labels_to_search_filter, \
+    mark_domain_labels_searched, allocate_ids, copy_rows
+from hloc.domain_processing_helper.location_trie import get_trie_artifact, load_trie, \
+    changed_codes, read_find_state, write_find_state
+from hloc.domain_processing_helper.match_channel import LocationMatchBatcher, \
+    decode_deleted_label_ids, decode_hints
+from hloc.domain_processing_helper.label_matcher import LabelMatcher, MatcherBackend, \
+    create_label_matcher
+from hloc.models import CodeMatch, LocationCodeType, DomainLabel, LocationHint
 from hloc.models.location import location_hint_label_table
 
-from sqlalchemy import update
+from sqlalchemy import update, or_
+
+CODE_MATCH_HINT_TYPE = CodeMatch.__mapper_args__['polymorphic_identity']
+# the number of matches collected before they are written with COPY
+COPY_BATCH_SIZE = 10 ** 5
 
 logger = None
 engine = None
@@ -42,6 +53,23 @@ def __create_parser_arguments(parser):
     parser.add_argument('-n', '--domain-block-limit', type=int, default=1000,
                         help='The number of domains taken per block to process them')
     parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
+    parser.add_argument('-t', '--trie-cache-dir', type=str, default=constants.TRIE_CACHING_DIR,
+                        help='The directory where the built tries are saved')
+    parser.add_argument('--build-trie-only', action='store_true',
+                        help='Only build and save the trie without searching the domain labels')
+    parser.add_argument('--rebuild-trie', action='store_true',
+                        help='Rebuild the trie even if a saved one for the current locations and '
+                             'blacklists exists')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only search labels which were never searched and labels containing'
+                             ' codes which changed since the last run. Changes in the code to '
+                             'location blacklist file need a full run')
+    parser.add_argument('--max-changed-codes', type=int, default=10**4,
+                        help='The incremental mode searches all labels if more codes changed')
+    parser.add_argument('-m', '--matcher-backend', type=str, default=MatcherBackend.marisa.value,
+                        choices=MatcherBackend.all_values(),
+                        help='The backend used to search the location codes in the labels. '
+                             'aho-corasick needs the pyahocorasick package')
     parser.add_argument('-l', '--logging-file', type=str, default='find_trie.log',
                         help='Specify a logging file where the log should be saved')
     parser.add_argument('-ll', '--log-level', type=str, default='INFO', dest='log_level',
@@ -62,7 +90,18 @@ def main():
     global engine
     engine = create_engine(args.database_name)
 
-    trie = create_trie(args.code_blacklist_file, args.word_blacklist_file)
+    Session = create_session_for_process(engine)
+    db_session = Session()
+    try:
+        trie_path = get_trie_artifact(db_session, args.trie_cache_dir, args.code_blacklist_file,
+                                      args.word_blacklist_file, force_rebuild=args.rebuild_trie)
+    finally:
+        db_session.close()
+        Session.remove()
+
+    if args.build_trie_only:
+        logger.info('saved trie to %s', trie_path)
+        return
 
     code_to_location_blacklist = {}
     if args.code_to_location_blacklist_file:
@@ -74,6 +113,13 @@ def main():
                     json_txt += line
             code_to_location_blacklist = json.loads(json_txt)
 
+    search_codes = None
+    if args.incremental:
+        search_codes = get_incremental_search_codes(args.trie_cache_dir, trie_path,
+                                                    args.max_changed_codes)
+        if search_codes is not None:
+            create_domain_label_indexes(engine)
+
     location_match_queue = mp.Queue()
     stop_event = threading.Event()
     handle_location_matches_thread = threading.Thread(target=handle_location_matches,
@@ -81,106 +127,136 @@ def main():
                                                       args=(location_match_queue, stop_event))
     handle_location_matches_thread.start()
 
+    label_batch_queue = mp.Queue(maxsize=2 * args.number_processes)
+
     processes = []
     for index in range(0, args.number_processes):
         process = mp.Process(target=search_process,
-                             args=(index, trie, code_to_location_blacklist,
-                                   args.domain_block_limit, args.number_processes,
+                             args=(index, trie_path, code_to_location_blacklist,
+                                   args.domain_block_limit, label_batch_queue,
                                    location_match_queue),
-                             kwargs={'amount': args.amount, 'debug': args.log_level == 'DEBUG'},
+                             kwargs={'matcher_backend': MatcherBackend(args.matcher_backend),
+                                     'mark_searched': search_codes is not None},
                              name='find_locations_{}'.format(index))
         process.start()
         processes.append(process)
 
+    if search_codes is not None:
+        label_filter = domain_labels_to_search_filter(search_codes)
+    elif args.incremental:
+        # the saved trie marks all labels as searched with it, so none may be skipped
+        label_filter = None
+    else:
+        if args.log_level == 'DEBUG':
+            last_search = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        else:
+            last_search = datetime.datetime.now() - datetime.timedelta(days=7)
+        label_filter = or_(DomainLabel.last_searched.is_(None),
+                           DomainLabel.last_searched <= last_search)
+
+    produce_label_batches(label_batch_queue, label_filter, args.domain_block_limit,
+                          args.number_processes, args.amount * args.number_processes)
+
     for process in processes:
         process.join()
 
-    Session = create_session_for_process(engine)
-    db_session = Session()
-    update_query = update(DomainLabel).values(last_searched=datetime.datetime.now())
-    db_session.execute(update_query)
-    db_session.close()
+    if search_codes is None:
+        # the search processes of the incremental mode mark the labels they searched
+        Session = create_session_for_process(engine)
+        db_session = Session()
+        update_query = update(DomainLabel).values(last_searched=datetime.datetime.now())
+        db_session.execute(update_query)
+        db_session.commit()
+        db_session.close()
 
     stop_event.set()
     handle_location_matches_thread.join()
     location_match_queue.join_thread()
 
+    if args.incremental and not args.amount:
+        write_find_state(args.trie_cache_dir, trie_path)
+    else:
+        # labels skipped by the last searched filter or the amount were not searched with this
+        # trie so the next incremental run must not diff against it
+        logger.info('not saving the find state of a run which did not search all labels')
+
 
-def create_trie(code_blacklist_filepath: str, word_blacklist_filepath: str):
+def produce_label_batches(label_batch_queue: mp.Queue, label_filter, batch_size: int,
+                          nr_processes: int, amount: int):
     """
-    Creates a RecordTrie with the marisa library
-    :param code_blacklist_filepath: the path to the code blacklist file
-    :param word_blacklist_filepath: the path to the word blacklist file
-    :rtype: marisa_trie.RecordTrie
+    Streams the labels to search with one server side cursor to the search processes
+    A batch is a tuple with an array of the label ids, the newline separated label names and
+    a bytes object which is 1 for every label searched before
+    Puts one None per search process after the last batch
     """
     Session = create_session_for_process(engine)
     db_session = Session()
+    label_count = 0
     try:
-        locations = db_session.query(LocationInfo)
-
-        code_blacklist_set = set()
-        if code_blacklist_filepath:
-            with open(code_blacklist_filepath) as code_blacklist_file:
-                for line in code_blacklist_file:
-                    line = line.strip()
-                    if line[0] != '#':
-                        code_blacklist_set.add(line)
-
-        word_blacklist_set = set()
-        if word_blacklist_filepath:
-            with open(word_blacklist_filepath) as word_blacklist_file:
-                for line in word_blacklist_file:
-                    line = line.strip()
-                    if line[0] != '#':
-                        word_blacklist_set.add(line)
-
-        return create_trie_obj(locations, code_blacklist_set, word_blacklist_set)
+        for label_batch in stream_domain_label_batches(batch_size, db_session,
+                                                       label_filter=label_filter,
+                                                       limit=amount):
+            label_ids, label_names, searched_before = zip(*label_batch)
+            label_batch_queue.put((array.array('q', label_ids), '\n'.join(label_names),
+                                   bytes(searched_before)))
+            label_count += len(label_batch)
     finally:
+        for _ in range(nr_processes):
+            label_batch_queue.put(None)
         db_session.close()
         Session.remove()
 
+    logger.info('streamed %s labels to the search processes', label_count)
 
-def create_trie_obj(location_list: [Location], code_blacklist: {str}, word_blacklist: {str}):
+
+def get_incremental_search_codes(trie_cache_dir: str, trie_path: str, max_changed_codes: int) \
+        -> typing.Optional[typing.List[str]]:
     """
-    Creates a RecordTrie with the marisa library
-    :param location_list: a list with all locations
-    :param code_blacklist: a list with all codes to blacklist
-    :param word_blacklist: a list with all words which should be blacklisted
-    :rtype: marisa_trie.RecordTrie
+    Compares the trie with the one of the last completed run
+    :return: the codes which changed since the last run or None if all labels must be searched
     """
-    code_id_type_tuples = []
-    for location in location_list:
-        code_id_type_tuples.extend(location.code_id_type_tuples())
-
-    code_id_type_tuples = [code_tuple for code_tuple in code_id_type_tuples
-                           if code_tuple[0] not in code_blacklist and
-                           code_tuple[0] not in word_blacklist and
-                           len(code_tuple[0]) > 2]
+    find_state = read_find_state(trie_cache_dir)
+    if find_state is None or not os.path.isfile(find_state['trie_path']):
+        logger.warning('no trie of a previous run found, searching all labels')
+        return None
 
-    for code in word_blacklist:
-        code_id_type_tuples.append((code, ('0'*32, -1)))
+    if find_state['trie_path'] == trie_path:
+        logger.info('trie unchanged since %s, searching only new labels', find_state['finished'])
+        return []
 
-    encoded_tuples = [(code, (uid.encode(), code_type))
-                      for code, (uid, code_type) in code_id_type_tuples]
+    codes = changed_codes(load_trie(find_state['trie_path']), load_trie(trie_path))
+    if len(codes) > max_changed_codes:
+        logger.warning('%s codes changed since the last run, searching all labels', len(codes))
+        return None
 
-    return marisa_trie.RecordTrie('<32sh', encoded_tuples)
+    logger.info('%s codes changed since %s', len(codes), find_state['finished'])
+    return sorted(codes)
 
 
 def handle_location_matches(location_match_queue: mp.Queue, stop_event: threading.Event):
+    """
+    Saves the location hints found by the search processes
+    The hints and their label links are written with COPY and the ids of new hints are
+    allocated from the sequence of the location_hints table in blocks
+    """
     class LocationMatch:
-        def __init__(self, location_hint):
+        __slots__ = ['id', 'location_code', 'location_code_type', 'location_id',
+                     'domain_label_ids', 'old_domain_label_ids']
+
+        def __init__(self, location_id, location_code, location_code_type):
             self.id = 0
-            self.location_hint = location_hint
-            self.location_code = location_hint.code
-            self.location_code_type = location_hint.code_type
-            self.location_id = location_hint.location_id
+            self.location_code = location_code
+            self.location_code_type = location_code_type
+            self.location_id = location_id
             self.domain_label_ids = set()
             self.old_domain_label_ids = set()
 
-        def get_insert_values(self):
-            return [{'location_hint_id': self.id,
-                     'domain_label_id': domain_label_id}
-                    for domain_label_id in self.domain_label_ids]
+        def get_insert_rows(self):
+            return [(self.id, domain_label_id) for domain_label_id in self.domain_label_ids]
+
+        def get_hint_row(self):
+            return (self.id, self.location_id, CODE_MATCH_HINT_TYPE,
+                    LocationCodeType(self.location_code_type), self.location_code)
 
         def add_domain_label_id(self, domain_label_id):
             if domain_label_id not in self.domain_label_ids and \
@@ -200,22 +276,24 @@ def handle_location_matches(location_match_queue: mp.Queue, stop_event: threadin
 
     def save(matches_to_save, new_matches, db_sess):
         if new_matches:
-            db_sess.bulk_save_objects([match.location_hint for match in new_matches],
-                                      return_defaults=True)
-            for new_match in new_matches:
-                new_match.id = new_match.location_hint.id
+            new_ids = allocate_ids(LocationHint.__table__, len(new_matches), db_sess)
+            for new_match, new_id in zip(new_matches, new_ids):
+                new_match.id = new_id
 
-        insert_values = []
+            copy_rows(LocationHint.__table__,
+                      ['id', 'location_id', 'hint_type', 'code_type', 'code'],
+                      (new_match.get_hint_row() for new_match in new_matches), db_sess)
+
+        insert_rows = []
         for match in matches_to_save:
-            insert_values.extend(match.get_insert_values())
+            insert_rows.extend(match.get_insert_rows())
             match.handled_domains()
 
         new_matches.clear()
         matches_to_save.clear()
 
-        if insert_values:
-            insert_expr = location_hint_label_table.insert().values(insert_values)
-            db_sess.execute(insert_expr)
+        copy_rows(location_hint_label_table, ['location_hint_id', 'domain_label_id'],
+                  insert_rows, db_sess)
 
     Session = create_session_for_process(engine)
     db_session = Session()
@@ -228,41 +306,40 @@ def handle_location_matches(location_match_queue: mp.Queue, stop_event: threadin
 
     while not (stop_event.is_set() and location_match_queue.empty()):
         try:
-            location_matches_tuples = location_match_queue.get(timeout=1)
-            if isinstance(location_matches_tuples, int):
+            location_match_batch = location_match_queue.get(timeout=1)
+
+            deleted_label_ids = decode_deleted_label_ids(location_match_batch)
+            if deleted_label_ids:
                 delete_expr = location_hint_label_table.delete().where(
-                    'location_hint_labels.domain_label_id' == location_matches_tuples)
+                    location_hint_label_table.c.domain_label_id.in_(deleted_label_ids))
                 db_session.execute(delete_expr)
-                logger.debug('saving for {}'.format(location_matches_tuples))
-            else:
-                for location_id, location_code, location_code_type, domain_label_id in \
-                        location_matches_tuples:
-                    location_hint_key = make_location_hint_key(location_id, location_code,
-                                                               location_code_type)
-                    try:
-                        location_hint = location_hints[location_hint_key]
-                    except KeyError:
-                        real_code_type = LocationCodeType(location_code_type)
-                        location_hint_obj = CodeMatch(location_id, code_type=real_code_type,
-                                                      domain_label=None, code=location_code)
-                        db_session.add(location_hint_obj)
-                        location_hint = LocationMatch(location_hint_obj)
-                        location_hints[location_hint_key] = location_hint
-                        new_matches.append(location_hint)
-
-                    matches_to_save.add(location_hint)
-                    location_hint.add_domain_label_id(domain_label_id)
-
-                    counter += 1
-                    if counter >= 10 ** 4:
-                        logger.debug('saving')
-                        save(matches_to_save, new_matches, db_session)
-                        counter = 0
-
-                        ccounter += 1
-                        if ccounter >= 10:
-                            db_session.commit()
-                            ccounter = 0
+                logger.debug('deleted the hints of %s labels', len(deleted_label_ids))
+
+            for location_id, location_code, location_code_type, domain_label_id in \
+                    decode_hints(location_match_batch):
+                location_hint_key = make_location_hint_key(location_id, location_code,
+                                                           location_code_type)
+                try:
+                    location_hint = location_hints[location_hint_key]
+                except KeyError:
+                    location_hint = LocationMatch(location_id, location_code,
+                                                  location_code_type)
+                    location_hints[location_hint_key] = location_hint
+                    new_matches.append(location_hint)
+
+                matches_to_save.add(location_hint)
+                location_hint.add_domain_label_id(domain_label_id)
+
+                counter += 1
+                if counter >= COPY_BATCH_SIZE:
+                    logger.debug('saving')
+                    save(matches_to_save, new_matches, db_session)
+                    counter = 0
+
+                    ccounter += 1
+                    if ccounter >= 10:
+                        db_session.commit()
+                        ccounter = 0
 
         except queue.Empty:
             pass
@@ -275,13 +352,16 @@ def handle_location_matches(location_match_queue: mp.Queue, stop_event: threadin
     logger.info('stopped')
 
 
-def search_process(index, trie, code_to_location_blacklist, limit, nr_processes,
-                   location_match_queue, amount=1000, debug: bool=False):
+def search_process(index, trie_path, code_to_location_blacklist, limit,
+                   label_batch_queue: mp.Queue, location_match_queue: mp.Queue,
+                   matcher_backend: MatcherBackend=MatcherBackend.marisa,
+                   mark_searched: bool=False):
     """
-    for all amount=0
+    Searches the labels of the batches in label_batch_queue until it receives None
+    The trie is memory mapped from trie_path so all processes share its pages
+    If mark_searched is set the searched labels are marked as searched
     """
-    Session = create_session_for_process(engine)
-    db_session = Session()
+    matcher = create_label_matcher(matcher_backend, load_trie(trie_path))
 
     match_count = collections.defaultdict(int)
     entries_count = 0
@@ -289,54 +369,46 @@ def search_process(index, trie, code_to_location_blacklist, limit, nr_processes,
     entries_wl_count = 0
     label_wl_count = 0
     label_length = 0
+    searched_label_ids = array.array('q')
+    search_start = datetime.datetime.now()
+    location_match_batcher = LocationMatchBatcher(location_match_queue)
 
-    if debug:
-        last_search = datetime.datetime.now() - datetime.timedelta(minutes=1)
-    else:
-        last_search = datetime.datetime.now() - datetime.timedelta(days=7)
-
-    for domain_label in get_all_domain_labels(index,
-                                              block_limit=limit,
-                                              nr_processes=nr_processes,
-                                              db_session=db_session):
-        label_count += 1
-        label_length += len(domain_label.name)
-
-        if domain_label.last_searched:
-            if domain_label.last_searched > last_search:
-                if domain_label.hints:
-                    label_wl_count += 1
+    while True:
+        label_batch = label_batch_queue.get()
+        if label_batch is None:
+            break
 
-                continue
-            else:
-                location_match_queue.put(domain_label.id)
+        label_ids, label_names, searched_before = label_batch
+        for label_id, label_name, label_searched in zip(label_ids, label_names.split('\n'),
+                                                        searched_before):
+            label_count += 1
+            label_length += len(label_name)
 
-        pm_count = collections.defaultdict(int)
+            if label_searched:
+                location_match_batcher.delete_label_hints(label_id)
 
-        temp_gr_count = search_in_label(domain_label, trie, code_to_location_blacklist,
-                                        location_match_queue)
+            temp_gr_count = search_in_label(label_id, label_name, matcher,
+                                            code_to_location_blacklist, location_match_batcher)
 
-        for key, value in temp_gr_count.items():
-            match_count[key] += value
-            pm_count[key] += value
+            for key, value in temp_gr_count.items():
+                match_count[key] += value
 
-        if temp_gr_count:
-            label_wl_count += 1
+            if temp_gr_count:
+                label_wl_count += 1
 
-        entries_count += 1
+            entries_count += 1
 
-        if entries_count == amount:
-            break
+        if mark_searched:
+            searched_label_ids.extend(label_ids)
 
-        if entries_count == amount:
-            break
+    location_match_batcher.flush()
 
     def build_stat_string_for_logger():
         """
         Builds a string for the final output
         :returns str: a string with a lot of logging info
         """
-        stats_string = 'Stats for this process following:'
+        stats_string = 'Stats for process {} following:'.format(index)
         stats_string += '\n\ttotal entries: {}'.format(entries_count)
         stats_string += '\n\ttotal labels: {}'.format(label_count)
         stats_string += '\n\ttotal label length: {}'.format(label_length)
@@ -348,28 +420,54 @@ def search_process(index, trie, code_to_location_blacklist, limit, nr_processes,
 
     logger.info(build_stat_string_for_logger())
 
-    db_session.close()
-    Session.remove()
+    if searched_label_ids:
+        Session = create_session_for_process(engine)
+        db_session = Session()
+        for start in range(0, len(searched_label_ids), limit):
+            mark_domain_labels_searched(searched_label_ids[start:start + limit], db_session,
+                                        searched_time=search_start)
+        db_session.commit()
+        db_session.close()
+        Session.remove()
+
     location_match_queue.close()
 
 
-def search_in_label(label_obj: DomainLabel, trie: marisa_trie.RecordTrie, special_filter,
-                    location_match_queue: mp.Queue) \
+def search_in_label(label_id: int, label_name: str, matcher: LabelMatcher, special_filter,
+                    location_match_batcher: LocationMatchBatcher) \
         -> typing.DefaultDict[LocationCodeType, int]:
     """returns all matches for this label"""
+    location_hint_tuples, type_count = find_label_location_hints(
+        label_id, label_name.split('-'), matcher, special_filter)
+
+    if location_hint_tuples:
+        location_match_batcher.add_hints(location_hint_tuples)
+
+    return type_count
+
+
+def find_label_location_hints(label_id: int, sub_labels: [str], matcher: LabelMatcher,
+                              special_filter) \
+        -> typing.Tuple[typing.List[typing.Tuple[str, str, int, int]],
+                        typing.DefaultDict[LocationCodeType, int]]:
+    """
+    Searches all location codes in the sub labels of a domain label
+    :param label_id: the id of the domain label
+    :param sub_labels: the sub labels of the domain label
+    :param matcher: the matcher backend over the location codes
+    :param special_filter: the code to location blacklist
+    :return: a tuple with the (location_id, code, code_type, label_id) tuples and the count per
+             code type
+    """
     ids = set()
     type_count = collections.defaultdict(int)
 
     location_hint_tuples = []
 
-    for o_label in label_obj.sub_labels:
-        label = o_label[:]
+    for o_label in sub_labels:
         blacklisted = []
 
-        while label:
-            matching_keys = trie.prefixes(label)
-            matching_keys.sort(key=len, reverse=True)
-
+        for _, matching_keys in matcher.matches_by_start(o_label):
             for key in matching_keys:
                 if [black_word for black_word in blacklisted if key in black_word]:
                     continue
@@ -379,7 +477,7 @@ def search_in_label(label_obj: DomainLabel, trie: marisa_trie.RecordTrie, specia
                          if black_word in o_label]:
                     continue
 
-                matching_locations = trie[key]
+                matching_locations = matcher.records(key)
                 if [code_type for _, code_type in matching_locations if code_type == -1]:
                     blacklisted.append(key)
                     continue
@@ -390,14 +488,10 @@ def search_in_label(label_obj: DomainLabel, trie: marisa_trie.RecordTrie, specia
                         continue
 
                     location_hint_tuples.append((location_id.decode(), key, code_type,
-                                                 label_obj.id))
+                                                 label_id))
                     type_count[real_code_type] += 1
 
-            label = label[1:]
-
-    location_match_queue.put(location_hint_tuples)
-
-    return type_count
+    return location_hint_tuples, type_count
 
 
 if __name__ == '__main__':
@@ -7,8 +7,9 @@ import argparse
 import datetime
 
 from hloc import util
-from hloc.models import MeasurementResult
-from hloc.db_utils import create_engine, create_session_for_process
+from hloc.models import MinRttMeasurement
+from hloc.db_utils import create_engine, create_session_for_process, min_rtt_table_exists, \
+    rebuild_min_rtt_measurements, drop_measurement_partitions
 
 
 logger = None
@@ -20,6 +21,8 @@ def __create_parser_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('--days-in-past', type=int, default=90,
                         help='The number of days in the past for which measurements will not be deleted')
     parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
+    parser.add_argument('--detach-only', action='store_true',
+                        help='Only detach the expired partitions and keep them as tables')
     parser.add_argument('-l', '--logging-file', type=str, default='delete-measurements.log',
                         help='Specify a logging file where the log should be saved')
     parser.add_argument('-ll', '--log-level', type=str, default='INFO',
@@ -39,11 +42,21 @@ def main():
     global engine
     engine = create_engine(args.database_name)
 
+    oldest_date_allowed = datetime.date.today() - datetime.timedelta(days=args.days_in_past)
+    removed_partitions = drop_measurement_partitions(
+        engine, datetime.datetime.combine(oldest_date_allowed, datetime.time()),
+        detach_only=args.detach_only)
+    logger.info('%s partitions %s', 'detached' if args.detach_only else 'dropped',
+                ', '.join(removed_partitions))
+
     Session = create_session_for_process(engine)
     db_session = Session()
 
-    oldest_date_allowed = datetime.date.today() - datetime.timedelta(days=args.days_in_past)
-    db_session.query(MeasurementResult).filter(MeasurementResult.timestamp < oldest_date_allowed).delete()
+    # replace the deleted minima with the minima of the remaining measurements
+    if min_rtt_table_exists(engine):
+        db_session.query(MinRttMeasurement).filter(
+            MinRttMeasurement.timestamp < oldest_date_allowed).delete()
+        rebuild_min_rtt_measurements(db_session)
 
     db_session.commit()
     db_session.close()
@@ -6,11 +6,11 @@ Parse and store RIPE Atlas probes locally for caching purposes
 import argparse
 import json
 import os
-import threading
 
 from hloc.db_utils import create_session_for_process, create_engine
-from hloc.util import start_token_generating_thread, setup_logger
+from hloc.util import setup_logger
 from hloc.ripe_helper.probe_helper import get_probes
+from hloc.ripe_helper.rate_limiter import RipeEndpoint, RipeRateLimiters, RateLimitBackendType
 from hloc.constants import PROBE_CACHING_PATH
 
 
@@ -22,6 +22,9 @@ def __create_parser_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('database_name', type=str, help='name of the database')
     parser.add_argument('-r', '--ripe-requests-per-second', type=int, default=20,
                         help='specify the of requests per second to RIPE')
+    parser.add_argument('--rate-limit-file', type=str,
+                        help='Share the RIPE request limit with all processes using this SQLite '
+                             'file (e.g. the --rate-limit-file of validate)')
     parser.add_argument('-l', '--logging-file', type=str, default='ripe-archive-import.log',
                         help='Specify a logging file where the log should be saved')
     parser.add_argument('-ll', '--log-level', type=str, default='INFO',
@@ -42,14 +45,13 @@ def main():
     Session = create_session_for_process(engine)
     db_session = Session()
 
-    ripe_sema = threading.BoundedSemaphore(50)
-    stop_event = threading.Event()
-    token_generator_thread = start_token_generating_thread(ripe_sema, args.ripe_requests_per_second,
-                                                           stop_event)
-    probes = get_probes(db_session, ripe_sema)
-
-    stop_event.set()
-    token_generator_thread.join()
+    if args.rate_limit_file:
+        backend_type = RateLimitBackendType.sqlite
+    else:
+        backend_type = RateLimitBackendType.local
+    ripe_rate_limiters = RipeRateLimiters.create(backend_type, args.ripe_requests_per_second, 50,
+                                                 db_path=args.rate_limit_file)
+    probes = get_probes(db_session, ripe_rate_limiters[RipeEndpoint.probes])
 
     log.info('writing probes to tmp')
 
@@ -19,7 +19,8 @@ import threading
 import typing
 
 from hloc import util
-from hloc.db_utils import create_session_for_process, location_for_iata_code, create_engine
+from hloc.db_utils import create_session_for_process, location_for_iata_code, create_engine, \
+    create_min_rtt_table, save_measurement_results, create_measurement_partitions
 from hloc.models import CaidaArkProbe, CaidaArkMeasurementResult, LocationInfo
 
 
@@ -39,6 +40,10 @@ def __create_parser_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('--days-in-past', type=int, default=30,
                         help='The number of days in the past for which parsing will be done')
     parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
+    parser.add_argument('--create-min-rtt-table', action='store_true',
+                        help='Create the table with the minimal rtt per destination, probe and '
+                             'measurement type if it does not exist. Once it exists every '
+                             'import merges its results into it')
     parser.add_argument('-l', '--logging-file', type=str, default='caida-archive-parsing.log',
                         help='Specify a logging file where the log should be saved')
     parser.add_argument('-ll', '--log-level', type=str, default='INFO',
@@ -64,6 +69,12 @@ def main():
     global engine
     engine = create_engine(args.database_name)
 
+    create_measurement_partitions(
+        engine, datetime.datetime.now() - datetime.timedelta(days=args.days_in_past))
+
+    if args.create_min_rtt_table:
+        create_min_rtt_table(engine)
+
     Session = create_session_for_process(engine)
     db_session = Session()
 
@@ -90,7 +101,8 @@ def main():
     with concurrent.ProcessPoolExecutor(max_workers=args.number_processes) as processing_executor:
         processing_results = processing_executor.map(
             functools.partial(parse_caida_data, not args.plaintext, args.days_in_past,
-                              probe_dct, new_parsed_files), filenames)
+                              probe_dct, new_parsed_files),
+            filenames)
 
         try:
             while True:
@@ -219,7 +231,7 @@ def parse_caida_data(bz2_compressed: bool, days_in_past: int, probe_id_dct: typi
         for probe_measurement_dct in measurements.values():
             measurement_results.extend(probe_measurement_dct.values())
 
-        db_session.bulk_save_objects(measurement_results)
+        save_measurement_results(measurement_results, db_session)
         logger.info('parsed and saved %s measurements', len(measurement_results))
         db_session.commit()
 
@@ -5,32 +5,39 @@ Parse data from the ripe archive files
 
 import argparse
 import collections
-import concurrent.futures as concurrent
 import datetime
 import enum
-import functools
 import ipaddress
-import mmap
 import multiprocessing as mp
 import os
 import queue
 import re
-import subprocess
 import sys
 import threading
-import time
+import types
 import typing
-import ujson as json
+import zlib
 
 from hloc import util
-from hloc.db_utils import create_session_for_process, create_engine
+from hloc.db_utils import create_session_for_process, create_engine, allocate_ids, copy_rows, \
+    create_min_rtt_table, min_rtt_table_exists, save_measurement_results, \
+    upsert_min_rtt_measurements, create_measurement_partitions
 from hloc.models import RipeMeasurementResult, RipeAtlasProbe, MeasurementProtocol, \
     MeasurementError, MeasurementResult
 from hloc.ripe_helper.history_helper import load_probes_from_cache
+from hloc.ripe_helper.archive_helper import read_archive_results
 
 logger = None
 engine = None
-buffer_lines_per_process = 10000
+batches_per_process = 4
+COPY_BATCH_SIZE = 10**5
+# the column order of the rows aggregated in the map-reduce mode
+MEASUREMENT_ROW_COLUMNS = ['probe_id', 'timestamp', 'destination_address', 'source_address',
+                           'error_msg', 'rtt', 'ttl', 'protocol', 'behind_nat',
+                           'from_traceroute', 'measurement_result_type', 'ripe_measurement_id']
+__ROW_PROBE_ID_INDEX = 0
+__ROW_DESTINATION_INDEX = 2
+__ROW_RTT_INDEX = 5
 
 
 def __create_parser_arguments(parser: argparse.ArgumentParser):
@@ -45,7 +52,24 @@ def __create_parser_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('--days-in-past', type=int, default=30,
                         help='The number of days in the past for which parsing will be done')
     parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
-    parser.add_argument('-w', '--workers', type=int, default=2, help='Number of read workers')
+    parser.add_argument('-w', '--workers', type=int, default=2,
+                        help='Number of read processes decompressing and filtering the files')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000,
+                        help='Number of filtered results sent to the parse processes at once')
+    parser.add_argument('--map-reduce', action='store_true',
+                        help='Every parse process reads whole files and keeps only the minimal '
+                             'result per destination and probe. The partial minima are merged '
+                             'by reduce processes partitioned by destination and bulk loaded')
+    parser.add_argument('--reduce-processes', type=int,
+                        help='Number of reduce processes in the map-reduce mode '
+                             '(default: number of processes)')
+    parser.add_argument('--spill-size', type=int, default=10**6,
+                        help='Number of minima a map process keeps before sending them to the '
+                             'reduce processes')
+    parser.add_argument('--create-min-rtt-table', action='store_true',
+                        help='Create the table with the minimal rtt per destination, probe and '
+                             'measurement type if it does not exist. Once it exists every '
+                             'import merges its results into it')
     parser.add_argument('-l', '--logging-file', type=str, default='ripe-archive-import.log',
                         help='Specify a logging file where the log should be saved')
     parser.add_argument('-ll', '--log-level', type=str, default='INFO',
@@ -69,6 +93,12 @@ def main():
     global engine
     engine = create_engine(args.database_name)
 
+    create_measurement_partitions(
+        engine, datetime.datetime.now() - datetime.timedelta(days=args.days_in_past))
+
+    if args.create_min_rtt_table:
+        create_min_rtt_table(engine)
+
     parsed_file_name = '{}-parsed-ripe-files.txt'.format(args.database_name)
     parsed_files = set()
 
@@ -108,59 +138,288 @@ def main():
                                             name='update probe latency')
     probe_latency_thread.start()
 
+    try:
+        if args.map_reduce:
+            import_map_reduce(args, file_names, probe_dct, probe_latency_queue, new_parsed_files)
+        else:
+            import_pipelined(args, file_names, probe_dct, probe_latency_queue, new_parsed_files)
+    finally:
+        with open(parsed_file_name, 'a') as parsed_files_histoy_file:
+            while not new_parsed_files.empty():
+                filename = new_parsed_files.get()
+                parsed_files_histoy_file.write(filename + '\n')
+
+    finish_event.set()
+    logger.debug('finish event set waiting for second hop latency thread')
+
+    probe_latency_thread.join()
+
+
+def __create_file_queue(file_names: [str], number_readers: int) -> mp.Queue:
+    file_queue = mp.Queue()
+    for file_name in file_names:
+        file_queue.put(file_name)
+    for _ in range(number_readers):
+        file_queue.put(None)
+
+    return file_queue
+
+
+def import_pipelined(args, file_names: [str], probe_dct: typing.Dict[int, RipeAtlasProbe],
+                     probe_latency_queue: mp.Queue, new_parsed_files: mp.Queue):
+    """
+    Read processes send the filtered results of the files to the parse processes
+    The minimal result per destination and probe is only computed per parse process
+    """
     finished_reading_event = mp.Event()
+    file_queue = __create_file_queue(file_names, args.workers)
+    result_batch_queue = mp.Queue(args.number_processes * batches_per_process)
+
+    read_processes = []
+    for index in range(0, args.workers):
+        process = mp.Process(target=read_files, args=(
+            file_queue, not args.plaintext, args.days_in_past, result_batch_queue,
+            new_parsed_files, args.batch_size), name='ripe-reading-{}'.format(index))
+        read_processes.append(process)
+        process.start()
+
+    processes = []
+
+    for index in range(0, args.number_processes):
+        process = mp.Process(target=parse_ripe_data, args=(
+            result_batch_queue, finished_reading_event, probe_dct, probe_latency_queue),
+            name='ripe-parsing-{}'.format(index))
+        processes.append(process)
+        process.start()
 
-    line_queue = mp.Queue(args.number_processes * buffer_lines_per_process)
+    try:
+        for process in read_processes:
+            process.join()
+
+        finished_reading_event.set()
+
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        finished_reading_event.set()
+        print(
+            'trying to do a graceful shutdown press Ctrl+C another time to force '
+            'shutdown')
+
+        for process in processes:
+            process.join()
+
+
+def import_map_reduce(args, file_names: [str], probe_dct: typing.Dict[int, RipeAtlasProbe],
+                      probe_latency_queue: mp.Queue, new_parsed_files: mp.Queue):
+    """
+    Every map process reads whole files and computes the minimal result per destination and
+    probe. The partial minima are sent to the reduce process owning the destination which merges
+    them and bulk loads its partition at the end.
+    """
+    number_reducers = args.reduce_processes or args.number_processes
+    file_queue = __create_file_queue(file_names, args.number_processes)
+    partition_queues = [mp.Queue(args.number_processes * batches_per_process)
+                        for _ in range(number_reducers)]
+
+    reduce_processes = []
+    for index, partition_queue in enumerate(partition_queues):
+        process = mp.Process(target=reduce_partition,
+                             args=(partition_queue, args.number_processes),
+                             name='ripe-reduce-{}'.format(index))
+        reduce_processes.append(process)
+        process.start()
+
+    map_processes = []
+    for index in range(0, args.number_processes):
+        process = mp.Process(target=map_files, args=(
+            file_queue, not args.plaintext, args.days_in_past, probe_dct, probe_latency_queue,
+            partition_queues, new_parsed_files, args.batch_size, args.spill_size),
+                             name='ripe-map-{}'.format(index))
+        map_processes.append(process)
+        process.start()
 
     try:
-        with concurrent.ThreadPoolExecutor(max_workers=args.workers) as read_thread_executor:
-            read_thread_results = read_thread_executor.map(
-                functools.partial(read_file, not args.plaintext, args.days_in_past, line_queue,
-                                  new_parsed_files),
-                file_names)
-            time.sleep(1)
-
-            processes = []
-
-            for index in range(0, args.number_processes):
-                process = mp.Process(target=parse_ripe_data, args=(
-                    line_queue, finished_reading_event, probe_dct, probe_latency_queue),
-                                     name='ripe-parsing-{}'.format(index))
-                processes.append(process)
-                process.start()
+        for process in map_processes:
+            process.join()
+            if process.exitcode < 0:
+                # killed by a signal before it could tell the reducers that it finished
+                logger.error('%s was killed by signal %s, its unsent minima are lost',
+                             process.name, -process.exitcode)
+                for partition_queue in partition_queues:
+                    partition_queue.put(None)
+            elif process.exitcode > 0:
+                logger.error('%s failed, its unsent minima are lost', process.name)
+
+        for process in reduce_processes:
+            process.join()
+    except KeyboardInterrupt:
+        print(
+            'trying to do a graceful shutdown press Ctrl+C another time to force '
+            'shutdown')
+
+        for process in reduce_processes:
+            process.join()
+
+
+def destination_partition(destination_address: str, number_partitions: int) -> int:
+    """Returns the partition of the destination (stable across processes unlike hash())"""
+    return zlib.crc32(destination_address.encode()) % number_partitions
+
+
+def __measurement_row(measurement_result: MeasurementResult) -> tuple:
+    return (measurement_result.probe_id, measurement_result.timestamp,
+            measurement_result.destination_address, measurement_result.source_address,
+            measurement_result.error_msg, measurement_result.rtt, measurement_result.ttl,
+            measurement_result.protocol, bool(measurement_result.behind_nat),
+            bool(measurement_result.from_traceroute), 'ripe_measurement',
+            measurement_result.ripe_measurement_id)
+
+
+def __merge_min_row(min_rows: typing.Dict[typing.Tuple[str, int], tuple], row: tuple):
+    if row[__ROW_RTT_INDEX] is None:
+        # traceroute hops keep null rtts like the jq filters did, they are no minimum
+        return
 
-            try:
-                while True:
+    key = (row[__ROW_DESTINATION_INDEX], row[__ROW_PROBE_ID_INDEX])
+    current_min_row = min_rows.get(key)
+    if current_min_row is None or current_min_row[__ROW_RTT_INDEX] > row[__ROW_RTT_INDEX]:
+        min_rows[key] = row
+
+
+def map_files(file_queue: mp.Queue, bz2_compressed: bool, days_in_past: int,
+              probe_dct: typing.Dict[int, RipeAtlasProbe], probe_latency_queue: mp.Queue,
+              partition_queues: [mp.Queue], new_parsed_files: mp.Queue, batch_size: int,
+              spill_size: int):
+    """
+    Reads whole files from file_queue and keeps the minimal result per destination and probe
+    The minima of a file are only merged after the whole file was read so a file which fails
+    is neither imported in part nor marked as parsed. The minima are sent to the partition
+    queues if spill_size is reached after a file and at the end, the files are marked as parsed
+    once their minima were sent. The reducers are told that this mapper finished even if it
+    fails.
+    """
+    try:
+        __map_files(file_queue, bz2_compressed, days_in_past, probe_dct, probe_latency_queue,
+                    partition_queues, new_parsed_files, batch_size, spill_size)
+    except Exception:
+        logger.exception('error while mapping')
+        raise
+    finally:
+        for partition_queue in partition_queues:
+            partition_queue.put(None)
+            partition_queue.close()
+
+    logger.info('finished mapping')
+
+
+def __map_files(file_queue: mp.Queue, bz2_compressed: bool, days_in_past: int,
+                probe_dct: typing.Dict[int, RipeAtlasProbe], probe_latency_queue: mp.Queue,
+                partition_queues: [mp.Queue], new_parsed_files: mp.Queue, batch_size: int,
+                spill_size: int):
+    oldest_date_allowed = int((datetime.datetime.now() - datetime.timedelta(days=days_in_past))
+                              .timestamp())
+    min_rows = {}
+    unsent_files = []
+
+    def spill():
+        partitions = [[] for _ in partition_queues]
+        for (destination_address, _), row in min_rows.items():
+            partitions[destination_partition(destination_address, len(partitions))].append(row)
+        min_rows.clear()
+
+        for partition_queue, rows in zip(partition_queues, partitions):
+            for start in range(0, len(rows), batch_size):
+                partition_queue.put(rows[start:start + batch_size])
+
+        for unsent_file in unsent_files:
+            new_parsed_files.put(unsent_file)
+        unsent_files.clear()
+
+    while True:
+        filepath = file_queue.get()
+        if filepath is None:
+            break
+
+        logger.info('start reading %s', filepath)
+        failure_counter = 0
+        parsed_results = 0
+        file_min_rows = {}
+        try:
+            for result_batch in read_archive_results(filepath, bz2_compressed,
+                                                     oldest_date_allowed,
+                                                     batch_size=batch_size):
+                for measurement_result_dct in result_batch:
+                    parsed_results += 1
                     try:
-                        read_thread_results.__next__()
-                    except StopIteration:
-                        break
+                        measurement_result = parse_measurement(measurement_result_dct,
+                                                               probe_dct, probe_latency_queue)
                     except Exception:
-                        logger.exception('read thread returned with exception')
+                        failure_counter += 1
+                        logger.exception('Error while parsing result %s',
+                                         measurement_result_dct)
+                        continue
 
-                finished_reading_event.set()
+                    if measurement_result:
+                        __merge_min_row(file_min_rows, __measurement_row(measurement_result))
+        except Exception:
+            logger.exception('error while reading %s', filepath)
+            continue
 
-                for process in processes:
-                    process.join()
-            except KeyboardInterrupt:
-                finished_reading_event.set()
-                print(
-                    'trying to do a graceful shutdown press Ctrl+C another time to force '
-                    'shutdown')
+        for row in file_min_rows.values():
+            __merge_min_row(min_rows, row)
+        unsent_files.append(filepath)
+        if len(min_rows) >= spill_size:
+            spill()
 
-                for process in processes:
-                    process.join()
+        if failure_counter:
+            logger.warning('%s of %s results in %s could not be parsed', failure_counter,
+                           parsed_results, filepath)
 
-    finally:
-        with open(parsed_file_name, 'a') as parsed_files_histoy_file:
-            while not new_parsed_files.empty():
-                filename = new_parsed_files.get()
-                parsed_files_histoy_file.write(filename + '\n')
+        logger.info('finished reading %s', filepath)
 
-    finish_event.set()
-    logger.debug('finish event set waiting for second hop latency thread')
+    spill()
 
-    probe_latency_thread.join()
+
+def reduce_partition(partition_queue: mp.Queue, number_mappers: int):
+    """
+    Merges the partial minima of all map processes for one destination partition and inserts
+    them with COPY in one transaction
+    """
+    min_rows = {}
+    finished_mappers = 0
+    while finished_mappers < number_mappers:
+        rows = partition_queue.get()
+        if rows is None:
+            finished_mappers += 1
+            continue
+
+        for row in rows:
+            __merge_min_row(min_rows, row)
+
+    Session = create_session_for_process(engine)
+    db_session = Session()
+
+    update_min_rtt_table = min_rtt_table_exists(engine)
+    measurement_table = MeasurementResult.__table__
+    rows = list(min_rows.values())
+    min_rows.clear()
+    for start in range(0, len(rows), COPY_BATCH_SIZE):
+        row_batch = rows[start:start + COPY_BATCH_SIZE]
+        ids = allocate_ids(measurement_table, len(row_batch), db_session)
+        copy_rows(measurement_table, ['id'] + MEASUREMENT_ROW_COLUMNS,
+                  ((row_id,) + row for row_id, row in zip(ids, row_batch)), db_session)
+
+        if update_min_rtt_table:
+            upsert_min_rtt_measurements(
+                (types.SimpleNamespace(id=row_id, **dict(zip(MEASUREMENT_ROW_COLUMNS, row)))
+                 for row_id, row in zip(ids, row_batch)), db_session)
+
+    db_session.commit()
+    db_session.close()
+    Session.remove()
+
+    logger.info('reduced and saved %s measurements', len(rows))
 
 
 def get_filenames(archive_path: str, file_regex: str, already_parsed_files: typing.Set[str],
@@ -209,27 +468,34 @@ def update_second_hop_latency(probe_latency_queue: mp.Queue, finish_event: threa
     Session.remove()
 
 
-def read_file(bz2_compressed: bool, days_in_past: int, line_queue: mp.Queue,
-              new_parsed_files: mp.Queue, filepath: str):
-    logger.info('start reading %s', filepath)
-    if bz2_compressed:
-        read_bz2_file_queued(line_queue, filepath, days_in_past)
-    else:
-        with open(filepath) as ripe_archive_filedesc, \
-                mmap.mmap(ripe_archive_filedesc.fileno(), 0,
-                          access=mmap.ACCESS_READ) as ripe_archive_file:
-            line = ripe_archive_file.readline().decode('utf-8')
+def read_files(file_queue: mp.Queue, bz2_compressed: bool, days_in_past: int,
+               result_batch_queue: mp.Queue, new_parsed_files: mp.Queue, batch_size: int):
+    """
+    Reads the files from file_queue until it receives None
+    The results are decompressed, parsed and filtered in this process and sent in batches
+    """
+    oldest_date_allowed = int((datetime.datetime.now() - datetime.timedelta(days=days_in_past))
+                              .timestamp())
+
+    while True:
+        filepath = file_queue.get()
+        if filepath is None:
+            break
 
-            while len(line) > 0:
-                try:
-                    line_queue.put(line)
-                except queue.Full:
-                    time.sleep(0.5)
-                    continue
-                line = ripe_archive_file.readline().decode('utf-8')
+        logger.info('start reading %s', filepath)
+        try:
+            for result_batch in read_archive_results(filepath, bz2_compressed,
+                                                     oldest_date_allowed,
+                                                     batch_size=batch_size):
+                result_batch_queue.put(result_batch)
+        except Exception:
+            logger.exception('error while reading %s', filepath)
+            continue
 
-    new_parsed_files.put(filepath)
-    logger.info('finished reading %s', filepath)
+        new_parsed_files.put(filepath)
+        logger.info('finished reading %s', filepath)
+
+    result_batch_queue.close()
 
 
 class MeasurementKey(enum.Enum):
@@ -251,7 +517,7 @@ class MeasurementKey(enum.Enum):
 
 
 # @util.cprofile('ripe_parser')
-def parse_ripe_data(line_queue: mp.Queue, finished_reading: mp.Event,
+def parse_ripe_data(result_batch_queue: mp.Queue, finished_reading: mp.Event,
                     probe_dct: typing.Dict[int, RipeAtlasProbe], probe_latency_queue: mp.Queue):
     Session = create_session_for_process(engine)
     db_session = Session()
@@ -259,37 +525,31 @@ def parse_ripe_data(line_queue: mp.Queue, finished_reading: mp.Event,
     results = collections.defaultdict(dict)
     min_rtt_results = collections.defaultdict(dict)
 
-    def line_generator():
-        try:
-            rline = line_queue.get(timeout=5)
-        except queue.Empty:
-            logger.exception('found empty queue')
-            return
-
+    def result_generator():
         status_msg = False
         read_fails = 0
         while True:
-            if rline:
-                yield rline
-            if finished_reading.is_set() and (line_queue.empty() or read_fails == 5):
+            if finished_reading.is_set() and (result_batch_queue.empty() or read_fails == 5):
                 return
             if finished_reading.is_set() and not status_msg:
                 logger.debug('reading finished finishing processing')
                 status_msg = True
-            rline = None
             try:
-                rline = line_queue.get(timeout=2)
+                result_batch = result_batch_queue.get(timeout=2)
                 read_fails = 0
             except queue.Empty:
                 logger.debug('failed reading')
                 read_fails += 1
+                continue
+
+            yield from result_batch
 
-    def save_measurement_results(m_results: collections.defaultdict, db_sess):
+    def save_results(m_results: collections.defaultdict, db_sess):
         measurement_results = []
         for probe_measurement_dct in m_results.values():
             measurement_results.extend(probe_measurement_dct.values())
 
-        db_sess.bulk_save_objects(measurement_results)
+        save_measurement_results(measurement_results, db_sess)
         logger.info('parsed and saved %s measurements', len(measurement_results))
         db_sess.commit()
 
@@ -298,11 +558,9 @@ def parse_ripe_data(line_queue: mp.Queue, finished_reading: mp.Event,
     failure_counter = 0
     parsed_lines = 0
 
-    for line in line_generator():
+    for measurement_result_dct in result_generator():
         parsed_lines += 1
         try:
-            measurement_result_dct = json.loads(line)
-
             measurement_result = parse_measurement(measurement_result_dct, probe_dct,
                                                    probe_latency_queue)
 
@@ -318,68 +576,26 @@ def parse_ripe_data(line_queue: mp.Queue, finished_reading: mp.Event,
                 min_rtt_results[destination_address][probe_id] = measurement_result.min_rtt
 
             if len(results) >= 10**6:
-                save_measurement_results(results, db_session)
+                save_results(results, db_session)
 
         except Exception:
             failure_counter += 1
-            logger.exception('Error while parsing line %s', line)
+            logger.exception('Error while parsing result %s', measurement_result_dct)
 
             if parsed_lines > 100 and failure_counter >= parsed_lines / 10:
                 logger.critical('failure rate too high "%s" of "%s"! stopping!', failure_counter,
                                 parsed_lines)
-                save_measurement_results(results, db_session)
+                save_results(results, db_session)
                 break
 
-    save_measurement_results(results, db_session)
+    save_results(results, db_session)
     db_session.close()
     Session.remove()
-    line_queue.close()
+    result_batch_queue.close()
 
     logger.info('finished parsing')
 
 
-def read_bz2_file_queued(line_queue: queue.Queue, filename: str, days_in_past: int):
-    oldest_date_allowed = int((datetime.datetime.now() - datetime.timedelta(days=days_in_past))
-                              .timestamp())
-    if 'traceroute' in filename:
-        command = 'bzcat ' + filename + ' | jq -c \'. | select(.timestamp >= ' + \
-                  str(oldest_date_allowed) + ' and has("dst_addr")) | {timestamp: .timestamp, ' \
-                  'dst_addr: .dst_addr, from: .from, msm_id: .msm_id, type: .type, ' \
-                  'result: [.result[] | select(has("result")) | {result: [.result[] | ' \
-                  'select(has("rtt") and has("from") and .rtt < 30) | ' \
-                  '{rtt: .rtt, ttl: .ttl, from: .from}] | group_by(.from) | ' \
-                  'map(min_by(.rtt)), hop: .hop}] | map(select(.result | length > 0) | ' \
-                  '{rtt: .result[0].rtt, ttl: .result[0].ttl, from: .result[0].from, hop: .hop}),' \
-                  ' proto: .proto, src_addr: .src_addr, prb_id: .prb_id} | ' \
-                  'select(.result | length > 0)\''
-    else:
-        command = 'bzcat ' + filename + ' | jq -c \'. | select(.timestamp >= ' + \
-                  str(oldest_date_allowed) + ' and has("dst_addr")) | {timestamp: .timestamp, ' \
-                  'avg: .avg, dst_addr: .dst_addr, from: .from, min: .min, msm_id: .msm_id, ' \
-                  'type: .type, result: [.result[] | select(has("rtt") and .rtt <= 30) | .rtt] ' \
-                  '| min, proto: .proto, src_addr: .src_addr, ttl: .ttl, prb_id: .prb_id} ' \
-                  '| select(.result >= 0)\''
-
-    logger.debug('reading bz2 compressed file %s', filename)
-    with subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, universal_newlines=True,
-                          bufsize=1) as subprocess_call:
-        for line in subprocess_call.stdout:
-            failures = 0
-            while True:
-                try:
-                    line_queue.put(line)
-                except queue.Full:
-                    time.sleep(0.1)
-                    failures += 1
-                    if failures >= 10:
-                        logger.exception('Queue full for too long stopping reading %s!', filename)
-                        return
-                else:
-                    break
-
-    logger.debug('finished reading bz2 %s', filename)
-
-
 def parse_measurement(measurement_result: dict, probe_dct: [int, RipeAtlasProbe],
                       probe_latency_queue: mp.Queue) \
         -> typing.Optional[MeasurementResult]:
@@ -11,7 +11,8 @@ import typing
 
 from hloc import util
 from hloc.models import ZmapProbe, ZmapMeasurementResult
-from hloc.db_utils import create_session_for_process, location_for_coordinates, create_engine
+from hloc.db_utils import create_session_for_process, location_for_coordinates, create_engine, \
+    create_min_rtt_table, save_measurement_results, create_measurement_partitions
 
 
 logger = None
@@ -25,6 +26,11 @@ def __create_parser_arguments(parser: argparse.ArgumentParser):
     parser.add_argument('locations_config_file', type=str,
                         help='a config file with the location keys and their GPS coordinates')
     parser.add_argument('-r', '--file-regex', type=str, default=r'.*scanned$')
+    parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
+    parser.add_argument('--create-min-rtt-table', action='store_true',
+                        help='Create the table with the minimal rtt per destination, probe and '
+                             'measurement type if it does not exist. Once it exists every '
+                             'import merges its results into it')
     parser.add_argument('-l', '--logging-file', type=str, default='zmap-results-import.log',
                         help='Specify a logging file where the log should be saved')
     parser.add_argument('-ll', '--log-level', type=str, default='INFO',
@@ -44,6 +50,9 @@ def main():
     global engine
     engine = create_engine(args.database_name)
 
+    if args.create_min_rtt_table:
+        create_min_rtt_table(engine)
+
     Session = create_session_for_process(engine)
     db_session = Session()
 
@@ -116,7 +125,10 @@ def parse_zmap_results(zmap_filepath: str, probe_id: int, db_session):
 
     logger.info('parsed {} unique destination rtts from {}'.format(len(measurements),
                                                                    zmap_filepath))
-    db_session.bulk_save_objects(measurements.values())
+    if measurements:
+        timestamps = [measurement.timestamp for measurement in measurements.values()]
+        create_measurement_partitions(engine, min(timestamps), max(timestamps))
+    save_measurement_results(list(measurements.values()), db_session)
     db_session.commit()
 
 
@@ -4,6 +4,7 @@ sanitizing and classification of the domain names
 
  Merge into ipdns_parser -- important: give alarm if target IP not found in IP2DNS file
 """
+import array
 import collections
 import json
 import multiprocessing as mp
@@ -14,18 +15,36 @@ import os
 import queue
 
 import configargparse
+import numpy as np
+import sqlalchemy as sqla
 
 import hloc.constants as constants
 from hloc import util
-from hloc.db_utils import recreate_db, create_session_for_process, create_engine
-from hloc.models import Domain, DomainType, DomainLabel
+from hloc.db_utils import recreate_db, create_session_for_process, create_engine, \
+    allocate_ids, copy_rows
+from hloc.models import Domain, DomainType
 from hloc.domain_processing_helper.domain_name_preprocessing import RegexStrategy, \
-    preprocess_domains
+    DomainClassifier, DOMAIN_TYPE_CODES
 from hloc.models.domain import domain_to_label_table
 
 logger = None
 engine = None
 BLOCK_SIZE = 10
+DOMAIN_COLUMNS = ['id', 'name', 'ipv4_address', 'ipv6_address', 'classification_type']
+# the maximum number of label ids kept in memory by handle_labels
+LABEL_CACHE_SIZE = 10**6
+
+LABEL_STAGING_TABLE = sqla.table('label_staging', sqla.column('name'), sqla.column('domain_id'))
+__INSERT_STAGED_LABELS_QUERY = sqla.text(
+    'INSERT INTO domain_labels (name) SELECT DISTINCT name FROM label_staging '
+    'ON CONFLICT (name) DO NOTHING')
+__INSERT_STAGED_LINKS_QUERY = sqla.text(
+    'INSERT INTO domain_to_labels (domain_id, domain_label_id) '
+    'SELECT label_staging.domain_id, domain_labels.id FROM label_staging '
+    'JOIN domain_labels ON domain_labels.name = label_staging.name')
+__STAGED_LABEL_IDS_QUERY = sqla.text(
+    'SELECT DISTINCT domain_labels.name, domain_labels.id FROM label_staging '
+    'JOIN domain_labels ON domain_labels.name = label_staging.name')
 
 
 def __create_parser_arguments(parser):
@@ -43,8 +62,10 @@ def __create_parser_arguments(parser):
                         help='path to a file with a white list of IPs')
     parser.add_argument('-d', '--database-recreate', action='store_true',
                         help='Recreates the database structure. Attention deletes all data!')
-    parser.add_argument('-b', '--buffer-lines-per-process', type=int, default=1000,
-                        help='Number of lines buffered for each process')
+    parser.add_argument('-c', '--chunk-size', type=int, default=16,
+                        help='The size of the file chunks handed to the processes in MiB')
+    parser.add_argument('--label-cache-size', type=int, default=LABEL_CACHE_SIZE,
+                        help='The maximum number of label ids kept in memory')
     parser.add_argument('-dbn', '--database-name', type=str, default='hloc-measurements')
     parser.add_argument('-l', '--logging-file', type=str, default='preprocess.log',
                         help='Specify a logging file where the log should be saved')
@@ -96,36 +117,35 @@ def main():
     else:
         whitelist = None
 
-    processes = []
-    parsed_ips = set()
-    parsed_ips_lock = mp.Lock()
-
-    finished_reading_event = mp.Event()
-
-    line_queue = mp.Queue(args.number_processes * args.buffer_lines_per_process)
-    line_thread = threading.Thread(target=read_file,
-                                   args=(args.filepath, line_queue, finished_reading_event),
-                                   name='file-reader')
-    line_thread.start()
-    time.sleep(1)
+    chunk_queue = mp.Queue()
+    for chunk in file_chunks(args.filepath, args.chunk_size * 2**20):
+        chunk_queue.put(chunk)
+    for _ in range(args.number_processes):
+        chunk_queue.put(None)
 
     stop_event = threading.Event()
-    domain_label_queue = mp.Queue()
+    domain_label_queue = mp.Queue(4 * args.number_processes)
     domain_label_handle_thread = threading.Thread(target=handle_labels,
                                                   args=(domain_label_queue, stop_event),
+                                                  kwargs={'label_cache_size':
+                                                          args.label_cache_size},
                                                   name='domain-label-handler')
     domain_label_handle_thread.start()
 
+    parsed_ips_queue = mp.Queue()
+    processes = []
     for i in range(0, args.number_processes):
         process = mp.Process(target=preprocess_file_part,
-                             args=(args.filepath, i, line_queue, args.isp_ip_filter, regex_strategy,
-                                   tlds, whitelist, parsed_ips, parsed_ips_lock, domain_label_queue,
-                                   finished_reading_event),
+                             args=(args.filepath, i, chunk_queue, args.isp_ip_filter,
+                                   regex_strategy, tlds, whitelist, parsed_ips_queue,
+                                   domain_label_queue),
                              name='preprocessing_{}'.format(i))
         processes.append(process)
         process.start()
 
-    line_thread.join()
+    parsed_ips = set()
+    for _ in processes:
+        parsed_ips.update(parsed_ips_queue.get())
 
     alive = len(processes)
     while alive > 0:
@@ -143,129 +163,140 @@ def main():
     domain_label_handle_thread.join()
     domain_label_queue.join_thread()
 
-    line_queue.close()
-    line_queue.join_thread()
+    chunk_queue.close()
+    chunk_queue.join_thread()
 
-    whitelisted_not_parsed_as_correct = set(parsed_ips) - parsed_ips
+    if whitelist is not None:
+        whitelisted_not_parsed_as_correct = whitelist - parsed_ips
 
-    if whitelisted_not_parsed_as_correct:
-        ips_missing = ',\n'.join(whitelisted_not_parsed_as_correct)
-        logger.warning('IP addresses in whitelist but not parsed: \n{}'.format(ips_missing))
+        if whitelisted_not_parsed_as_correct:
+            ips_missing = ',\n'.join(whitelisted_not_parsed_as_correct)
+            logger.warning('IP addresses in whitelist but not parsed: \n{}'.format(ips_missing))
 
     end = time.time()
     logger.info('Running time: {0}'.format((end - start)))
 
 
-def read_file(filepath: str, line_queue: mp.Queue, finished_reading_event: mp.Event):
-    with open(filepath, encoding='ISO-8859-1') as rdns_file_handle:
-        for line in rdns_file_handle:
-            try:
-                line_queue.put(line)
-            except queue.Full:
-                time.sleep(0.5)
+def file_chunks(filepath: str, chunk_size: int) -> typing.Generator[typing.Tuple[int, int],
+                                                                   None, None]:
+    """
+    Splits the file in byte ranges of about chunk_size bytes
+    The boundaries do not need to be at line ends, see read_chunk_lines
+    """
+    file_size = os.path.getsize(filepath)
+    for start in range(0, file_size, chunk_size):
+        yield start, min(start + chunk_size, file_size)
 
-    finished_reading_event.set()
+
+def read_chunk_lines(rdns_file_handle, start: int, end: int) \
+        -> typing.Generator[bytes, None, None]:
+    """
+    Returns all lines of the binary file handle which begin in the byte range [start, end)
+    A line crossing the end of the range is read completely, a line crossing the start belongs
+    to the previous range
+    """
+    if start > 0:
+        rdns_file_handle.seek(start - 1)
+        rdns_file_handle.readline()
+    else:
+        rdns_file_handle.seek(0)
+
+    while rdns_file_handle.tell() < end:
+        line = rdns_file_handle.readline()
+        if not line:
+            break
+        yield line
 
 
 # @util.cprofile('handle.profile')
-def handle_labels(labels_queue: mp.Queue, stop_event: threading.Event):
-    """Handels the label results and saves them to the database not blocking the other db queries"""
-
-    class DomainLabelHolder:
-        def __init__(self, label):
-            self.label = label
-            self.label_id = 0
-            self.domain_ids = set()
-            self._handled_domain_ids = set()
-
-        def add_domain_id(self, domain_id):
-            if domain_id not in self.domain_ids and domain_id not in self._handled_domain_ids:
-                self.domain_ids.add(domain_id)
-
-        def get_insert_values(self):
-            values = [{'domain_id': domain_id, 'domain_label_id': self.label_id}
-                      for domain_id in self.domain_ids]
-            return values
-
-        def handled_domain_ids(self):
-            self._handled_domain_ids = self._handled_domain_ids.union(self.domain_ids)
-            self.domain_ids.clear()
-
-        def __hash__(self):
-            return hash(self.label)
-
-    def save_labels(domain_labels_dct, labels_to_save, new_labels, db_sess):
-        if new_labels:
-            db_sess.bulk_save_objects([label.label for label in new_labels], return_defaults=True)
-            for label_obj in new_labels:
-                label_obj.label_id = label_obj.label.id
-
-        values_to_insert = []
-        for label_obj in labels_to_save:
-            if label_obj.domain_ids:
-                values_to_insert.extend(label_obj.get_insert_values())
-                label_obj.handled_domain_ids()
-
-        insert_expr = domain_to_label_table.insert().values(values_to_insert)
-        new_labels.clear()
-        labels_to_save.clear()
-        db_sess.execute(insert_expr)
+def handle_labels(labels_queue: mp.Queue, stop_event: threading.Event,
+                  label_cache_size: int=LABEL_CACHE_SIZE):
+    """
+    Handels the label results and saves them to the database not blocking the other db queries
+    The ids of known labels are kept in a cache with at most label_cache_size entries. Links to
+    cached labels are buffered in arrays and written with COPY. Links to other labels are copied
+    to a staging table from which the missing labels are inserted and the links are resolved
+    by name, so the memory used does not grow with the input size.
+    """
+    label_ids = {}
+    linked_domain_ids = array.array('q')
+    linked_label_ids = array.array('q')
+    staged_label_names = []
+    staged_domain_ids = array.array('q')
+
+    def save_labels(db_sess):
+        if staged_label_names:
+            db_sess.execute(sqla.text(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS {} (name varchar(100), domain_id integer) '
+                'ON COMMIT DROP'.format(LABEL_STAGING_TABLE.name)))
+            copy_rows(LABEL_STAGING_TABLE, ['name', 'domain_id'],
+                      zip(staged_label_names, staged_domain_ids), db_sess)
+            db_sess.execute(__INSERT_STAGED_LABELS_QUERY)
+            db_sess.execute(__INSERT_STAGED_LINKS_QUERY)
+
+            if len(label_ids) >= label_cache_size:
+                label_ids.clear()
+            for label_name, label_id in db_sess.execute(__STAGED_LABEL_IDS_QUERY):
+                label_ids[label_name] = label_id
+
+            db_sess.execute(sqla.text('TRUNCATE {}'.format(LABEL_STAGING_TABLE.name)))
+            del staged_label_names[:]
+            del staged_domain_ids[:]
+
+        copy_rows(domain_to_label_table, ['domain_id', 'domain_label_id'],
+                  zip(linked_domain_ids, linked_label_ids), db_sess)
+        del linked_domain_ids[:]
+        del linked_label_ids[:]
 
     Session = create_session_for_process(engine)
     db_session = Session()
 
-    new_labels = []
-    labels_to_save = set()
-    domain_labels = {}
-    counter = 0
     ccounter = 0
 
     while not stop_event.is_set() or not labels_queue.empty():
         try:
-            domain_label_tuples = labels_queue.get(timeout=1)
-            for label_name, domain_id in domain_label_tuples:
-                try:
-                    label = domain_labels[label_name]
-                except KeyError:
-                    label_obj = DomainLabel(label_name)
-                    label = DomainLabelHolder(label_obj)
-                    domain_labels[label_name] = label
-                    new_labels.append(label)
-
-                labels_to_save.add(label)
-                label.add_domain_id(domain_id)
-
-                counter += 1
-                if counter >= 10**4:
-                    save_labels(domain_labels, labels_to_save, new_labels, db_session)
-                    counter = 0
-                    ccounter +=1
-
-                    if ccounter >= 10:
-                        db_session.commit()
-                        ccounter = 0
+            label_names, domain_ids = labels_queue.get(timeout=1)
+            for label_name, domain_id in zip(label_names.split('\n'), domain_ids):
+                label_id = label_ids.get(label_name)
+                if label_id is None:
+                    staged_label_names.append(label_name)
+                    staged_domain_ids.append(domain_id)
+                else:
+                    linked_domain_ids.append(domain_id)
+                    linked_label_ids.append(label_id)
+
+            if len(staged_domain_ids) + len(linked_domain_ids) >= 10**5:
+                save_labels(db_session)
+                ccounter += 1
+
+                if ccounter >= 10:
+                    db_session.commit()
+                    ccounter = 0
 
         except queue.Empty:
             pass
 
-    save_labels(domain_labels, labels_to_save, new_labels, db_session)
+    save_labels(db_session)
     db_session.commit()
     logger.info('stopped')
     labels_queue.close()
 
 
-def preprocess_file_part(filepath: str, pnr: int, line_queue: mp.Queue,
+def preprocess_file_part(filepath: str, pnr: int, chunk_queue: mp.Queue,
                          ip_encoding_filter: bool, regex_strategy: RegexStrategy,
                          tlds: typing.Set[str], whitelist: typing.Set[str],
-                         parsed_ips: typing.Set[str], parsed_ips_lock: mp.Lock,
-                         domain_label_queue: mp.Queue, finished_reading_event: mp.Event):
+                         parsed_ips_queue: mp.Queue, domain_label_queue: mp.Queue):
     """
-    Sanitize filepart from start to end
+    Sanitizes and classifies the byte ranges of the file taken from chunk_queue until it
+    receives None
+    The domains of a chunk are inserted with one COPY and their labels are sent to the label
+    handler as one batch
     pnr is a number to recognize the process
-    ipregex should be a regex with 4 integers to filter the Isp client domain names
+    Puts the parsed IPs contained in the whitelist to parsed_ips_queue when finished
     """
     logger.info('starting')
     label_stats = collections.defaultdict(int)
+    parsed_ips = set()
 
     Session = create_session_for_process(engine)
     db_session = Session()
@@ -274,39 +305,53 @@ def preprocess_file_part(filepath: str, pnr: int, line_queue: mp.Queue,
         count_good_lines = 0
         count_isp_lines = 0
 
-        while not finished_reading_event.is_set() or not line_queue.empty():
-            try:
-                line = line_queue.get(timeout=2)
-            except queue.Empty:
-                time.sleep(1)
-                continue
+        domain_classifiers = {
+            ip_version: DomainClassifier(tlds, white_list=whitelist, ip_version=ip_version,
+                                         regex_strategy=regex_strategy,
+                                         ip_encoding_filter=ip_encoding_filter)
+            for ip_version in [constants.IPV4_IDENTIFIER, constants.IPV6_IDENTIFIER]}
 
-            if len(line) == 0:
-                continue
-            line = line.strip()
-            ip, domain = line.split(',', 1)
+        with open(filepath, 'rb') as rdns_file_handle:
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is None:
+                    break
 
-            if not domain:
-                logger.info('Warning found empty domain for IP {} skipping'.format(ip))
-                continue
+                ip_domain_columns = {constants.IPV4_IDENTIFIER: ([], []),
+                                     constants.IPV6_IDENTIFIER: ([], [])}
 
-            if ':' in ip:
-                ip_version = constants.IPV6_IDENTIFIER
-            else:
-                ip_version = constants.IPV4_IDENTIFIER
+                for line in read_chunk_lines(rdns_file_handle, *chunk):
+                    line = line.decode('ISO-8859-1').strip()
+                    if not line:
+                        continue
 
-            with parsed_ips_lock:
-                parsed_ips.add(ip)
+                    ip, domain = line.split(',', 1)
 
-            n_good_lines_count, n_ip_lines_count = classify_domain(
-                ip, domain, ip_version, ip_encoding_filter, regex_strategy, tlds,
-                whitelist, db_session, domain_label_queue)
-            count_good_lines += n_good_lines_count
-            count_isp_lines += n_ip_lines_count
+                    if not domain:
+                        logger.info('Warning found empty domain for IP {} skipping'.format(ip))
+                        continue
 
-            db_session.commit()
-        else:
-            logger.info('finished no more lines')
+                    if ':' in ip:
+                        ip_addresses, domains = ip_domain_columns[constants.IPV6_IDENTIFIER]
+                    else:
+                        ip_addresses, domains = ip_domain_columns[constants.IPV4_IDENTIFIER]
+                    ip_addresses.append(ip)
+                    domains.append(domain)
+
+                    if whitelist is not None and ip in whitelist:
+                        parsed_ips.add(ip)
+
+                for ip_version, (ip_addresses, domains) in ip_domain_columns.items():
+                    if not domains:
+                        continue
+
+                    n_good_lines_count, n_ip_lines_count = classify_domains(
+                        ip_addresses, domains, ip_version, domain_classifiers[ip_version],
+                        db_session, domain_label_queue)
+                    count_good_lines += n_good_lines_count
+                    count_isp_lines += n_ip_lines_count
+
+        logger.info('finished no more chunks')
 
         directory = os.path.dirname(filepath)
         filename = util.get_path_filename(filepath)
@@ -320,83 +365,55 @@ def preprocess_file_part(filepath: str, pnr: int, line_queue: mp.Queue,
                   'w', encoding='utf-8') as labelStatFile:
             json.dump(label_stats, labelStatFile)
     finally:
+        parsed_ips_queue.put(parsed_ips)
         db_session.close()
         Session.remove()
         domain_label_queue.close()
 
 
-def classify_domain(ip: str, domain: str, ip_version: str, ip_encoding_filter: bool,
-                    regex_strategy: RegexStrategy, tlds: typing.Set[str],
-                    whitelist: typing.Set[str], db_session,
-                    domain_labels_queue: mp.Queue) -> (int, int):
+def classify_domains(ip_addresses: [str], domains: [str], ip_version: str,
+                     domain_classifier: DomainClassifier, db_session,
+                     domain_labels_queue: mp.Queue) -> (int, int):
+    """
+    Classifies the domains, inserts them with COPY and sends their labels to the label handler
+    All IP addresses must have the same ip version
+    :return: the number of valid and the number of ip encoded domains
+    """
     is_ipv6 = ip_version == constants.IPV6_IDENTIFIER
 
-    (good_lines, bad_lines, bad_tld_lines, ip_encoded_lines, custom_filter_lines,
-     bad_characters_part) = preprocess_domains([(ip, domain)], tlds, whitelist,
-                                               ip_version, regex_strategy,
-                                               ip_encoding_filter)
-
-    domain = None
-
-    if good_lines:
-        ip_address, domain_address = good_lines[0]
-        if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
-        else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
-
-        domain.classification_type = DomainType.valid
-
-    if bad_lines:
-        ip_address, domain_address = bad_lines[0]
-        if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
-        else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
-
-        domain.classification_type = DomainType.invalid_characters
-
-    if bad_tld_lines:
-        ip_address, domain_address = bad_tld_lines[0]
-        if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
-        else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
-
-        domain.classification_type = DomainType.bad_tld
-
-    if ip_encoded_lines:
-        ip_address, domain_address = ip_encoded_lines[0]
-        if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
-        else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
-
-        domain.classification_type = DomainType.ip_encoded
+    codes = domain_classifier.classify_columns(ip_addresses, domains)
+    domain_ids = allocate_ids(Domain.__table__, len(domains), db_session)
 
-    if custom_filter_lines:
-        ip_address, domain_address = custom_filter_lines[0]
+    domain_rows = []
+    label_names = []
+    label_domain_ids = array.array('q')
+    for domain_id, ip_address, domain_address, code in zip(domain_ids, ip_addresses, domains,
+                                                           codes.tolist()):
         if is_ipv6:
-            domain = Domain(domain_address, ipv6_address=ip_address)
+            domain_rows.append((domain_id, domain_address, None, ip_address,
+                                DOMAIN_TYPE_CODES[code]))
         else:
-            domain = Domain(domain_address, ipv4_address=ip_address)
+            domain_rows.append((domain_id, domain_address, ip_address, None,
+                                DOMAIN_TYPE_CODES[code]))
 
-        domain.classification_type = DomainType.blacklisted
+        for label_name in get_domain_labels(domain_address):
+            label_names.append(label_name)
+            label_domain_ids.append(domain_id)
 
-    db_session.add(domain)
+    copy_rows(Domain.__table__, DOMAIN_COLUMNS, domain_rows, db_session)
     db_session.commit()
-    domain_label_tuples = get_domain_label_tuples(domain)
-    domain_labels_queue.put(domain_label_tuples)
 
-    return len(good_lines), len(ip_encoded_lines)
+    if label_names:
+        domain_labels_queue.put(('\n'.join(label_names), label_domain_ids))
 
+    code_counts = np.bincount(codes, minlength=len(DOMAIN_TYPE_CODES))
+    return int(code_counts[DOMAIN_TYPE_CODES.index(DomainType.valid)]), \
+        int(code_counts[DOMAIN_TYPE_CODES.index(DomainType.ip_encoded)])
 
-def get_domain_label_tuples(domain: Domain):
-    domain_labels = set()
-    for label in domain.name.split('.')[:-2]:
-        domain_labels.add((label, domain.id))
-    return domain_labels
 
+def get_domain_labels(domain_name: str) -> typing.Set[str]:
+    """Returns the labels of the domain name without the second and top level domain"""
+    return set(domain_name.split('.')[:-2])
 
 if __name__ == '__main__':
     main()
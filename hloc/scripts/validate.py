@@ -6,9 +6,12 @@ Verify obtained location hints with rtt measurements using a predefined threshol
 import time
 
 import argparse
+import asyncio
 import collections
 import datetime
 import enum
+import functools
+import itertools
 import multiprocessing as mp
 import operator
 import queue
@@ -19,13 +22,24 @@ import typing
 from sqlalchemy.exc import InvalidRequestError
 
 from hloc import util, constants
-from hloc.db_utils import get_measurements_for_domain, get_all_domains_splitted_efficient, \
-    create_session_for_process, create_engine, get_domains_for_ips
+from hloc.geo import coordinate_arrays, haversine_distance_matrix, SpatialIndex
+from hloc.db_utils import get_measurements_for_ips, get_all_domains_splitted_efficient, \
+    create_session_for_process, create_engine, get_domains_for_ips, create_min_rtt_table, \
+    save_measurement_results, create_measurement_partitions, load_domains_with_hints
 from hloc.exceptions import ProbeError, ServerError
 from hloc.models import *
 from hloc.models.location import probe_location_info_table
-from hloc.ripe_helper.basics_helper import get_measurement_ids
+from hloc.models.probe import AVAILABILITY_FLAGS, AVAILABILITY_MASK
+from hloc.ripe_helper.async_client import AsyncRipeAtlasClient
+from hloc.ripe_helper.basics_helper import get_measurement_ids, get_measurement_statuses, \
+    create_measurements
+from hloc.ripe_helper.history_cache import RipeHistoryCache
 from hloc.ripe_helper.history_helper import check_measurements_for_nodes, load_probes_from_cache
+from hloc.ripe_helper.measurement_batcher import MeasurementBatcher, MEASUREMENT_BATCH_WINDOW
+from hloc.ripe_helper.measurement_poller import MeasurementStatusPoller
+from hloc.ripe_helper.probe_status import ProbeStatusService
+from hloc.ripe_helper.rate_limiter import RipeEndpoint, RipeRateLimiters, RateLimitBackendType, \
+    parse_endpoint_limit
 
 logger = None
 engine = None
@@ -75,6 +89,21 @@ The measurement strategy:
     parser.add_argument('-b', '--ripe-request-burst-limit', type=int,
                         help='How many request should at maximum be allowed per second'
                              ' to the ripe server', default=40)
+    parser.add_argument('--ripe-endpoint-limit', type=parse_endpoint_limit, action='append',
+                        default=[], metavar='ENDPOINT:RATE[:BURST]',
+                        help='An additional request limit for one RIPE Atlas endpoint ({}), '
+                             'can be repeated'.format(
+                                 ', '.join(endpoint.value for endpoint in RipeEndpoint)))
+    parser.add_argument('--rate-limit-backend', type=str,
+                        default=RateLimitBackendType.shared_memory.value,
+                        choices=[RateLimitBackendType.shared_memory.value,
+                                 RateLimitBackendType.sqlite.value],
+                        help='Where the RIPE Atlas request tokens are kept: shared-memory for '
+                             'the processes of this run or sqlite to share the limits with '
+                             'every process using the same --rate-limit-file, also on other '
+                             'hosts')
+    parser.add_argument('--rate-limit-file', type=str, default=constants.RIPE_RATE_LIMIT_PATH,
+                        help='The SQLite file of the sqlite rate limit backend')
     parser.add_argument('-ml', '--measurement-limit', type=int,
                         help='The amount of parallel RIPE Atlas measurements allowed',
                         default=100)
@@ -107,6 +136,26 @@ The measurement strategy:
                              'closed')
     parser.add_argument('--random-domains', action='store_true',
                         help='Select the domains to measure randomly')
+    parser.add_argument('--use-min-rtt-table', action='store_true',
+                        help='Read only the minimal rtt per probe from the min rtt table. The '
+                             'table is created if it does not exist')
+    parser.add_argument('--async-measurements', action='store_true',
+                        help='Check the domains with an asyncio event loop per process instead '
+                             'of threads (needs the aiohttp package)')
+    parser.add_argument('--async-max-checks', type=int, default=1000,
+                        help='The maximum number of domains checked in parallel by a process '
+                             'with --async-measurements')
+    parser.add_argument('--measurement-batch-window', type=float,
+                        default=MEASUREMENT_BATCH_WINDOW,
+                        help='The time in seconds a new measurement waits for other measurements '
+                             'with the same candidate probes to create them with one request '
+                             '(0 disables the batching)')
+    parser.add_argument('--history-cache-ttl', type=int, default=0,
+                        help='Cache the RIPE Atlas measurement history for this many seconds '
+                             'and share it between all processes (Default 0: no caching)')
+    parser.add_argument('--history-cache-file', type=str,
+                        default=constants.RIPE_HISTORY_CACHE_PATH,
+                        help='The SQLite file for the RIPE Atlas measurement history cache')
     parser.add_argument('--debug', action='store_true', help='Use only one process and one thread')
     parser.add_argument('-l', '--log-file', type=str, default='check_locations.log',
                         help='Specify a logging file where the log should be saved')
@@ -129,6 +178,12 @@ def main():
     global engine
     engine = create_engine(args.database_name)
 
+    create_measurement_partitions(
+        engine, datetime.datetime.now() - datetime.timedelta(seconds=args.allowed_measurement_age))
+
+    if args.use_min_rtt_table:
+        create_min_rtt_table(engine)
+
     global logger
     logger = util.setup_logger(args.log_file, 'check', loglevel=args.log_level,
                                hourly_log_rotation=True)
@@ -139,19 +194,28 @@ def main():
     db_session = Session()
     db_session.expire_on_commit = False
 
-    ripe_slow_down_sema = mp.BoundedSemaphore(args.ripe_request_burst_limit)
+    ripe_rate_limiters = RipeRateLimiters.create(
+        RateLimitBackendType(args.rate_limit_backend), args.ripe_request_limit,
+        args.ripe_request_burst_limit,
+        endpoint_limits={endpoint: (rate, burst)
+                         for endpoint, rate, burst in args.ripe_endpoint_limit},
+        db_path=args.rate_limit_file)
+    RipeAtlasProbe.status_service = ProbeStatusService(ripe_rate_limiters[RipeEndpoint.probes])
     ripe_create_sema = mp.Semaphore(args.measurement_limit)
     global MAX_THREADS
 
     if args.debug:
         MAX_THREADS = 1
+    elif args.async_measurements:
+        MAX_THREADS = args.async_max_checks
     else:
         MAX_THREADS = int(args.measurement_limit / args.number_processes * 1.5)
 
-    finish_event = threading.Event()
-    generator_thread = util.start_token_generating_thread(ripe_slow_down_sema,
-                                                          args.ripe_request_limit,
-                                                          finish_event)
+    if args.history_cache_ttl > 0:
+        result_cache = RipeHistoryCache(args.history_cache_file, args.history_cache_ttl)
+        result_cache.create()
+    else:
+        result_cache = None
 
     locations = db_session.query(LocationInfo)
 
@@ -162,6 +226,7 @@ def main():
 
     if not args.disable_probe_fetching:
         probe_distances = load_probes_from_cache(db_session).values()
+        update_probes([probe for probe, _ in probe_distances])
 
         location_to_probes_dct = assign_location_probes(locations,
                                                         [probe for probe, _ in probe_distances],
@@ -248,7 +313,7 @@ def main():
         process = mp.Process(target=ripe_check_process,
                              args=(pid,
                                    ripe_create_sema,
-                                   ripe_slow_down_sema,
+                                   ripe_rate_limiters,
                                    args.bill_to,
                                    args.without_new_measurements,
                                    args.allowed_measurement_age,
@@ -265,7 +330,12 @@ def main():
                                    args.stop_without_old_results,
                                    ips_for_process,
                                    args.endless_measurements,
-                                   args.random_domains),
+                                   args.random_domains,
+                                   args.use_min_rtt_table,
+                                   args.async_measurements,
+                                   max(1, int(args.measurement_limit / process_count)),
+                                   result_cache,
+                                   args.measurement_batch_window),
                              name='domain_checking_{}'.format(pid))
 
         processes.append(process)
@@ -285,36 +355,15 @@ def main():
         except KeyboardInterrupt:
             pass
 
-    if finish_event:
-        finish_event.set()
-
-    if generator_thread:
-        generator_thread.join()
-
     logger.debug('{} processes alive'.format(alive))
     end_time = time.time()
     logger.info('running time: {}'.format((end_time - start_time)))
     return 0
 
 
-def generate_ripe_request_tokens(sema: mp.Semaphore, limit: int, finish_event: threading.Event):
-    """
-    Generates RIPE_REQUESTS_PER_SECOND tokens on the Semaphore
-    """
-    logger.debug('generate thread started')
-    while not finish_event.is_set():
-        time.sleep(2 / limit)
-        try:
-            sema.release()
-            sema.release()
-        except ValueError:
-            continue
-    logger.debug('generate thread stoopped')
-
-
 def ripe_check_process(pid: int,
                        ripe_create_sema: mp.Semaphore,
-                       ripe_slow_down_sema: mp.Semaphore,
+                       ripe_rate_limiters: RipeRateLimiters,
                        bill_to_address: str,
                        wo_measurements: bool,
                        allowed_measurement_age: int,
@@ -332,8 +381,23 @@ def ripe_check_process(pid: int,
                        stop_without_old_results: bool,
                        ip_list: typing.List[str],
                        endless_measurements: bool,
-                       random_domains: bool):
-    """Checks for all domains if the suspected locations are correct"""
+                       random_domains: bool,
+                       use_min_rtt_table: bool,
+                       async_measurements: bool,
+                       measurement_limit: int,
+                       result_cache: typing.Optional[RipeHistoryCache],
+                       measurement_batch_window: float):
+    """
+    Checks for all domains if the suspected locations are correct
+    The domains are either checked by MAX_THREADS threads or with async_measurements by one
+    event loop with at most MAX_THREADS checks in parallel. The async RIPE Atlas client of the
+    event loop gets this process's share (measurement_limit) of the parallel measurements.
+    All RIPE Atlas requests take their tokens from the ripe_rate_limiters shared by all
+    processes.
+    The RIPE Atlas measurement history is looked up in the result_cache shared by all processes.
+    New measurements with the same candidate probes are created together if they are requested
+    within measurement_batch_window seconds.
+    """
     correct_type_count = collections.defaultdict(int)
 
     domain_type_count = collections.defaultdict(int)
@@ -373,81 +437,76 @@ def ripe_check_process(pid: int,
                                                                   use_random_order=random_domains,
                                                                   endless_mode=endless_measurements)
 
-        generator_lock = threading.Lock()
+        domain_info_queue = queue.Queue(maxsize=2 * domain_block_limit)
+        prefetch_thread = threading.Thread(target=prefetch_domain_infos,
+                                           args=(domain_generator, domain_block_limit,
+                                                 allowed_measurement_age, use_min_rtt_table,
+                                                 db_session, domain_info_queue,
+                                                 1 if async_measurements else MAX_THREADS,
+                                                 stop_event),
+                                           name='domain-prefetch')
+        prefetch_thread.start()
 
         def next_domain_info():
+            while True:
+                try:
+                    return domain_info_queue.get(timeout=1)
+                except queue.Empty:
+                    if stop_event.is_set():
+                        return None
+
+        check_domain = functools.partial(
+            check_domain_location_ripe,
+            increment_domain_type_count=increment_domain_type_count,
+            increment_count_for_type=increment_count_for_type,
+            wo_measurements=wo_measurements,
+            allowed_measurement_age=allowed_measurement_age,
+            measurement_strategy=measurement_strategy,
+            number_of_probes_per_measurement=number_of_probes_per_measurement,
+            buffer_time=buffer_time,
+            packets_per_measurement=packets_per_measurement,
+            use_efficient_probes=use_efficient_probes,
+            location_to_probes_dct=location_to_probes_dct,
+            measurement_results_queue=measurement_results_queue,
+            stop_without_old_results=stop_without_old_results)
+
+        if async_measurements:
+            async def check_domains():
+                ripe_client = AsyncRipeClient(api_key, ripe_rate_limiters,
+                                              measurement_limit=measurement_limit,
+                                              bill_to_address=bill_to_address,
+                                              result_cache=result_cache,
+                                              batch_window=measurement_batch_window)
+                async with ripe_client:
+                    await domain_check_async_manage(
+                        next_domain_info, functools.partial(check_domain, ripe_client=ripe_client),
+                        MAX_THREADS)
+
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
             try:
-                with generator_lock:
-                    domain = domain_generator.__next__()
-                    location_hints = domain.all_label_matches
-                    location_hint_tuples = []
-
-                    for location_hint in location_hints:
-                        if isinstance(location_hint, CodeMatch):
-                            _ = location_hint.location.city_name
-                            _ = location_hint.code_type
-                            location_hint_tuples.append((location_hint,
-                                                         location_hint.location))
-
-                            try:
-                                db_session.expunge(location_hint)
-                                db_session.expunge(location_hint.location)
-                            except InvalidRequestError:
-                                pass
-
-                    loc_ip_version = constants.IPV4_IDENTIFIER if domain.ipv4_address else \
-                        constants.IPV6_IDENTIFIER
-
-                    measurement_results_query = get_measurements_for_domain(
-                        domain,
-                        loc_ip_version,
-                        allowed_measurement_age,
-                        sorted_return=True,
-                        db_session=db_session,
-                        allow_all_zmap_measurements=True)
-
-                    measurement_result_tuples = []
-
-                    for res in measurement_results_query:
-                        _ = res.probe.location
-                        measurement_result_tuples.append((res, res.probe.location))
-                        try:
-                            db_session.expunge(res.probe.location)
-                            db_session.expunge(res)
-                        except InvalidRequestError:
-                            pass
-
-                    db_session.expunge(domain)
-                    return domain, location_hint_tuples, measurement_result_tuples
-            except StopIteration:
-                return None
+                loop.run_until_complete(check_domains())
+            finally:
+                loop.close()
+        else:
+            ripe_client = ThreadedRipeClient(ripe_create_sema, ripe_rate_limiters, api_key,
+                                             bill_to_address=bill_to_address,
+                                             result_cache=result_cache,
+                                             batch_window=measurement_batch_window)
+            for _ in range(0, MAX_THREADS):
+                # TODO use ThreadPoolExecutor
+                thread = threading.Thread(target=domain_check_threading_manage,
+                                          args=(next_domain_info,
+                                                functools.partial(check_domain,
+                                                                  ripe_client=ripe_client)))
 
-        for _ in range(0, MAX_THREADS):
-            # TODO use ThreadPoolExecutor
-            thread = threading.Thread(target=domain_check_threading_manage,
-                                      args=(next_domain_info,
-                                            increment_domain_type_count,
-                                            increment_count_for_type,
-                                            ripe_create_sema,
-                                            ripe_slow_down_sema,
-                                            bill_to_address,
-                                            wo_measurements,
-                                            allowed_measurement_age,
-                                            api_key,
-                                            measurement_strategy,
-                                            number_of_probes_per_measurement,
-                                            buffer_time,
-                                            packets_per_measurement,
-                                            use_efficient_probes,
-                                            location_to_probes_dct,
-                                            measurement_results_queue,
-                                            stop_without_old_results))
-
-            threads.append(thread)
-            thread.start()
-
-        for thread in threads:
-            thread.join()
+                threads.append(thread)
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+        prefetch_thread.join()
 
     except KeyboardInterrupt:
         logger.warning('SIGINT recognized stopping Process')
@@ -467,6 +526,86 @@ def ripe_check_process(pid: int,
     logger.info('correct_count {}'.format(correct_type_count))
 
 
+def load_domain_infos(domains: [Domain], allowed_measurement_age: int, use_min_rtt_table: bool,
+                      db_session) \
+        -> [typing.Tuple[Domain, typing.List[typing.Tuple[LocationHint, Location]],
+                         typing.List[typing.Tuple[MeasurementResult, Location]]]]:
+    """
+    Loads the hints with their locations and the measurements with their probe locations for a
+    block of domains with a few set based queries
+    :return: (domain, hint tuples, measurement result tuples) for every domain. All objects are
+             detached from the session and the relations used by the checks are loaded.
+    """
+    domains_by_id = {domain.id: domain
+                     for domain in load_domains_with_hints([domain.id for domain in domains],
+                                                           db_session)}
+    domain_ips = {}
+    for domain in domains_by_id.values():
+        ip_version = constants.IPV4_IDENTIFIER if domain.ipv4_address else \
+            constants.IPV6_IDENTIFIER
+        domain_ips[domain.id] = str(domain.ip_for_version(ip_version))
+
+    measurement_result_tuples = collections.defaultdict(list)
+    if domain_ips:
+        for res in get_measurements_for_ips(set(domain_ips.values()), allowed_measurement_age,
+                                            sorted_return=True, db_session=db_session,
+                                            allow_all_zmap_measurements=True,
+                                            use_min_rtt_table=use_min_rtt_table,
+                                            load_probe_locations=True):
+            measurement_result_tuples[str(res.destination_address)].append(
+                (res, res.probe.location))
+
+    domain_infos = []
+    for domain in domains:
+        domain = domains_by_id.get(domain.id)
+        if domain is None:
+            continue
+
+        location_hint_tuples = [(location_hint, location_hint.location)
+                                for location_hint in domain.all_label_matches
+                                if isinstance(location_hint, CodeMatch)]
+        # the checks modify the result lists
+        domain_infos.append((domain, location_hint_tuples,
+                             list(measurement_result_tuples[domain_ips[domain.id]])))
+
+    db_session.expunge_all()
+    return domain_infos
+
+
+def prefetch_domain_infos(domain_generator: typing.Iterator[Domain], block_size: int,
+                          allowed_measurement_age: int, use_min_rtt_table: bool, db_session,
+                          domain_info_queue: queue.Queue, number_consumers: int,
+                          stop_event: threading.Event):
+    """
+    Loads the domain infos in blocks and puts them in the domain_info_queue
+    Puts one None per consumer in the queue after the last domain
+    """
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                domain_info_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        while not stop_event.is_set():
+            domains = list(itertools.islice(domain_generator, block_size))
+            if not domains:
+                break
+
+            for domain_info in load_domain_infos(domains, allowed_measurement_age,
+                                                 use_min_rtt_table, db_session):
+                if not put(domain_info):
+                    return
+    except Exception:
+        logger.exception('error while prefetching domains')
+    finally:
+        for _ in range(number_consumers):
+            put(None)
+
+
 def measurement_results_saver(measurement_results_queue: queue.Queue, stop_event: threading.Event):
     Session = create_session_for_process(engine)
     db_session = Session()
@@ -481,20 +620,120 @@ def measurement_results_saver(measurement_results_queue: queue.Queue, stop_event
             count_results += 1
 
             if count_results % 10**5 == 0:
-                db_session.bulk_save_objects(results)
+                save_measurement_results(results, db_session)
                 db_session.commit()
 
                 results.clear()
         except queue.Empty:
             pass
 
-    db_session.bulk_save_objects(results)
+    save_measurement_results(results, db_session)
     db_session.commit()
 
     db_session.close()
     Session.remove()
 
 
+class ThreadedRipeClient(object):
+    """
+    Serves the RIPE Atlas requests of the domain checks with the blocking cousteau helpers
+    The coroutines block the event loop of the calling thread so every thread checks one domain.
+    The threads waiting for a measurement are woken by one status poller and their new
+    measurements are created in batches.
+    """
+
+    def __init__(self, ripe_create_sema: mp.Semaphore, ripe_rate_limiters: RipeRateLimiters,
+                 api_key: str, bill_to_address: str=None,
+                 result_cache: RipeHistoryCache=None,
+                 batch_window: float=MEASUREMENT_BATCH_WINDOW):
+        self.ripe_create_sema = ripe_create_sema
+        self.ripe_rate_limiters = ripe_rate_limiters
+        self.api_key = api_key
+        self.bill_to_address = bill_to_address
+        self.result_cache = result_cache
+        self.status_poller = MeasurementStatusPoller(
+            functools.partial(get_measurement_statuses,
+                              ripe_slow_down_sema=ripe_rate_limiters[RipeEndpoint.measurements]))
+        if batch_window > 0:
+            self.measurement_batcher = MeasurementBatcher(
+                functools.partial(create_measurements,
+                                  ripe_slow_down_sema=ripe_rate_limiters[RipeEndpoint.create]),
+                batch_window=batch_window)
+        else:
+            self.measurement_batcher = None
+
+    async def get_measurement_ids(self, ip_addr: str, allowed_measurement_age: int) -> [int]:
+        return get_measurement_ids(ip_addr, self.ripe_rate_limiters[RipeEndpoint.measurements],
+                                   allowed_measurement_age, result_cache=self.result_cache)
+
+    async def check_measurements_for_nodes(self, measurement_ids: [int],
+                                           nodes: [RipeAtlasProbe],
+                                           allowed_measurement_age: int) \
+            -> typing.Optional[typing.List[MeasurementResult]]:
+        return check_measurements_for_nodes(measurement_ids, nodes,
+                                            self.ripe_rate_limiters[RipeEndpoint.results],
+                                            allowed_measurement_age,
+                                            result_cache=self.result_cache)
+
+    async def available_probes(self, ip_version: str, probes: [RipeAtlasProbe]) \
+            -> [RipeAtlasProbe]:
+        return get_available_probes([ip_version], probes)
+
+    async def measure_rtt(self, ip_addr: str, ip_version: str, probes: [RipeAtlasProbe],
+                          description: str, number_of_packets: int=1, tags: [str]=None,
+                          requested_probes: int=1) -> typing.Optional[RipeMeasurementResult]:
+        with self.ripe_create_sema:
+            params = {
+                RipeAtlasProbe.MeasurementKeys.measurement_name.value: description,
+                RipeAtlasProbe.MeasurementKeys.ip_version.value: ip_version,
+                RipeAtlasProbe.MeasurementKeys.api_key.value: self.api_key,
+                RipeAtlasProbe.MeasurementKeys.ripe_slowdown_sema.value:
+                    self.ripe_rate_limiters[RipeEndpoint.results],
+                RipeAtlasProbe.MeasurementKeys.create_slowdown_sema.value:
+                    self.ripe_rate_limiters[RipeEndpoint.create],
+                RipeAtlasProbe.MeasurementKeys.num_packets.value: number_of_packets,
+                RipeAtlasProbe.MeasurementKeys.additional_probes.value: probes[1:],
+                RipeAtlasProbe.MeasurementKeys.requested_probes.value: requested_probes,
+                RipeAtlasProbe.MeasurementKeys.tags.value: tags or [],
+                RipeAtlasProbe.MeasurementKeys.status_poller.value: self.status_poller,
+                RipeAtlasProbe.MeasurementKeys.measurement_batcher.value: self.measurement_batcher
+            }
+            if self.bill_to_address:
+                params[RipeAtlasProbe.MeasurementKeys.bill_to_address.value] = \
+                    self.bill_to_address
+
+            return probes[0].measure_rtt(ip_addr, **params)
+
+
+class AsyncRipeClient(AsyncRipeAtlasClient):
+    """
+    The asyncio RIPE Atlas client for the domain checks
+    The probe status is still fetched with cousteau so it is requested in the default executor
+    """
+
+    async def available_probes(self, ip_version: str, probes: [RipeAtlasProbe]) \
+            -> [RipeAtlasProbe]:
+        return await asyncio.get_event_loop().run_in_executor(None, get_available_probes,
+                                                              [ip_version], probes)
+
+
+async def check_domain_info(check_domain: typing.Callable[..., typing.Awaitable],
+                            domain_info: typing.Tuple[
+                                Domain,
+                                typing.List[typing.Tuple[LocationHint, Location]],
+                                typing.List[typing.Tuple[MeasurementResult, Location]]]):
+    """Checks one domain with check_domain and logs all errors"""
+    domain, location_hints, measurement_result_tuples = domain_info
+    try:
+        logger.debug('next domain %s', domain.name)
+        ip_version = constants.IPV4_IDENTIFIER if domain.ipv4_address else \
+            constants.IPV6_IDENTIFIER
+        await check_domain(domain, location_hints, ip_version=ip_version,
+                           old_measurement_results=measurement_result_tuples)
+    except Exception:
+        logger.exception('Check Domain Error %s', domain.name)
+
+
 def domain_check_threading_manage(next_domain_info: typing.Callable[
                                       [],
                                       typing.Tuple[
@@ -502,26 +741,11 @@ def domain_check_threading_manage(next_domain_info: typing.Callable[
                                           typing.List[typing.Tuple[LocationHint, Location]],
                                           typing.List[typing.Tuple[MeasurementResult, Location]]
                                       ]],
-                                  increment_domain_type_count: typing.Callable[
-                                      [DomainLocationType], None],
-                                  increment_count_for_type: typing.Callable[
-                                      [LocationCodeType], None],
-                                  ripe_create_sema: mp.Semaphore,
-                                  ripe_slow_down_sema: mp.Semaphore,
-                                  bill_to_address: str,
-                                  wo_measurements: bool,
-                                  allowed_measurement_age: int,
-                                  api_key: str,
-                                  measurement_strategy: MeasurementStrategy,
-                                  number_of_probes_per_measurement: int,
-                                  buffer_time: float,
-                                  packets_per_measurement: int,
-                                  use_efficient_probes: bool,
-                                  location_to_probes_dct: typing.Dict[
-                                      str, typing.Tuple[RipeAtlasProbe, float, Location]],
-                                  measurement_results_queue: queue.Queue,
-                                  stop_without_old_results: bool):
-    """The method called to create a thread and manage the domain checks"""
+                                  check_domain: typing.Callable[..., typing.Awaitable]):
+    """
+    The method called to create a thread and manage the domain checks
+    The checks run one after another in an event loop owned by the thread
+    """
     logger.debug('thread started')
 
     def get_domains() -> typing.Generator[typing.Tuple[Domain, typing.List[LocationHint]],
@@ -533,50 +757,77 @@ def domain_check_threading_manage(next_domain_info: typing.Callable[
             else:
                 break
 
-    for domain, location_hints, measurement_result_tuples in get_domains():
-        try:
-            logger.debug('next domain %s', domain.name)
-            ip_version = constants.IPV4_IDENTIFIER if domain.ipv4_address else \
-                constants.IPV6_IDENTIFIER
-            check_domain_location_ripe(domain, location_hints, increment_domain_type_count,
-                                       increment_count_for_type, ripe_create_sema,
-                                       ripe_slow_down_sema, ip_version, bill_to_address,
-                                       wo_measurements, allowed_measurement_age, api_key,
-                                       measurement_strategy, number_of_probes_per_measurement,
-                                       buffer_time, packets_per_measurement, use_efficient_probes,
-                                       location_to_probes_dct, measurement_result_tuples,
-                                       measurement_results_queue, stop_without_old_results)
-        except Exception:
-            logger.exception('Check Domain Error %s', domain.name)
+    loop = asyncio.new_event_loop()
+    try:
+        for domain_info in get_domains():
+            loop.run_until_complete(check_domain_info(check_domain, domain_info))
+    finally:
+        loop.close()
 
     logger.debug('Thread finished')
 
 
-def check_domain_location_ripe(domain: Domain,
-                               location_hints: typing.List[typing.Tuple[LocationHint,
-                                                                        LocationInfo]],
-                               increment_domain_type_count: typing.Callable[
-                                   [DomainLocationType], None],
-                               increment_count_for_type: typing.Callable[
-                                   [LocationCodeType], None],
-                               ripe_create_sema: mp.Semaphore,
-                               ripe_slow_down_sema: mp.Semaphore,
-                               ip_version: str,
-                               bill_to_address: str,
-                               wo_measurements: bool,
-                               allowed_measurement_age: int,
-                               api_key: str,
-                               measurement_strategy: MeasurementStrategy,
-                               number_of_probes_per_measurement: int,
-                               buffer_time: float,
-                               packets_per_measurement: int,
-                               use_efficient_probes: bool,
-                               location_to_probes_dct: typing.Dict[
-                                   str, typing.Tuple[RipeAtlasProbe, float, Location]],
-                               old_measurement_results: typing.List[typing.Tuple[MeasurementResult,
-                                                                                 Location]],
-                               measurement_results_queue: queue.Queue,
-                               stop_without_old_results: bool):
+async def domain_check_async_manage(next_domain_info: typing.Callable[
+                                        [],
+                                        typing.Tuple[
+                                            Domain,
+                                            typing.List[typing.Tuple[LocationHint, Location]],
+                                            typing.List[typing.Tuple[MeasurementResult, Location]]
+                                        ]],
+                                    check_domain: typing.Callable[..., typing.Awaitable],
+                                    max_checks: int):
+    """
+    Checks the domains concurrently in the running event loop
+    :param max_checks: the maximum number of domains checked at the same time
+    """
+    loop = asyncio.get_event_loop()
+    check_slots = asyncio.Semaphore(max_checks)
+    check_tasks = set()
+
+    def check_finished(task: asyncio.Future):
+        check_tasks.discard(task)
+        check_slots.release()
+
+    while True:
+        await check_slots.acquire()
+        domain_info = await loop.run_in_executor(None, next_domain_info)
+        if domain_info is None:
+            check_slots.release()
+            break
+
+        task = asyncio.ensure_future(check_domain_info(check_domain, domain_info))
+        check_tasks.add(task)
+        task.add_done_callback(check_finished)
+
+    if check_tasks:
+        await asyncio.wait(check_tasks)
+
+    logger.debug('async domain checks finished')
+
+
+async def check_domain_location_ripe(domain: Domain,
+                                     location_hints: typing.List[typing.Tuple[LocationHint,
+                                                                              LocationInfo]],
+                                     increment_domain_type_count: typing.Callable[
+                                         [DomainLocationType], None],
+                                     increment_count_for_type: typing.Callable[
+                                         [LocationCodeType], None],
+                                     ripe_client: typing.Union[ThreadedRipeClient,
+                                                               AsyncRipeClient],
+                                     ip_version: str,
+                                     wo_measurements: bool,
+                                     allowed_measurement_age: int,
+                                     measurement_strategy: MeasurementStrategy,
+                                     number_of_probes_per_measurement: int,
+                                     buffer_time: float,
+                                     packets_per_measurement: int,
+                                     use_efficient_probes: bool,
+                                     location_to_probes_dct: typing.Dict[
+                                         str, typing.Tuple[RipeAtlasProbe, float, Location]],
+                                     old_measurement_results: typing.List[
+                                         typing.Tuple[MeasurementResult, Location]],
+                                     measurement_results_queue: queue.Queue,
+                                     stop_without_old_results: bool):
     """checks if ip is at location"""
     matched = False
 
@@ -646,8 +897,8 @@ def check_domain_location_ripe(domain: Domain,
     no_verification_matches = []
 
     if next_match_tup is not None:
-        measurement_ids = get_measurement_ids(str(domain.ip_for_version(ip_version)),
-                                              ripe_slow_down_sema, allowed_age)
+        measurement_ids = await ripe_client.get_measurement_ids(
+            str(domain.ip_for_version(ip_version)), allowed_age)
         logger.debug('number of ripe measurements {}'.format(len(measurement_ids)))
     else:
         measurement_ids = []
@@ -675,10 +926,9 @@ def check_domain_location_ripe(domain: Domain,
                                                                             ))
 
             probes = [probe for probe, _, _ in near_node_distances]
-            measurement_results = check_measurements_for_nodes(measurement_ids,
-                                                               probes,
-                                                               ripe_slow_down_sema,
-                                                               allowed_age)
+            measurement_results = await ripe_client.check_measurements_for_nodes(measurement_ids,
+                                                                                 probes,
+                                                                                 allowed_age)
 
             measurement_result = None
             make_measurement = True
@@ -712,7 +962,7 @@ def check_domain_location_ripe(domain: Domain,
                 if not wo_measurements:
                     # only if no old measurement exists
                     logger.debug('creating measurement')
-                    available_nodes = __get_available_probes([ip_version], probes)
+                    available_nodes = await ripe_client.available_probes(ip_version, probes)
 
                     if not available_nodes:
                         logger.debug(
@@ -720,13 +970,10 @@ def check_domain_location_ripe(domain: Domain,
                         no_verification_matches.append((next_match, location))
                         continue
 
-                    measurement_result = create_and_check_measurement(
+                    measurement_result = await create_and_check_measurement(
                         str(domain.ip_for_version(ip_version)), ip_version, location,
                         available_nodes[:3*number_of_probes_per_measurement],
-                        ripe_create_sema,
-                        ripe_slow_down_sema,
-                        api_key,
-                        bill_to_address=bill_to_address,
+                        ripe_client,
                         number_of_probes=number_of_probes_per_measurement,
                         number_of_packets=packets_per_measurement,
                         use_efficient_probes=use_efficient_probes
@@ -798,22 +1045,23 @@ def check_domain_location_ripe(domain: Domain,
     return 0
 
 
-def __get_available_probes(ip_versions: [str], probes: [RipeAtlasProbe]):
-    ip_versions_needed = []
+def get_available_probes(ip_versions: [str], probes: [RipeAtlasProbe]):
+    """Filters the probes by their availability flags"""
     if constants.IPV4_IDENTIFIER in ip_versions and constants.IPV6_IDENTIFIER in ip_versions:
-        ip_versions_needed.append(AvailableType.both_available)
+        needed_flags = AVAILABILITY_FLAGS[AvailableType.both_available]
     elif constants.IPV4_IDENTIFIER in ip_versions:
-        ip_versions_needed.append(AvailableType.ipv4_available)
+        needed_flags = AVAILABILITY_FLAGS[AvailableType.ipv4_available]
     elif constants.IPV6_IDENTIFIER in ip_versions:
-        ip_versions_needed.append(AvailableType.ipv6_available)
+        needed_flags = AVAILABILITY_FLAGS[AvailableType.ipv6_available]
     else:
         raise ValueError('no valid ip version in ip versions list')
 
+    RipeAtlasProbe.status_service.refresh_outdated([probe.probe_id for probe in probes])
     available_probes = []
 
     for probe in probes:
         try:
-            if probe.available() in ip_versions_needed:
+            if probe.availability_flags() & AVAILABILITY_MASK == needed_flags:
                 available_probes.append(probe)
         except ProbeError:
             logger.exception('Probe Error on probe with id %s and ripe_atlas id %s', probe.id,
@@ -824,12 +1072,18 @@ def __get_available_probes(ip_versions: [str], probes: [RipeAtlasProbe]):
 
 
 def eliminate_duplicate_results(results: [typing.Tuple[MeasurementResult, Location]]):
+    if not results:
+        return
+
+    lats, lons = coordinate_arrays(location for _, location in results)
+    distances = haversine_distance_matrix(lats, lons, lats, lons)
+
     remove_obj = set()
-    for result, location in results:
+    for i, (result, location) in enumerate(results):
         if (result, location) not in remove_obj:
-            for inner_result, inner_location in results:
+            for j, (inner_result, inner_location) in enumerate(results):
                 if result is not inner_result and inner_result not in remove_obj:
-                    if location.gps_distance_haversine(inner_location) < 100:
+                    if distances[i, j] < 100:
                         if result.min_rtt < inner_result.min_rtt:
                             remove_obj.add((inner_result, inner_location))
                         else:
@@ -856,14 +1110,18 @@ def filter_possible_matches(matches: [typing.Tuple[LocationHint, LocationInfo]],
     f_results.sort(key=lambda res: res[0].rtt)
     f_results = f_results[:10]
 
+    match_lats, match_lons = coordinate_arrays(location_info for _, location_info in matches)
+    result_lats, result_lons = coordinate_arrays(loc for _, loc in f_results)
+    distances = haversine_distance_matrix(match_lats, match_lons, result_lats, result_lons)
+
     near_matches = collections.defaultdict(list)
-    for match, location_info in matches:
+    for i, (match, location_info) in enumerate(matches):
         location_distances = []
-        for result, loc in f_results:
+        for j, (result, loc) in enumerate(f_results):
             if result.min_rtt is None:
                 continue
 
-            distance = loc.gps_distance_haversine(location_info)
+            distance = float(distances[i, j])
 
             if distance > result.min_rtt * 100:
                 break
@@ -912,31 +1170,32 @@ def filter_possible_matches(matches: [typing.Tuple[LocationHint, LocationInfo]],
 NON_WORKING_PROBE_IDS = set()
 
 
-def create_and_check_measurement(ip_addr: str, ip_version: str,
-                                 location: LocationInfo, nodes: [Probe],
-                                 ripe_create_sema: mp.Semaphore,
-                                 ripe_slow_down_sema: mp.Semaphore,
-                                 api_key: str,
-                                 bill_to_address: str=None,
-                                 number_of_probes: int=1,
-                                 number_of_packets: int=1,
-                                 use_efficient_probes: bool=False) \
+async def create_and_check_measurement(ip_addr: str, ip_version: str,
+                                       location: LocationInfo, nodes: [Probe],
+                                       ripe_client: typing.Union[ThreadedRipeClient,
+                                                                 AsyncRipeClient],
+                                       number_of_probes: int=1,
+                                       number_of_packets: int=1,
+                                       use_efficient_probes: bool=False) \
         -> typing.Optional[RipeMeasurementResult]:
-    """creates a measurement for the parameters and checks for the created measurement"""
+    """
+    creates a measurement for the parameters and checks for the created measurement
+    All nodes not blacklisted are candidates and RIPE Atlas picks number_of_probes of them. The
+    candidates of a location are the same for all its checks, so their measurements can be
+    batched into one request.
+    """
     if number_of_probes <= 0:
         raise ValueError('number_of_probes must be larger than 0')
 
-    near_nodes_all = [node for node in nodes if node.id not in NON_WORKING_PROBE_IDS]
+    def candidate_nodes() -> [Probe]:
+        candidates = [node for node in nodes if node.id not in NON_WORKING_PROBE_IDS]
+        if use_efficient_probes:
+            candidates.sort(
+                key=lambda x: x.second_hop_latency if x.second_hop_latency else 10000)
+            candidates = candidates[:number_of_probes * 2]
+        return candidates
 
-    logger.debug('%s near nodes not blacklisted', len(near_nodes_all))
-
-    near_nodes = near_nodes_all[:]
-    if use_efficient_probes:
-        near_nodes.sort(key=lambda x: x.second_hop_latency if x.second_hop_latency else 10000)
-        near_nodes = near_nodes[:number_of_probes * 2]
-
-    while len(near_nodes) > number_of_probes:
-        del near_nodes[random.randint(0, len(near_nodes) - 1)]
+    near_nodes = candidate_nodes()
 
     logger.debug('%s nodes for selection of %s we would like to use', len(near_nodes),
                  number_of_probes)
@@ -944,77 +1203,47 @@ def create_and_check_measurement(ip_addr: str, ip_version: str,
     if not near_nodes:
         return None
 
-    with ripe_create_sema:
-        while True:
-            try:
-                params = {
-                    RipeAtlasProbe.MeasurementKeys.measurement_name.value:
-                        'HLOC Geolocation Measurement for location {}'.format(location.city_name),
-                    RipeAtlasProbe.MeasurementKeys.ip_version.value: ip_version,
-                    RipeAtlasProbe.MeasurementKeys.api_key.value: api_key,
-                    RipeAtlasProbe.MeasurementKeys.ripe_slowdown_sema.value: ripe_slow_down_sema,
-                    RipeAtlasProbe.MeasurementKeys.num_packets.value: number_of_packets,
-                    RipeAtlasProbe.MeasurementKeys.additional_probes.value: near_nodes[1:],
-                    RipeAtlasProbe.MeasurementKeys.tags.value: [constants.HLOC_RIPE_TAG]
-                }
-                if bill_to_address:
-                    params[RipeAtlasProbe.MeasurementKeys.bill_to_address.value] = bill_to_address
-
-                measurement_result = near_nodes[0].measure_rtt(ip_addr, **params)
-
-                return measurement_result
-            except ProbeError:
-                logger.warning('Probe error for probe id %s', near_nodes[0].id, exc_info=True)
-
-                for node in near_nodes:
-                    NON_WORKING_PROBE_IDS.add(node.id)
-                    near_nodes_all.remove(node)
-
-                near_nodes = near_nodes_all[:]
-                while len(near_nodes) > number_of_probes:
-                    del near_nodes[random.randint(0, len(near_nodes) - 1)]
-
-                if not near_nodes:
-                    return None
-            except ServerError:
-                # RA server returned status >= 500
-                # solution is trying to sleep for 5 - 10 minutes and then try again
-                logger.exception('RA has server issues')
-                print(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'RA has Server issues')
-                time.sleep(300 + random.randrange(0, 300))
+    while True:
+        try:
+            return await ripe_client.measure_rtt(
+                ip_addr, ip_version, near_nodes,
+                'HLOC Geolocation Measurement for location {}'.format(location.city_name),
+                number_of_packets=number_of_packets, tags=[constants.HLOC_RIPE_TAG],
+                requested_probes=min(number_of_probes, len(near_nodes)))
+        except ProbeError:
+            logger.warning('Probe error for probe ids %s',
+                           ', '.join(str(node.id) for node in near_nodes), exc_info=True)
+
+            for node in near_nodes:
+                NON_WORKING_PROBE_IDS.add(node.id)
+
+            near_nodes = candidate_nodes()
+            if not near_nodes:
+                return None
+        except ServerError:
+            # RA server returned status >= 500
+            # solution is trying to sleep for 5 - 10 minutes and then try again
+            logger.exception('RA has server issues')
+            print(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'RA has Server issues')
+            await asyncio.sleep(300 + random.randrange(0, 300))
 
 
 def update_probes(probes: [RipeAtlasProbe]):
-    def _update(probe_queue_int: queue.Queue):
+    """Refreshes the status of all probes with bulk probe listings"""
+    retries = 0
+    while True:
         try:
-            while True:
-                probe_t = probe_queue_int.get(timeout=1)
-                retries = 0
-                while True:
-                    try:
-                        probe_t.update()
-                    except ripe_exceptions.APIResponseError:
-                        retries += 1
-
-                        if retries % 5 == 0:
-                            logger.exception('ripe ApiResponseError mod 5:')
-                    else:
-                        break
-        except queue.Empty:
-            pass
+            RipeAtlasProbe.status_service.refresh([probe.probe_id for probe in probes])
+        except ripe_exceptions.APIResponseError:
+            retries += 1
 
-    probe_queue = queue.Queue()
-    for probe in probes:
-        probe_queue.put(probe)
-
-    threads = []
-    for i in range(10):
-        thread = threading.Thread(target=_update, args=(probe_queue,))
-        thread.start()
-        threads.append(thread)
+            if retries % 5 == 0:
+                logger.exception('ripe ApiResponseError mod 5:')
+        else:
+            break
 
-    for thread in threads:
-        thread.join()
+    for probe in probes:
+        probe.update()
 
     logger.info('updated probes')
 
@@ -1027,17 +1256,18 @@ def assign_location_probes(locations: [LocationInfo], probes: [RipeAtlasProbe],
     near_probes_assignments = []
     location_to_probes_dct = {}
 
+    probes = list(probes)
+    probe_index = SpatialIndex.from_objects(probes, location=operator.attrgetter('location'))
+
     for location in locations:
-        near_probes = []
-        for probe in probes:
-            dist = probe.location.gps_distance_haversine(location)
-            if dist < 1000:
-                _ = str(probe.location.lat) + str(probe.location.lon) + probe.location.id + \
-                    str(probe.second_hop_latency)
-                near_probes.append((probe, dist, probe.location))
-
-        near_probes.sort(key=operator.itemgetter(1))
-        near_probes = near_probes[:200]
+        near_indexes, distances = probe_index.query_radius(location.lat, location.lon,
+                                                           constants.NEAR_PROBES_RADIUS)
+        in_radius = distances < constants.NEAR_PROBES_RADIUS
+        near_indexes = near_indexes[in_radius][:constants.NEAR_PROBES_LIMIT]
+        distances = distances[in_radius][:constants.NEAR_PROBES_LIMIT]
+
+        near_probes = [(probes[index], float(distance), probes[index].location)
+                       for index, distance in zip(near_indexes, distances)]
         location_to_probes_dct[location.id] = near_probes
         near_probes_assignments.extend([{'probe_id': probe[0].id,
                                          'location_info_id': location.id}
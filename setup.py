@@ -3,14 +3,14 @@
 from distutils.core import setup
 
 install_requires = ['requests>=2.12.4', 'ripe.atlas.cousteau>=1.3', 'configargparse>=0.11',
-                    'sqlalchemy>=1.1.4', 'psycopg2>=2.6.2', 'marisa-trie>=0.7.4', 'ipaddress>=1.0',
-                    'typing>=3.6', 'multiprocessing-logging>=0.2.5']
+                    'sqlalchemy>=1.2.6', 'psycopg2>=2.6.2', 'marisa-trie>=0.7.4', 'ipaddress>=1.0',
+                    'typing>=3.6', 'multiprocessing-logging>=0.2.5', 'numpy>=1.13.0']
 
 setup(name='hloc',
       version='0.1',
       description='Hints based LOCation verification framework',
       author='Patrick Sattler',
       author_email='sattler@in.tum.de',
-      packages=['hloc', 'hloc.scripts', 'hloc.models'],
+      packages=['hloc', 'hloc.scripts', 'hloc.models', 'hloc.geo'],
       install_requires=install_requires,
       )